@@ -5,29 +5,197 @@ from shapely.geometry import Point
 from shapely import wkt, LineString
 from typing import Union
 from datetime import datetime, timedelta
-import re
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import osmnx as ox
-
-def open_file(path: str) -> pd.DataFrame:
+import pyarrow as pa
+import pyarrow.parquet as pq
+import road_network as rn
+import routing
+import street_names
+import zones
+
+def open_file(path: str, columns: list = None, filters: list = None) -> pd.DataFrame:
     """
-    opens csv file as a pandas dataframe
-    :param path: path to the csv file
+    opens a csv or parquet file as a pandas dataframe
+    Geometry columns of parquet files are read back as shapely geometries.
+    :param path: path to the csv or parquet file
+    :param columns: names of the columns to read. All columns if None.
+    :param filters: pyarrow filters for the rows of a parquet file, for example [('ZONE', 'in', [4, 12])] or
+        month_filter('CRASH DATE_CRASH TIME', 2018, 5). Row groups that cannot match are not read.
     :return: pandas DataFrame
     """
-    return pd.read_csv(path)
+    if not path.endswith('.parquet'):
+        return pd.read_csv(path, usecols=columns)
+
+    table = pq.read_table(path, columns=columns, filters=filters)
+    df = table.to_pandas()
+    metadata = table.schema.metadata or {}
+    for column in json.loads(metadata.get(b'wkb_columns', b'[]')):
+        if column in df.columns:
+            df[column] = shapely.from_wkb(df[column].to_numpy())
+    return df
+
+
+def save_file(df: pd.DataFrame, path: str, datetime_columns: list = None, geometry_columns: list = None,
+              sort_by: str = None) -> pd.DataFrame:
+    """
+    Saves a pandas dataframe as a csv or parquet file. The index is saved as the 'Unnamed: 0' column, the same
+    column read_csv makes from the index of a saved csv file, so both formats open to the same columns.
+    Parquet files store geometries as WKB, datetimes as timestamps and zones as small integers.
+    :param df: pandas dataframe
+    :param path: path to the csv or parquet file
+    :param datetime_columns: columns with datetime strings to store as timestamps
+    :param geometry_columns: columns with shapely geometries or WKT strings. Columns holding shapely geometries are
+        found without it.
+    :param sort_by: column to sort the rows by before saving a parquet file. Sorting by the column used in filters
+        lets open_file skip row groups.
+    :return: the saved dataframe
+    """
+    if not path.endswith('.parquet'):
+        df.to_csv(path, index=True)
+        return df
+
+    if 'Unnamed: 0' in df.columns:
+        artifact = df.copy()
+    elif df.index.nlevels == 1:
+        artifact = df.reset_index(names='Unnamed: 0')
+    else:
+        artifact = df.reset_index()
+    artifact = pd.DataFrame(artifact)
+    for column in datetime_columns or []:
+        artifact[column] = pd.to_datetime(artifact[column])
+    if 'ZONE' in artifact.columns:
+        artifact['ZONE'] = zone_codes(artifact['ZONE'])
+    if sort_by is not None:
+        artifact = artifact.sort_values(sort_by, kind='stable')
+
+    geometry_columns = set(geometry_columns or [])
+    for column in artifact.columns:
+        if isinstance(artifact[column].dtype, gpd.array.GeometryDtype) or (
+                artifact[column].dtype == object and isinstance(artifact[column].dropna().head(1).squeeze(),
+                                                                shapely.Geometry)):
+            geometry_columns.add(column)
+    for column in geometry_columns:
+        values = np.asarray(artifact[column], dtype=object)
+        if len(values) and isinstance(pd.Series(values).dropna().head(1).squeeze(), str):
+            values = shapely.from_wkt(values)
+        artifact[column] = shapely.to_wkb(values)
+
+    table = pa.Table.from_pandas(artifact, preserve_index=False)
+    metadata = {**(table.schema.metadata or {}), b'wkb_columns': json.dumps(sorted(geometry_columns)).encode()}
+    pq.write_table(table.replace_schema_metadata(metadata), path, row_group_size=100000)
+    return df
+
+
+def zone_codes(zones: pd.Series) -> pd.Series:
+    """
+    Stores zones as small integers. Zone numbers become int16 and zone names become a categorical with integer codes.
+    A zone inside a list, like the ZONE column of older crash files, is taken out of the list.
+    :param zones: pandas Series of zones
+    :return: pandas Series of zones with a compact dtype
+    >>> zone_codes(pd.Series([4.0, None, 12.0])).tolist()
+    [4, <NA>, 12]
+    >>> zone_codes(pd.Series([['Astoria'], [], ['Astoria']])).cat.codes.tolist()
+    [0, -1, 0]
+    """
+    if zones.dtype == object:
+        zones = zones.map(lambda zone: (zone[0] if len(zone) else None) if isinstance(zone, list) else zone)
+    if pd.api.types.is_numeric_dtype(zones.dtype) or pd.api.types.is_numeric_dtype(zones.dropna().infer_objects()):
+        return zones.astype('Int16')
+    return zones.astype('category')
 
-def combine_taxi_dfs() -> pd.DataFrame:
+
+def month_filter(column: str, year: int, month: int) -> list:
+    """
+    Makes open_file filters for the rows of one month.
+    :param column: name of a datetime column
+    :param year: year
+    :param month: month
+    :return: list of pyarrow filters
+    >>> month_filter('CRASH DATE_CRASH TIME', 2018, 12)
+    [('CRASH DATE_CRASH TIME', '>=', Timestamp('2018-12-01 00:00:00')), ('CRASH DATE_CRASH TIME', '<', Timestamp('2019-01-01 00:00:00'))]
+    """
+    start = pd.Timestamp(year=year, month=month, day=1)
+    return [(column, '>=', start), (column, '<', start + pd.DateOffset(months=1))]
+
+
+def csv_to_parquet(csv_path: str, datetime_columns: list = None, geometry_columns: list = None,
+                   sort_by: str = None) -> str:
+    """
+    Converts a csv file made by this pipeline to a parquet file next to it.
+    :param csv_path: path to the csv file
+    :param datetime_columns: columns with datetime strings to store as timestamps
+    :param geometry_columns: columns with WKT geometries to store as WKB
+    :param sort_by: column to sort the rows by
+    :return: path to the parquet file
     """
+    parquet_path = os.path.splitext(csv_path)[0] + '.parquet'
+    save_file(open_file(csv_path), parquet_path, datetime_columns, geometry_columns, sort_by)
+    return parquet_path
+
+
+# columns of the monthly taxi files kept by taxi_file_setup and their compact dtypes
+TAXI_DTYPES = {'tpep_pickup_datetime': str, 'tpep_dropoff_datetime': str, 'trip_distance': 'float32',
+               'PULocationID': 'int16', 'DOLocationID': 'int16', 'fare_amount': 'float32', 'tip_amount': 'float32',
+               'tolls_amount': 'float32', 'total_amount': 'float32'}
+
+
+def sample_taxi_month(path, sample_size: int = 50000, seed=None, chunksize: int = 500000) -> pd.DataFrame:
+    """
+    Draws a uniform random sample of trips from one monthly taxi file without reading the whole file into memory.
+    The file is read in chunks and every row gets a random key. The rows with the sample_size smallest keys are the
+    sample (reservoir sampling), so memory use depends on sample_size and chunksize, not on the file size.
+    :param path: path or buffer of a monthly taxi trip csv file
+    :param sample_size: number of trips to sample
+    :param seed: seed or numpy SeedSequence for the random keys. The sample is reproducible with the same seed.
+    :param chunksize: number of rows read at a time
+    :return: pandas dataframe of the sampled trips indexed by their row number in the file
+    >>> import io
+    >>> month = ('tpep_pickup_datetime,tpep_dropoff_datetime,trip_distance,PULocationID,DOLocationID,fare_amount,'
+    ...          'tip_amount,tolls_amount,total_amount,VendorID\\n' +
+    ...          '01/01/2018 01:00:03 AM,01/01/2018 01:11:10 AM,2.5,10,15,9.5,1,0,11.3,1\\n' * 10)
+    >>> sample = sample_taxi_month(io.StringIO(month), sample_size=3, seed=1, chunksize=4)
+    >>> len(sample), sample['PULocationID'].dtype
+    (3, dtype('int16'))
+    >>> sample.index.equals(sample_taxi_month(io.StringIO(month), sample_size=3, seed=1, chunksize=4).index)
+    True
+    """
+    rng = np.random.default_rng(seed)
+    reservoir = None
+    for chunk in pd.read_csv(path, usecols=list(TAXI_DTYPES), dtype=TAXI_DTYPES, chunksize=chunksize):
+        chunk['sample_key'] = rng.random(len(chunk))
+        if reservoir is not None:
+            # rows with a key above the largest key of a full reservoir can never be sampled
+            if len(reservoir) == sample_size:
+                chunk = chunk[chunk['sample_key'] < reservoir['sample_key'].max()]
+            chunk = pd.concat([reservoir, chunk])
+        reservoir = chunk.nsmallest(sample_size, 'sample_key')
+    return reservoir.drop(columns='sample_key').sort_index()
+
+
+def combine_taxi_dfs(sample_size: int = 50000, seed=None, workers: int = None, chunksize: int = 500000,
+                     taxi_dir: str = 'taxi', save_path: str = 'sampled_combined_taxi_2018_600k.csv') -> pd.DataFrame:
+    """
+    Samples the 12 monthly taxi files in parallel and combines the samples.
+    :param sample_size: number of trips sampled from every month
+    :param seed: seed for the samples. The combined sample is reproducible with the same seed.
+    :param workers: number of months sampled at the same time. Uses all cores if None.
+    :param chunksize: number of rows read at a time from a monthly file
+    :param taxi_dir: directory with the monthly taxi files
+    :param save_path: path of the csv file the combined sample is saved to. Not saved if None.
     :return: Combined 12 months of taxi trip data into one DataFrame
     """
-    dfs = []
-    for i in range(1, 13):
-        df = pd.read_csv(f'taxi/Yellow_Taxi_Trip_Data_{i}_2018.csv', infer_datetime_format=True)
-        df = df.sample(n=50000)
-        dfs.append(df)
+    paths = [f'{taxi_dir}/Yellow_Taxi_Trip_Data_{i}_2018.csv' for i in range(1, 13)]
+    # an independent random stream for every month keeps the sample the same in any process order
+    seeds = np.random.SeedSequence(seed).spawn(len(paths))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        dfs = list(executor.map(sample_taxi_month, paths, [sample_size] * len(paths), seeds,
+                                [chunksize] * len(paths)))
     combined = pd.concat(dfs)
-    combined.to_csv('sampled_combined_taxi_2018_600k.csv')
+    if save_path is not None:
+        combined.to_csv(save_path)
     return combined
 
 def format_index(df: pd.DataFrame, new_index_name: str) -> pd.DataFrame:
@@ -81,6 +249,91 @@ def convert_to_geometry_point(coords: str) -> Union[shapely.Point, shapely.LineS
     return geo_point
 
 
+def report_invalid_geometries(invalid: np.ndarray) -> int:
+    """
+    Prints how many rows did not give a geometry.
+    :param invalid: numpy boolean array that is True for the rows without a geometry
+    :return: number of invalid rows
+    """
+    count = int(invalid.sum())
+    if count:
+        print(f'Invalid geometries: {count} of {len(invalid)} rows')
+    return count
+
+
+def points_from_coordinates(latitudes, longitudes) -> np.ndarray:
+    """
+    Makes shapely Points from latitude and longitude columns in one call. Rows with a missing coordinate get None and
+    are reported.
+    :param latitudes: array-like of latitudes
+    :param longitudes: array-like of longitudes
+    :return: numpy array of Points
+    >>> points_from_coordinates([40.8018, None], [-73.96108, -73.9])
+    Invalid geometries: 1 of 2 rows
+    array([<POINT (-73.961 40.802)>, None], dtype=object)
+    """
+    lat = pd.to_numeric(pd.Series(latitudes), errors='coerce').to_numpy(dtype=np.float64)
+    lon = pd.to_numeric(pd.Series(longitudes), errors='coerce').to_numpy(dtype=np.float64)
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    points = np.full(len(lat), None, dtype=object)
+    points[valid] = shapely.points(lon[valid], lat[valid])
+    report_invalid_geometries(~valid)
+    return points
+
+
+def location_points(locations: np.ndarray) -> np.ndarray:
+    """
+    Makes shapely Points from "(lat, lon)" strings. The strings are split at the comma and both parts read as numbers
+    for all rows at once.
+    :param locations: numpy array of location strings with one comma each
+    :return: numpy array of Points, None for strings that are not two numbers
+    >>> location_points(np.array(['(40.8018, -73.96108)', '(40.7, x)', '(40.1, )', '(, -73.8)'], dtype=object))
+    array([<POINT (-73.961 40.802)>, None, None, None], dtype=object)
+    """
+    points = np.full(len(locations), None, dtype=object)
+    if len(locations) == 0:
+        return points
+    parts = pd.Series(locations, dtype='str').str.strip('() ').str.partition(',')
+    coordinates = np.column_stack([pd.to_numeric(parts[column].str.strip(), errors='coerce').to_numpy(dtype=np.float64)
+                                   for column in [0, 2]])
+    valid = np.isfinite(coordinates).all(axis=1)
+    points[valid] = shapely.points(coordinates[valid, 1], coordinates[valid, 0])
+    return points
+
+
+def geometries_from_text(values) -> np.ndarray:
+    """
+    Makes shapely geometries from a column of "(lat, lon)" location strings and WKT strings of any geometry type in
+    bulk, instead of calling convert_to_geometry_point on every row. Values that are already geometries are kept.
+    Rows that cannot be parsed get None and are reported instead of raising.
+    :param values: array-like of location strings, WKT strings or geometries
+    :return: numpy array of geometries
+    >>> geometries_from_text(['(40.8018, -73.96108)', 'MULTILINESTRING ((0 0, 1 1), (2 2, 3 3))', 'LINESTRING (0',
+    ...                       None])
+    Invalid geometries: 1 of 4 rows
+    array([<POINT (-73.961 40.802)>,
+           <MULTILINESTRING ((0 0, 1 1), (2 2, 3 3))>, None, None],
+          dtype=object)
+    """
+    values = np.asarray(values, dtype=object)
+    text = pd.Series(values)
+    geometries = np.where(shapely.is_geometry(values), values, None)
+
+    # "(lat, lon)" strings are read as numbers, every other string as WKT
+    is_location = ((text.str.startswith('(') == True) & (text.str.count(',') == 1)).to_numpy()
+    is_wkt = text.str.len().notna().to_numpy() & ~is_location
+    geometries[is_location] = location_points(values[is_location])
+    geometries[is_wkt] = shapely.from_wkt(values[is_wkt], on_invalid='ignore')
+    report_invalid_geometries(pd.notna(values) & pd.isna(geometries))
+    return geometries
+
+
+# format of the crash and closure zone files: 2 stores the zone number (objectid) of the trips in ZONE
+ZONE_FILE_VERSION = 2
+# borough codes of the closure file and the matching borough names of the taxi zone file
+BOROUGH_NAMES = {'B': 'Brooklyn', 'S': 'Staten Island', 'M': 'Manhattan', 'Q': 'Queens', 'X': 'Bronx'}
+
+
 def borough_match(borough_code: str, borough_name: str) -> bool:
     """
     Matches borough code from closure file to the borough name in taxi zone file.
@@ -95,98 +348,177 @@ def borough_match(borough_code: str, borough_name: str) -> bool:
     >>> match
     False
     """
-    if borough_code == 'B' and borough_name == 'Brooklyn':
-        return True
-    elif borough_code == 'S' and borough_name == 'Staten Island':
-        return True
-    elif borough_code == 'M' and borough_name == 'Manhattan':
-        return True
-    elif borough_code == 'Q' and borough_name == 'Queens':
-        return True
-    elif borough_code == 'X' and borough_name == 'Bronx':
-        return True
-    else:
-        return False
+    return BOROUGH_NAMES.get(borough_code) == borough_name
 
 
-def add_zone_to_crash(df: pd.DataFrame, nyc_geo: gpd.geodataframe) -> gpd.GeoDataFrame:
+def build_zone_index(nyc_geo: gpd.GeoDataFrame) -> shapely.STRtree:
     """
-    Finds the zone corresponding to car crashes.
+    Builds a spatial index over the taxi zone boundaries. The boundaries are prepared, like the ones read with
+    zones.read_zones, so zones.query_zones can test them quickly.
+    :param nyc_geo: geopandas dataframe with taxi zone data.
+    :return: STRtree whose tree indices are the row positions of the zones in nyc_geo.
+    """
+    geometries = np.asarray(nyc_geo.geometry.values)
+    shapely.prepare(geometries)
+    return shapely.STRtree(geometries)
+
+
+def assign_zones(points, nyc_geo: gpd.GeoDataFrame, zone_index: shapely.STRtree = None) -> np.ndarray:
+    """
+    Finds the taxi zone containing each point with one bulk query against the zone index.
+    When a point lies in more than one zone, the first zone in nyc_geo wins, like the zone loop it replaces.
+    :param points: array-like of shapely Points.
+    :param nyc_geo: geopandas dataframe with taxi zone data.
+    :param zone_index: index from build_zone_index. Built from nyc_geo if not given.
+    :return: numpy array with the row position in nyc_geo of the zone containing each point. -1 if no zone contains it.
+    >>> from shapely.geometry import box
+    >>> zones = gpd.GeoDataFrame({'zone': ['a', 'b']}, geometry=[box(0, 0, 1, 1), box(1, 0, 2, 1)])
+    >>> assign_zones([Point(0.5, 0.5), Point(1.5, 0.5), Point(5, 5)], zones)
+    array([ 0,  1, -1])
+    """
+    if zone_index is None:
+        zone_index = build_zone_index(nyc_geo)
+    points = np.asarray(points, dtype=object)
+    point_positions, zone_positions = zones.query_zones(zone_index, points, 'within')
+
+    # keep the lowest zone position for every point
+    no_zone = len(nyc_geo)
+    positions = np.full(len(points), no_zone, dtype=np.int64)
+    np.minimum.at(positions, point_positions, zone_positions)
+    positions[positions == no_zone] = -1
+    return positions
+
+
+def taxi_zone_ids(nyc_geo: gpd.GeoDataFrame) -> np.ndarray:
+    """
+    Finds the zone number (objectid) of every taxi zone, the number the taxi trips use in PULocationID and
+    DOLocationID. The crash and closure zone files store zones by this number.
+    :param nyc_geo: geopandas dataframe with taxi zone data.
+    :return: numpy int64 array with the zone number of every row of nyc_geo
+    >>> taxi_zone_ids(pd.DataFrame({'objectid': ['4', '12']}))
+    array([ 4, 12])
+    """
+    return nyc_geo['objectid'].astype(np.int64).to_numpy()
+
+
+def check_zone_numbers(zones: pd.Series, file: str):
+    """
+    Makes sure a ZONE column holds zone numbers, not the zone names older crash files stored.
+    :param zones: pandas Series of zones
+    :param file: name of the file the zones come from, for the error message
+    >>> check_zone_numbers(pd.Series(['Astoria']), 'Crash_zones')
+    Traceback (most recent call last):
+    ...
+    ValueError: The ZONE column of Crash_zones holds zone names. Rebuild it with zone numbers (objectid), for example with: python pipeline.py --force crash_zones closure_zones
+    """
+    if not (pd.api.types.is_numeric_dtype(zones.dtype) or pd.api.types.is_numeric_dtype(zones.dropna().infer_objects())):
+        raise ValueError(f'The ZONE column of {file} holds zone names. Rebuild it with zone numbers (objectid), for '
+                         f'example with: python pipeline.py --force crash_zones closure_zones')
+
+
+def add_zone_to_crash(df: pd.DataFrame, nyc_geo: gpd.geodataframe,
+                      save_path: str = 'Crash_zones.parquet') -> gpd.GeoDataFrame:
+    """
+    Finds the zone corresponding to car crashes. The crash points are made in bulk from the LATITUDE and LONGITUDE
+    columns, or from the LOCATION strings if the coordinates are not there.
     :param df: Pandas dataframe with crashes data.
     :param nyc_geo: geopandas dataframe with taxi zone data.
-    :return: geopandas dataframe with crash data and zones where the crash occurred.
+    :param save_path: path of the csv or parquet file the crash zones are saved to. Not saved if None.
+    :return: geopandas dataframe with crash data and the zone number (objectid) where the crash occurred in the ZONE
+        column, <NA> outside the taxi zones.
+    >>> from shapely.geometry import box
+    >>> zones = gpd.GeoDataFrame({'zone': ['a', 'b'], 'objectid': [7, 3]}, geometry=[box(0, 0, 1, 1), box(1, 0, 2, 1)])
+    >>> crash = pd.DataFrame({'index': [1, 2, 3], 'LOCATION': ['(0.5, 1.5)', '(0.5, 0.5)', '(5.0, 5.0)']})
+    >>> add_zone_to_crash(crash, zones, save_path=None)['ZONE'].tolist()
+    [3, 7, <NA>]
     """
     crs = 'EPSG:4326'
-    df['ZONE'] = [list() for x in range(len(df.index))]
-    taxi_zones = nyc_geo.zone
-    taxi_zones_boundaries = nyc_geo.geometry
-    df['geometry'] = df['LOCATION'].apply(lambda x: convert_to_geometry_point(x))
+    if {'LATITUDE', 'LONGITUDE'} <= set(df.columns):
+        # the geometry holds the coordinates, so the columns are not kept
+        geometry = points_from_coordinates(df['LATITUDE'], df['LONGITUDE'])
+        df = df.drop(columns=['LATITUDE', 'LONGITUDE'])
+    else:
+        geometry = geometries_from_text(df['LOCATION'])
+    geometry = pd.Series(geometry, index=df.index)
+
+    # look up all crash locations in the zone index at once and store the zone number (objectid) of the trips
+    zone_positions = assign_zones(geometry.to_numpy(), nyc_geo)
+    df['ZONE'] = pd.Series(taxi_zone_ids(nyc_geo)[zone_positions], index=df.index,
+                           dtype='Int16').mask(zone_positions < 0)
+    df['geometry'] = geometry
     data_gdf = gpd.GeoDataFrame(df, geometry='geometry', crs=crs)
 
-    for i, row in data_gdf.iterrows():
-        coords = row['geometry']
-        for boundary, zone in zip(taxi_zones_boundaries, taxi_zones):
-            if boundary.contains(coords):
-                data_gdf.at[i, 'ZONE'].append(zone)
-                break
-    data_gdf.to_csv('Crash_zones.csv', index=True)
+    if save_path is not None:
+        save_file(data_gdf, save_path, datetime_columns=['CRASH DATE_CRASH TIME'], sort_by='CRASH DATE_CRASH TIME')
     return data_gdf
 
 
-def add_zone_to_closures(closures, street_geometries, nyc_geo) -> pd.DataFrame:
+def add_zone_to_closures(closures, street_geometries, nyc_geo,
+                         save_path: str = 'closure_zones.parquet') -> pd.DataFrame:
     """
-    Finds the zone corresponding with the coordinates of a road closure. Creates a new
+    Finds the zones corresponding with the streets of the road closures. A closure gets every zone of its borough
+    that one of the geometries of its street intersects. Street names are compared in their canonical form (see
+    street_names.py), so 'W 4th St' matches 'west 4 street', and the share of closures with a street is printed.
     :param closures: dataframe containing the street closures in New York city in 2018.
     :param street_geometries: dataframe containing the LineStrings representing the streets of New York city.
     :param nyc_geo: geopandas dataframe containing information about taxi zones in New York city.
-    :return pandas dataframe with columns for road closure ID and zone where the road closure is.
+    :param save_path: path of the csv or parquet file the closure zones are saved to. Not saved if None.
+    :return pandas dataframe with columns for road closure ID and the zone number (objectid) of the zone where the road
+        closure is.
+    >>> from shapely.geometry import box
+    >>> zones = gpd.GeoDataFrame({'zone': ['a', 'b', 'c'], 'borough': ['Manhattan', 'Manhattan', 'Queens'],
+    ...                           'objectid': [7, 3, 9]}, geometry=[box(0, 0, 1, 1), box(1, 0, 2, 1), box(2, 0, 3, 1)])
+    >>> streets = pd.DataFrame({'name': ['main street', 'main street', 'broadway'],
+    ...                         'geometry': ['LINESTRING (0.5 0.2, 0.5 0.8)', 'LINESTRING (0.5 0.5, 2.5 0.5)',
+    ...                                      'LINESTRING (1.2 0.5, 1.8 0.5)']})
+    >>> close = pd.DataFrame({'SEGMENTID': [100, 200, 300], 'BOROUGH_CODE': ['M', 'M', 'Q'],
+    ...                       'ONSTREETNAME': ['MAIN ST', 'broadway', 'unknown road']})
+    >>> add_zone_to_closures(close, streets, zones, save_path=None)
+    Closures matched to a street geometry: 66.7%
+       SEGMENTID  ZONE
+    0        100     7
+    1        100     3
+    2        200     3
     """
-    # make connector table
-    closure_zones = pd.DataFrame(columns=['SEGMENTID', 'ZONE'])
-
     # fix the coordinates and crs in street_geometries
     crs = 'EPSG:4326'
-    street_geometries['geometry'] = street_geometries['geometry'].apply(lambda x: convert_to_geometry_point(x))
+    street_geometries['geometry'] = geometries_from_text(street_geometries['geometry'])
     street_geometries = gpd.GeoDataFrame(street_geometries, geometry='geometry', crs=crs)
+    geometries = np.asarray(street_geometries.geometry.values)
+
+    # encode both sides' street names as codes into one list of canonical names and join on the codes
+    names = street_names.encode_names(closures['ONSTREETNAME'], street_geometries['name'])
+    closure_codes, street_codes = names.codes
+    print(f'Closures matched to a street geometry: {names.match_rate():.1%}')
+    street_order = np.argsort(street_codes, kind='stable')
+    sorted_codes = street_codes[street_order]
+    first = np.searchsorted(sorted_codes, closure_codes, side='left')
+    counts = np.where(closure_codes >= 0, np.searchsorted(sorted_codes, closure_codes, side='right') - first, 0)
+    closure_rows = np.repeat(np.arange(len(closures)), counts)
+    offsets = np.arange(len(closure_rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    geometry_rows = street_order[np.repeat(first, counts) + offsets]
+
+    # intersect only the geometries of closed streets with the zone boundaries
+    needed_geometries = np.unique(geometry_rows)
+    zone_index = build_zone_index(nyc_geo)
+    geometry_positions, zone_positions = zones.query_zones(zone_index, geometries[needed_geometries], 'intersects')
+    geometry_zones = pd.DataFrame({'geometry_row': needed_geometries[geometry_positions],
+                                   'zone_row': zone_positions})
+    closure_geometries = pd.DataFrame({'closure_row': closure_rows, 'geometry_row': geometry_rows})
+    pairs = closure_geometries.merge(geometry_zones, on='geometry_row', how='inner')
+
+    # keep the zones in the borough of the closure
+    closure_boroughs = closures['BOROUGH_CODE'].map(BOROUGH_NAMES).to_numpy()
+    zone_boroughs = nyc_geo.borough.to_numpy()
+    pairs = pairs[closure_boroughs[pairs['closure_row']] == zone_boroughs[pairs['zone_row']]]
+    pairs = pairs.sort_values(['closure_row', 'zone_row'], kind='stable')
 
-    # make variables for taxi zone data
-    taxi_zones = nyc_geo.zone
-    zone_numbers = taxi_zones.index
-    zone_borough = nyc_geo.borough
-    taxi_zones_boundaries = nyc_geo.geometry
-    zone_data = zip(taxi_zones_boundaries, zone_numbers, zone_borough)
-    # make dict
-
-    previous_zone = None
-    # get unique values for st name and borough, group_by
-    #S_Grimsby or tuple
-    for i, closure in closures.iterrows():
-        #
-        street_name = closure['ONSTREETNAME']
-        ID = closure['SEGMENTID']
-        closure_borough = closure['BOROUGH_CODE']
-
-        # find the geometries of the street
-        matching_geometries = street_geometries[street_geometries['name'] == street_name]['geometry']
-        geo_found = False
-        for geometry in matching_geometries:
-            # if geo_found:
-            #     break
-            for boundary, zone, borough in zone_data:
-                # dict makes it fasted cause it looks for key
-                # if the coordinates is within the zone boundary
-                if boundary.contains(geometry):
-                    # check the borough name
-                    if not borough_match(closure_borough, borough):
-                        break
-                    if zone == previous_zone:  # Check if the zone is the same as the previous one
-                        break
-                    print(zone)
-                    closure_zones.loc[len(closure_zones)] = [ID, zone]
-                    previous_zone = zone
-                    # geo_found = True
-                    break
-    closure_zones.to_csv('closure_zones.csv', index=True)
+    # make connector table
+    closure_zones = pd.DataFrame({'SEGMENTID': closures['SEGMENTID'].to_numpy()[pairs['closure_row']],
+                                  'ZONE': taxi_zone_ids(nyc_geo)[pairs['zone_row']]})
+    closure_zones = closure_zones.drop_duplicates().reset_index(drop=True)
+    if save_path is not None:
+        save_file(closure_zones, save_path)
     return closure_zones
 
 
@@ -203,19 +535,21 @@ def crash_file_setup(crash_path, zone_geo):
     crashes_data = crashes_data.loc[(crashes_data['LATITUDE'] >= 40) & (crashes_data['LATITUDE'] <= 41) & (
             crashes_data['LONGITUDE'] >= -74.5) & (crashes_data['LONGITUDE'] <= -73)]
     # remove columns and empty rows
-    crashes_data = keep_relevant_columns(crashes_data, ['index', 'CRASH DATE_CRASH TIME', 'LOCATION'])
+    crashes_data = keep_relevant_columns(crashes_data, ['index', 'CRASH DATE_CRASH TIME', 'LOCATION', 'LATITUDE',
+                                                        'LONGITUDE'])
 
     crashes_data = crashes_data.dropna()
 
     return add_zone_to_crash(crashes_data, zone_geo)
 
 
-def closure_file_setup(closures_path, street_geo_path, zone_geo):
+def closure_file_setup(closures_path, street_geo_path, zone_geo, save_path: str = 'closures_cleaned.parquet'):
     """
     cleans the closure and street geometries data.
     :param closures_path: path to closures data
     :param street_geo_path: path to street geometries data
     :param zone_geo: geopandas dataframe of taxi zones
+    :param save_path: path of the csv or parquet file the cleaned closures are saved to
     :return: pandas dataframe of street closures and a pandas dataframe of the zones where the closure occurred
     """
     # open file
@@ -223,15 +557,16 @@ def closure_file_setup(closures_path, street_geo_path, zone_geo):
     street_geometries = open_file(street_geo_path)
 
     # Make street names the same in both dataframes
-    street_closures['ONSTREETNAME'] = street_closures['ONSTREETNAME'].str.lower()
-    street_closures['ONSTREETNAME'] = street_closures['ONSTREETNAME'].str.replace('\s+', ' ', regex=True)
-    street_geometries['name'] = street_geometries['name'].str.lower()
+    street_closures['ONSTREETNAME'] = street_names.normalize_names(street_closures['ONSTREETNAME'])
+    street_geometries['name'] = street_names.normalize_names(street_geometries['name'])
 
     # remove columns and empty rows
     street_closures = keep_relevant_columns(street_closures, ['SEGMENTID', 'ONSTREETNAME', 'WORK_START_DATE',
                                                               'WORK_END_DATE', 'BOROUGH_CODE'])
     street_closures = street_closures.dropna()
-    street_closures.to_csv('closures_cleaned.csv', index=True)
+    for column in ['WORK_START_DATE', 'WORK_END_DATE']:
+        street_closures[column] = pd.to_datetime(street_closures[column])
+    save_file(street_closures, save_path)
 
     closure_zones = add_zone_to_closures(street_closures, street_geometries, zone_geo)
     return street_closures, closure_zones
@@ -247,10 +582,7 @@ def taxi_file_setup(taxi_path):
     taxi_data = format_index(open_file(taxi_path), 'tripID')
 
     # remove taxi columns
-    taxi_data = keep_relevant_columns(taxi_data,
-                                      ['tripID', 'tpep_pickup_datetime', 'tpep_dropoff_datetime', 'trip_distance',
-                                       'PULocationID', 'DOLocationID', 'fare_amount', 'tip_amount',
-                                       'tolls_amount', 'total_amount'])
+    taxi_data = keep_relevant_columns(taxi_data, ['tripID'] + list(TAXI_DTYPES))
     return taxi_data
 
 
@@ -285,59 +617,311 @@ def events_during_trips(trips_df: pd.DataFrame, crashes_df: pd.DataFrame, closur
     >>> events_during_trips(trips, crash, close, close_zone)
     {1: {'num_of_crashes_passed': 1, 'num_of_road_closures_passed': 1}, 2: {'num_of_crashes_passed': 0, 'num_of_road_closures_passed': 1}}
     """
-    events_encountered = {}
-    for index, trip in trips_df.iterrows():
-        trip_id = trip['tripID']
-        events_passed = {'num_of_crashes_passed': 0, 'num_of_road_closures_passed': 0}
-
-        zone1 = trip["PULocationID"]
-        zone2 = trip["DOLocationID"]
-        pick_time = trip["tpep_pickup_datetime"]
-        drop_time = trip["tpep_dropoff_datetime"]
-        time_window = timedelta(minutes=30)
-
-        rows_with_zone_and_time_crashes = crashes_df.loc[((crashes_df["ZONE"] == zone1) | (crashes_df["ZONE"] == zone2)) &
-                                                 (crashes_df["CRASH DATE_CRASH TIME"] >= pick_time - time_window) &
-                                                 (crashes_df["CRASH DATE_CRASH TIME"] <= drop_time + time_window)]
-        events_passed["num_of_crashes_passed"] = len(rows_with_zone_and_time_crashes)
-
-        rows_with_time_closures = closures_df.loc[(closures_df["WORK_START_DATE"] <= pick_time) &
-                                                  (pick_time <= closures_df["WORK_END_DATE"])]
-        rows_with_zone_closures = closure_zones_df.loc[((closure_zones_df["ZONE"] == zone1) |
-                                                        (closure_zones_df["ZONE"] == zone2))]
-        # get unique segment IDs
-        rows_with_zone_closures = rows_with_zone_closures.drop_duplicates(subset=["SEGMENTID", "ZONE"])
-        # find rows with same segmentID and timeframe
-        rows_with_zone_and_time_collisions = pd.merge(rows_with_time_closures, rows_with_zone_closures,
-                                                      on="SEGMENTID", how="inner")
-        events_passed["num_of_road_closures_passed"] = len(rows_with_zone_and_time_collisions)
-
-        events_encountered[trip_id] = events_passed
-    return events_encountered
-
-
-def street_geometries():
-    """
-    creates a csv file containing the geometries of street in New York city.
-    """
-    g = ox.graph_from_place('NYC, NY, USA', network_type='drive')
-    nyc = ox.graph_to_gdfs(g, nodes=False, edges=True, node_geometry=False, fill_edge_geometry=False)
-    nyc = nyc[~nyc['name'].apply(lambda x: isinstance(x, list))]
-
-    def remove_suffix(name: str) -> Union[str, np.nan]:
-        """
-        Removes the suffix from street name.
-        :param name: The name of street.
-        :return: returns a numpy nan or a the name of the street with no suffix
-        """
-        # check if value is a string
-        if isinstance(name, str):
-            # apply regular expression to remove suffix
-            return re.sub(r'(?<=\d)(st|nd|rd|th)\b', '', name)
-        # if value is not a string or is NaN, return NaN
-        else:
-            return np.nan
-
-    # apply function to 'name' column and overwrite existing values
-    nyc['name'] = nyc['name'].apply(remove_suffix)
-    nyc[['name', 'geometry']].dropna().to_csv('street_geometries.csv')
\ No newline at end of file
+    event_counts = event_counts_during_trips(trips_df, crashes_df, closures_df, closure_zones_df)
+    return event_counts.to_dict(orient='index')
+
+
+def to_epoch_ns(values) -> np.ndarray:
+    """
+    Converts datetimes to integer nanoseconds since the epoch.
+    :param values: pandas Series or array-like of datetimes
+    :return: numpy int64 array
+    """
+    return pd.to_datetime(values).to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+
+def build_crash_index(crashes_df: pd.DataFrame) -> dict:
+    """
+    Sorts the crash times of every zone so crashes in a time window can be counted with a binary search.
+    :param crashes_df: pandas dataframe of car crashes data
+    :return: dictionary with zone number as key and a sorted numpy array of crash times in epoch nanoseconds as value
+    """
+    check_zone_numbers(crashes_df['ZONE'], 'the crashes')
+    crashes = crashes_df[['ZONE', 'CRASH DATE_CRASH TIME']].dropna()
+    crash_times = to_epoch_ns(crashes['CRASH DATE_CRASH TIME'])
+    return {zone: np.sort(crash_times[positions]) for zone, positions in crashes.groupby('ZONE').indices.items()}
+
+
+def build_closure_index(closures_df: pd.DataFrame, closure_zones_df: pd.DataFrame) -> dict:
+    """
+    Builds an interval index of the road closures of every zone. The closures active at a time t are the closures
+    that started at or before t minus the closures that ended before t.
+    :param closures_df: pandas dataframe of road closure data
+    :param closure_zones_df: pandas dataframe of road closure zones data
+    :return: dictionary with zone as key and a tuple of the sorted start times and sorted end times in epoch
+        nanoseconds as value
+    """
+    check_zone_numbers(closure_zones_df['ZONE'], 'the closure zones')
+    closure_zones = closure_zones_df[['SEGMENTID', 'ZONE']].drop_duplicates()
+    closures = closures_df[['SEGMENTID', 'WORK_START_DATE', 'WORK_END_DATE']].dropna()
+    zone_closures = pd.merge(closures, closure_zones, on='SEGMENTID', how='inner')
+    starts = to_epoch_ns(zone_closures['WORK_START_DATE'])
+    ends = to_epoch_ns(zone_closures['WORK_END_DATE'])
+
+    # closures ending before they start are never active
+    valid = starts <= ends
+    zones = zone_closures['ZONE'][valid]
+    starts, ends = starts[valid], ends[valid]
+    return {zone: (np.sort(starts[positions]), np.sort(ends[positions]))
+            for zone, positions in zones.groupby(zones).indices.items()}
+
+
+def count_zone_events(trip_zones: np.ndarray, window_start: np.ndarray, window_end: np.ndarray, crash_index: dict,
+                      closure_index: dict, closure_times: np.ndarray) -> tuple:
+    """
+    Counts the crashes and active road closures in the zone of every trip.
+    :param trip_zones: numpy array with one zone per trip
+    :param window_start: numpy array with the start of the crash time window of every trip in epoch nanoseconds
+    :param window_end: numpy array with the end of the crash time window of every trip in epoch nanoseconds
+    :param crash_index: dictionary made by build_crash_index
+    :param closure_index: dictionary made by build_closure_index
+    :param closure_times: numpy array with the time at which closures must be active for every trip in epoch
+        nanoseconds
+    :return: tuple of two numpy arrays with the number of crashes and the number of road closures of every trip
+    """
+    crash_counts = np.zeros(len(trip_zones), dtype=np.int64)
+    closure_counts = np.zeros(len(trip_zones), dtype=np.int64)
+    trip_zones = pd.Series(trip_zones)
+    for zone, positions in trip_zones.groupby(trip_zones).indices.items():
+        crash_times = crash_index.get(zone)
+        if crash_times is not None:
+            crash_counts[positions] = (np.searchsorted(crash_times, window_end[positions], side='right') -
+                                       np.searchsorted(crash_times, window_start[positions], side='left'))
+        if zone in closure_index:
+            starts, ends = closure_index[zone]
+            closure_counts[positions] = (np.searchsorted(starts, closure_times[positions], side='right') -
+                                         np.searchsorted(ends, closure_times[positions], side='left'))
+    return crash_counts, closure_counts
+
+
+def event_counts_during_trips(trips_df: pd.DataFrame, crashes_df: pd.DataFrame, closures_df: pd.DataFrame,
+                              closure_zones_df: pd.DataFrame, time_window: timedelta = timedelta(minutes=30),
+                              corridors: routing.ZoneRoutes = None) -> pd.DataFrame:
+    """
+    Finds the number of events in the pickup or drop off zone of every taxi trip. Crashes are counted from
+    time_window before the pickup until time_window after the drop off. Road closures are counted if they are active
+    at the pickup time.
+    In corridor mode the events of every zone the shortest route between the pickup and drop off zones crosses are
+    counted, looked up in the precomputed corridors instead of routing every trip.
+    :param trips_df: pandas dataframe of taxi trips data
+    :param crashes_df: pandas dataframe of car crashes data
+    :param closures_df: pandas dataframe of road closure data
+    :param closure_zones_df: pandas dataframe of road closure zones data
+    :param time_window: time before the pickup and after the drop off in which crashes are counted
+    :param corridors: ZoneRoutes from routing.load_zone_routes to count the events along the route. Only the pickup
+        and drop off zones are counted if None.
+    :return: pandas dataframe indexed by trip ID with the columns num_of_crashes_passed and
+        num_of_road_closures_passed
+    >>> trips = pd.DataFrame({
+    ...     'tripID': [1, 2],
+    ...     'PULocationID': [10, 20],
+    ...     'DOLocationID': [15, 20],
+    ...     'tpep_pickup_datetime': [datetime(2023, 5, 1, 10, 0), datetime(2023, 5, 1, 11, 0)],
+    ...     'tpep_dropoff_datetime': [datetime(2023, 5, 1, 10, 30), datetime(2023, 5, 1, 11, 30)]
+    ... })
+    >>> crash = pd.DataFrame({
+    ...     'ZONE': [10, 20, 30],
+    ...     'CRASH DATE_CRASH TIME': [datetime(2023, 5, 1, 9, 45), datetime(2023, 5, 1, 10, 15), datetime(2023, 5, 1, 11, 10)]
+    ... })
+    >>> close = pd.DataFrame({
+    ...     'SEGMENTID': [100, 200],
+    ...     'WORK_START_DATE': [datetime(2023, 5, 1, 9, 0), datetime(2023, 5, 1, 10, 30)],
+    ...     'WORK_END_DATE': [datetime(2023, 5, 1, 10, 0), datetime(2023, 5, 1, 11, 0)]
+    ... })
+    >>> close_zone = pd.DataFrame({
+    ...     'ZONE': [10, 20],
+    ...     'SEGMENTID': [100, 200]
+    ... })
+    >>> event_counts_during_trips(trips, crash, close, close_zone) #doctest:+NORMALIZE_WHITESPACE
+            num_of_crashes_passed  num_of_road_closures_passed
+    tripID
+    1                           1                            1
+    2                           0                            1
+    >>> indptr, corridor_zones = routing.ragged_corridors({(10, 15): [10, 20, 15]})
+    >>> corridors = routing.ZoneRoutes(None, None, None, indptr, corridor_zones)
+    >>> event_counts_during_trips(trips, crash, close, close_zone, corridors=corridors) #doctest:+NORMALIZE_WHITESPACE
+            num_of_crashes_passed  num_of_road_closures_passed
+    tripID
+    1                           2                            1
+    2                           0                            1
+
+    The crash and closure zone files made by add_zone_to_crash and add_zone_to_closures store the zone number
+    (objectid) of the trips.
+    >>> from shapely.geometry import box
+    >>> nyc = gpd.GeoDataFrame({'zone': ['a', 'b'], 'borough': ['Queens', 'Queens'], 'objectid': [10, 20]},
+    ...                        geometry=[box(0, 0, 1, 1), box(1, 0, 2, 1)])
+    >>> crash_zones = add_zone_to_crash(crash.assign(LOCATION=['(0.5, 0.5)', '(0.5, 1.5)', '(5.0, 5.0)']), nyc,
+    ...                                 save_path=None)
+    >>> streets = pd.DataFrame({'name': ['main street', 'broadway'],
+    ...                         'geometry': ['LINESTRING (0.2 0.5, 0.8 0.5)', 'LINESTRING (1.2 0.5, 1.8 0.5)']})
+    >>> closure_zones = add_zone_to_closures(close.assign(ONSTREETNAME=['Main St', 'Broadway'], BOROUGH_CODE='Q'),
+    ...                                      streets, nyc, save_path=None)
+    Closures matched to a street geometry: 100.0%
+    >>> event_counts_during_trips(trips, crash_zones, close, closure_zones) #doctest:+NORMALIZE_WHITESPACE
+            num_of_crashes_passed  num_of_road_closures_passed
+    tripID
+    1                           1                            1
+    2                           0                            1
+    """
+    pick_times = to_epoch_ns(trips_df['tpep_pickup_datetime'])
+    drop_times = to_epoch_ns(trips_df['tpep_dropoff_datetime'])
+    window = pd.Timedelta(time_window).value
+    window_start = pick_times - window
+    window_end = drop_times + window
+
+    crash_index = build_crash_index(crashes_df)
+    closure_index = build_closure_index(closures_df, closure_zones_df)
+
+    pickup_zones = trips_df['PULocationID'].to_numpy()
+    dropoff_zones = trips_df['DOLocationID'].to_numpy()
+    index = pd.Index(trips_df['tripID'].to_numpy(), name='tripID')
+    if corridors is not None:
+        trip_positions, zones = routing.corridor_zones(corridors, pickup_zones, dropoff_zones)
+        crash_counts, closure_counts = count_zone_events(zones, window_start[trip_positions],
+                                                         window_end[trip_positions], crash_index, closure_index,
+                                                         pick_times[trip_positions])
+        return pd.DataFrame({'num_of_crashes_passed': np.bincount(trip_positions, crash_counts, len(trips_df)),
+                             'num_of_road_closures_passed': np.bincount(trip_positions, closure_counts,
+                                                                        len(trips_df))},
+                            index=index).astype(np.int64)
+
+    pickup_crashes, pickup_closures = count_zone_events(pickup_zones, window_start, window_end, crash_index,
+                                                        closure_index, pick_times)
+    dropoff_crashes, dropoff_closures = count_zone_events(dropoff_zones, window_start, window_end, crash_index,
+                                                          closure_index, pick_times)
+
+    # events in the drop off zone were already counted if the trip stayed in its pickup zone
+    other_zone = pickup_zones != dropoff_zones
+    event_counts = pd.DataFrame({'num_of_crashes_passed': pickup_crashes + dropoff_crashes * other_zone,
+                                 'num_of_road_closures_passed': pickup_closures + dropoff_closures * other_zone},
+                                index=index)
+    return event_counts
+
+
+def partition_trips(trips_df: pd.DataFrame, partition_by: str = 'month') -> list:
+    """
+    Splits the taxi trips into partitions that can be matched with events independently.
+    :param trips_df: pandas dataframe of taxi trips data
+    :param partition_by: 'month' to partition by the month of the pickup or 'zone' to partition by the pickup zone
+    :return: list of numpy arrays with the row positions of the trips of every partition, ordered by partition key
+    >>> trips = pd.DataFrame({'PULocationID': [3, 1, 3],
+    ...                       'tpep_pickup_datetime': [datetime(2018, 2, 1), datetime(2018, 1, 5), datetime(2018, 1, 9)]})
+    >>> partition_trips(trips, 'month')
+    [array([1, 2]), array([0])]
+    >>> partition_trips(trips, 'zone')
+    [array([1]), array([0, 2])]
+    """
+    if partition_by == 'month':
+        keys = pd.to_datetime(trips_df['tpep_pickup_datetime']).dt.to_period('M')
+    elif partition_by == 'zone':
+        keys = trips_df['PULocationID']
+    else:
+        raise ValueError(f"Invalid partition_by '{partition_by}'. Must be 'month' or 'zone'.")
+    keys = pd.Series(keys.to_numpy())
+    return list(keys.groupby(keys, sort=True).indices.values())
+
+
+def events_for_partition(trips_df: pd.DataFrame, crashes_df: pd.DataFrame, closures_df: pd.DataFrame,
+                         closure_zones_df: pd.DataFrame, time_window: timedelta,
+                         corridors: routing.ZoneRoutes = None) -> tuple:
+    """
+    Slices the crashes and road closures that can matter for a partition of trips. Only the events inside the time
+    range and zones of the trips are kept, so a worker process receives a small part of the event data.
+    :param trips_df: pandas dataframe of the taxi trips of one partition
+    :param crashes_df: pandas dataframe of car crashes data
+    :param closures_df: pandas dataframe of road closure data
+    :param closure_zones_df: pandas dataframe of road closure zones data
+    :param time_window: time before the pickup and after the drop off in which crashes are counted
+    :param corridors: ZoneRoutes to keep the events of every zone along the routes of the trips
+    :return: tuple of the crashes, closures and closure zones of the partition
+    """
+    check_zone_numbers(crashes_df['ZONE'], 'the crashes')
+    check_zone_numbers(closure_zones_df['ZONE'], 'the closure zones')
+    trip_zones = pd.unique(np.concatenate([trips_df['PULocationID'].to_numpy(), trips_df['DOLocationID'].to_numpy()]))
+    if corridors is not None:
+        pickup_zones, dropoff_zones = zip(*pd.MultiIndex.from_arrays([trips_df['PULocationID'],
+                                                                      trips_df['DOLocationID']]).unique())
+        trip_zones = pd.unique(routing.corridor_zones(corridors, np.array(pickup_zones), np.array(dropoff_zones))[1])
+    first_pickup = trips_df['tpep_pickup_datetime'].min()
+    last_pickup = trips_df['tpep_pickup_datetime'].max()
+    last_dropoff = trips_df['tpep_dropoff_datetime'].max()
+
+    crashes = crashes_df.loc[crashes_df['ZONE'].isin(trip_zones) &
+                             (crashes_df['CRASH DATE_CRASH TIME'] >= first_pickup - time_window) &
+                             (crashes_df['CRASH DATE_CRASH TIME'] <= last_dropoff + time_window),
+                             ['ZONE', 'CRASH DATE_CRASH TIME']]
+    closure_zones = closure_zones_df.loc[closure_zones_df['ZONE'].isin(trip_zones), ['SEGMENTID', 'ZONE']]
+    closures = closures_df.loc[closures_df['SEGMENTID'].isin(closure_zones['SEGMENTID']) &
+                               (closures_df['WORK_START_DATE'] <= last_pickup) &
+                               (closures_df['WORK_END_DATE'] >= first_pickup),
+                               ['SEGMENTID', 'WORK_START_DATE', 'WORK_END_DATE']]
+    return crashes, closures, closure_zones
+
+
+def count_partition_events(partition: tuple) -> pd.DataFrame:
+    """
+    Runs event_counts_during_trips on one partition. Used by the worker processes of
+    event_counts_during_trips_parallel.
+    :param partition: tuple of the trips, crashes, closures, closure zones, time window and corridors of the partition
+    :return: the result of event_counts_during_trips for the partition
+    """
+    trips, crashes, closures, closure_zones, time_window, corridors = partition
+    return event_counts_during_trips(trips, crashes, closures, closure_zones, time_window, corridors)
+
+
+def event_counts_during_trips_parallel(trips_df: pd.DataFrame, crashes_df: pd.DataFrame, closures_df: pd.DataFrame,
+                                       closure_zones_df: pd.DataFrame, workers: int = None,
+                                       partition_by: str = 'month',
+                                       time_window: timedelta = timedelta(minutes=30),
+                                       corridors: routing.ZoneRoutes = None) -> pd.DataFrame:
+    """
+    Runs event_counts_during_trips on partitions of the trips in a pool of worker processes. The counts are the same
+    as event_counts_during_trips and are returned in the order of trips_df.
+    :param trips_df: pandas dataframe of taxi trips data
+    :param crashes_df: pandas dataframe of car crashes data
+    :param closures_df: pandas dataframe of road closure data
+    :param closure_zones_df: pandas dataframe of road closure zones data
+    :param workers: number of worker processes. Uses all cores if None.
+    :param partition_by: 'month' to partition by the month of the pickup or 'zone' to partition by the pickup zone
+    :param time_window: time before the pickup and after the drop off in which crashes are counted
+    :param corridors: ZoneRoutes to count the events along the route of every trip
+    :return: pandas dataframe indexed by trip ID with the columns num_of_crashes_passed and
+        num_of_road_closures_passed
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    if workers <= 1:
+        return event_counts_during_trips(trips_df, crashes_df, closures_df, closure_zones_df, time_window, corridors)
+
+    trip_columns = ['tripID', 'PULocationID', 'DOLocationID', 'tpep_pickup_datetime', 'tpep_dropoff_datetime']
+    partitions = partition_trips(trips_df, partition_by)
+
+    def partition_inputs():
+        for positions in partitions:
+            trips = trips_df[trip_columns].iloc[positions]
+            yield (trips, *events_for_partition(trips, crashes_df, closures_df, closure_zones_df, time_window,
+                                                corridors), time_window, corridors)
+
+    # fill the counts back in by row position so the output order does not depend on the workers
+    crash_counts = np.zeros(len(trips_df), dtype=np.int64)
+    closure_counts = np.zeros(len(trips_df), dtype=np.int64)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for positions, counts in zip(partitions, executor.map(count_partition_events, partition_inputs())):
+            crash_counts[positions] = counts['num_of_crashes_passed'].to_numpy()
+            closure_counts[positions] = counts['num_of_road_closures_passed'].to_numpy()
+
+    return pd.DataFrame({'num_of_crashes_passed': crash_counts, 'num_of_road_closures_passed': closure_counts},
+                        index=pd.Index(trips_df['tripID'].to_numpy(), name='tripID'))
+
+
+def street_geometries(save_path: str = 'street_geometries.parquet'):
+    """
+    creates a file containing the geometries of street in New York city.
+    The streets come from the road network store, which is built from the osmnx cache.
+    :param save_path: path of the csv or parquet file the street geometries are saved to
+    """
+    nyc = rn.street_lines(rn.load_network())
+
+    # store the canonical street names, so they match the closures without a per-row clean up
+    nyc['name'] = street_names.normalize_names(nyc['name'])
+    save_file(nyc[['name', 'geometry']].dropna(), save_path)
\ No newline at end of file
@@ -1,54 +1,114 @@
-import osmnx as ox
+import os
 import geopandas as gpd
-import matplotlib.pyplot as plt
-import networkx as nx
+import pandas as pd
+import numpy as np
+import shapely
+import road_network as rn
 
 
+def pyplot(headless: bool = False):
+    """
+    Imports matplotlib.pyplot when a figure is drawn, so modules that only compute do not pay for it.
+    :param headless: switch to the Agg backend, which draws figures to files without a display
+    :return: the matplotlib.pyplot module
+    """
+    import matplotlib
+    if headless:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def show_figure(fig, figure_path: str = None):
+    """
+    Shows a figure, or saves it to a file and closes it.
+    :param fig: matplotlib figure
+    :param figure_path: path of the image file. The figure is shown if None.
+    """
+    plt = pyplot()
+    if figure_path is None:
+        plt.show()
+        return
+    os.makedirs(os.path.dirname(figure_path) or '.', exist_ok=True)
+    fig.savefig(figure_path, dpi=150, bbox_inches='tight')
+    plt.close(fig)
 
-def plot_routes_for_random_addresses_in_2_zones(gdf: gpd.GeoDataFrame, zone1: int, zone2: int):
+
+def sample_points_in_zone(network: rn.RoadNetwork, zone: shapely.Geometry, n: int = 1,
+                          rng: np.random.Generator = None) -> gpd.GeoSeries:
+    """
+    Picks random points on the streets of a zone
+    :param network: RoadNetwork
+    :param zone: zone polygon
+    :param n: number of points
+    :param rng: numpy random generator
+    :return: GeoSeries of points. It is empty if no street of the network lies inside the zone.
+    >>> network = rn.RoadNetwork(np.array([1, 2]), np.array([0.0, 1.0]), np.array([0.0, 0.0]), np.array([0, 1, 1]),
+    ...                          np.array([1]), *[np.array([])] * 7)
+    >>> len(sample_points_in_zone(network, shapely.box(-1, -1, 2, 1), 3))
+    3
+    >>> len(sample_points_in_zone(network, shapely.box(5, 5, 6, 6), 3))
+    0
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    in_zone = shapely.contains_xy(zone, network.lon, network.lat)
+    sources = np.repeat(np.arange(len(network.node_ids)), np.diff(network.indptr))
+    zone_edges = np.flatnonzero(in_zone[sources] & in_zone[network.indices])
+    if len(zone_edges) == 0:
+        return gpd.GeoSeries([], crs=4326)
+    edges = rng.choice(zone_edges, n)
+    along = rng.random(n)
+    lon = network.lon[sources[edges]] + along * (network.lon[network.indices[edges]] - network.lon[sources[edges]])
+    lat = network.lat[sources[edges]] + along * (network.lat[network.indices[edges]] - network.lat[sources[edges]])
+    return gpd.GeoSeries(gpd.points_from_xy(lon, lat), crs=4326)
+
+
+def plot_routes_for_random_addresses_in_2_zones(gdf: gpd.GeoDataFrame, zone1: int, zone2: int,
+                                                network: rn.RoadNetwork = None, figure_path: str = None):
     """
     Plots shortest route between two random points on map given their zones
     :param gdf: nyc geopandas GeoDataFrame
     :param zone1: integer value of Pickup (PU) zone
     :param zone2: integer value of Drop Off (DO) zone
+    :param network: NYC drive network. Loaded from the road network store if None.
+    :param figure_path: path of the image file the map is saved to. The map is shown if None.
     :return: map of random addresses in PU and DO zones, their nearest nodes, and shortest route between them
     """
+    import osmnx as ox
+    plt = pyplot()
+
+    if network is None:
+        network = rn.load_network()
 
-    gdf.geometry.to_crs(4326)
-    zone1_bbox = gdf.loc[gdf['objectid'] == str(zone1)]['geometry'].item()
-    g_z1 = ox.graph_from_polygon(zone1_bbox, network_type='drive', retain_all=True)
-    g_z1 = ox.utils_graph.get_undirected(g_z1)
-    random_address_z1 = ox.utils_geo.sample_points(g_z1, 1).to_crs(4326)
-
-    zone2_bbox = gdf.loc[gdf['objectid'] == str(zone2)]['geometry'].item()
-    g_z2 = ox.graph_from_polygon(zone2_bbox, network_type='drive', retain_all=True)
-    g_z2 = ox.utils_graph.get_undirected(g_z2)
-    random_address_z2 = ox.utils_geo.sample_points(g_z2, 1).to_crs(4326)
-
-    nyc_full = ox.graph_from_place('New York City, NY, USA', network_type = 'drive')
-
-    address_dict = {}
-    for address in [random_address_z1, random_address_z2]:
-        address_list = address.to_list()
-        lat = float((str(address_list).split(' '))[1].strip('('))
-        lon = float((str(address_list).split(' '))[2].strip(')>]'))
-        node = ox.nearest_nodes(nyc_full, lat, lon)
-        address_dict[tuple(address.to_list())] = (lat, lon, node)
-    route = ox.shortest_path(nyc_full, address_dict[tuple(random_address_z1.to_list())][2],
-                             address_dict[tuple(random_address_z2.to_list())][2],
-                             weight='length')
-
-    zones = nx.compose(g_z1, g_z2).to_undirected()
-    c = ox.graph_to_gdfs(zones, edges=False).unary_union.centroid
+    zone1_bbox = gdf.loc[gdf['objectid'].astype(int) == zone1]['geometry'].item()
+    random_address_z1 = sample_points_in_zone(network, zone1_bbox)
+    zone2_bbox = gdf.loc[gdf['objectid'].astype(int) == zone2]['geometry'].item()
+    random_address_z2 = sample_points_in_zone(network, zone2_bbox)
+    for zone, points in ((zone1, random_address_z1), (zone2, random_address_z2)):
+        if points.empty:
+            raise ValueError(f'Zone {zone} has no streets in the drive network')
+
+    addresses = pd.concat([random_address_z1, random_address_z2])
+    source, target = rn.nearest_nodes(network, addresses.x, addresses.y)
+    route = rn.shortest_path(network, source, target)
+
+    c = shapely.union(zone1_bbox, zone2_bbox).centroid
     bbox = ox.utils_geo.bbox_from_point(point=(c.y, c.x), dist=5000)
 
-    fig, ax = ox.plot_graph_route(nyc_full, route, 'y', show=False, close=False, node_size=1, node_color='w', edge_color='b',
-                        edge_linewidth=0.05, bbox=bbox)
+    # only the streets inside the map are drawn
+    west, south, east, north = bbox
+    in_map = np.flatnonzero((network.lon >= west) & (network.lon <= east) &
+                            (network.lat >= south) & (network.lat <= north))
+    nyc_map = rn.to_networkx(network, np.union1d(in_map, route))
+
+    fig, ax = ox.plot_graph_route(nyc_map, [int(network.node_ids[node]) for node in route], route_color='y',
+                                  show=False, close=False, node_size=1, node_color='w', edge_color='b',
+                                  edge_linewidth=0.05, bbox=bbox)
     random_address_z1.plot(color='r', ax=ax)
     random_address_z2.plot(color='b', ax=ax)
     plt.title(f'Shortest Route Between Random Points in Zone {zone1} and Zone {zone2}')
     plt.autoscale()
-    plt.show()
+    show_figure(fig, figure_path)
     return
 
 # nyc_gdf = gpd.read_file('NYC_Taxi_Zones.geojson')
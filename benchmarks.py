@@ -0,0 +1,453 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import time
+import tracemalloc
+import warnings
+from datetime import datetime, timedelta
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import File_creation as fc
+import clusters as c
+import main
+import profiling
+import zones
+
+# trip counts of the --scales names
+SCALES = {'10k': 10000, '100k': 100000, '1m': 1000000, '10m': 10000000, '50m': 50000000}
+# about the number of crashes and street closures in the 2018 files
+YEAR_CRASHES = 230000
+YEAR_CLOSURES = 26000
+STREET_SEGMENTS = 100000
+BOROUGH_CODES = {name: code for code, name in fc.BOROUGH_NAMES.items()}
+
+
+def random_points(nyc_geo: gpd.GeoDataFrame, n: int, seed: int = 0) -> np.ndarray:
+    """
+    Draws uniformly distributed points over the bounding box of the taxi zones.
+    :param nyc_geo: geopandas dataframe with taxi zone data
+    :param n: number of points
+    :param seed: seed for the random number generator
+    :return: numpy array of shapely Points
+    """
+    rng = np.random.default_rng(seed)
+    min_x, min_y, max_x, max_y = nyc_geo.total_bounds
+    return shapely.points(rng.uniform(min_x, max_x, n), rng.uniform(min_y, max_y, n))
+
+
+def legacy_zone_loop(points: np.ndarray, nyc_geo: gpd.GeoDataFrame) -> np.ndarray:
+    """
+    The zone lookup loop add_zone_to_crash used before the spatial index. Kept as the benchmark baseline.
+    :param points: numpy array of shapely Points
+    :param nyc_geo: geopandas dataframe with taxi zone data
+    :return: numpy array with the row position of the zone containing each point. -1 if no zone contains it.
+    """
+    positions = np.full(len(points), -1, dtype=np.int64)
+    for i, point in enumerate(points):
+        for position, boundary in enumerate(nyc_geo.geometry):
+            if boundary.contains(point):
+                positions[i] = position
+                break
+    return positions
+
+
+def benchmark_zone_assignment(nyc_geo: gpd.GeoDataFrame, n_points: int = 100000, n_legacy_points: int = 2000,
+                              seed: int = 0) -> dict:
+    """
+    Compares the points per second of assign_zones against the legacy zone loop.
+    The legacy loop only runs on the first n_legacy_points points because it is slow.
+    :param nyc_geo: geopandas dataframe with taxi zone data
+    :param n_points: number of points given to assign_zones
+    :param n_legacy_points: number of points given to the legacy loop
+    :param seed: seed for the random points
+    :return: dictionary with the points per second of both engines and the speedup
+    """
+    points = random_points(nyc_geo, n_points, seed)
+
+    start = time.perf_counter()
+    bulk_positions = fc.assign_zones(points, nyc_geo)
+    bulk_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    legacy_positions = legacy_zone_loop(points[:n_legacy_points], nyc_geo)
+    legacy_seconds = time.perf_counter() - start
+
+    if not np.array_equal(bulk_positions[:n_legacy_points], legacy_positions):
+        raise AssertionError('assign_zones and the legacy zone loop disagree')
+
+    bulk_rate = n_points / bulk_seconds
+    legacy_rate = n_legacy_points / legacy_seconds
+    return {'stage': 'assign_zones', 'bulk_points_per_s': bulk_rate, 'legacy_points_per_s': legacy_rate,
+            'speedup': bulk_rate / legacy_rate}
+
+
+def random_events(n_trips: int, n_crashes: int, n_closures: int, seed: int = 0) -> tuple:
+    """
+    Makes random taxi trips, crashes, road closures and closure zones over 2018 and the 263 taxi zones.
+    :param n_trips: number of taxi trips
+    :param n_crashes: number of crashes
+    :param n_closures: number of road closures
+    :param seed: seed for the random number generator
+    :return: tuple of the trips, crashes, closures and closure zones pandas dataframes
+    """
+    rng = np.random.default_rng(seed)
+    year_start = pd.Timestamp('2018-01-01')
+    minutes_in_year = 365 * 24 * 60
+
+    pickup = year_start + pd.to_timedelta(rng.integers(0, minutes_in_year, n_trips), unit='min')
+    trips = pd.DataFrame({'tripID': np.arange(n_trips),
+                          'PULocationID': rng.integers(1, 264, n_trips),
+                          'DOLocationID': rng.integers(1, 264, n_trips),
+                          'tpep_pickup_datetime': pickup,
+                          'tpep_dropoff_datetime': pickup + pd.to_timedelta(rng.integers(1, 90, n_trips), unit='min')})
+    crashes = pd.DataFrame({'ZONE': rng.integers(1, 264, n_crashes),
+                            'CRASH DATE_CRASH TIME': year_start + pd.to_timedelta(
+                                rng.integers(0, minutes_in_year, n_crashes), unit='min')})
+    work_start = year_start + pd.to_timedelta(rng.integers(0, minutes_in_year, n_closures), unit='min')
+    closures = pd.DataFrame({'SEGMENTID': np.arange(n_closures),
+                             'WORK_START_DATE': work_start,
+                             'WORK_END_DATE': work_start + pd.to_timedelta(rng.integers(60, 60 * 24 * 30, n_closures),
+                                                                           unit='min')})
+    closure_zones = pd.DataFrame({'SEGMENTID': rng.integers(0, n_closures, 2 * n_closures),
+                                  'ZONE': rng.integers(1, 264, 2 * n_closures)})
+    return trips, crashes, closures, closure_zones
+
+
+def legacy_events_loop(trips_df: pd.DataFrame, crashes_df: pd.DataFrame, closures_df: pd.DataFrame,
+                       closure_zones_df: pd.DataFrame) -> dict:
+    """
+    The trip loop events_during_trips used before the interval join. Kept as the benchmark baseline.
+    :return: dictionary with trip ID as key and a dictionary with the number of crashes and road closures as value
+    """
+    events_encountered = {}
+    time_window = timedelta(minutes=30)
+    for index, trip in trips_df.iterrows():
+        zone1 = trip["PULocationID"]
+        zone2 = trip["DOLocationID"]
+        pick_time = trip["tpep_pickup_datetime"]
+        drop_time = trip["tpep_dropoff_datetime"]
+
+        rows_with_zone_and_time_crashes = crashes_df.loc[((crashes_df["ZONE"] == zone1) | (crashes_df["ZONE"] == zone2)) &
+                                                         (crashes_df["CRASH DATE_CRASH TIME"] >= pick_time - time_window) &
+                                                         (crashes_df["CRASH DATE_CRASH TIME"] <= drop_time + time_window)]
+        rows_with_time_closures = closures_df.loc[(closures_df["WORK_START_DATE"] <= pick_time) &
+                                                  (pick_time <= closures_df["WORK_END_DATE"])]
+        rows_with_zone_closures = closure_zones_df.loc[((closure_zones_df["ZONE"] == zone1) |
+                                                        (closure_zones_df["ZONE"] == zone2))]
+        rows_with_zone_closures = rows_with_zone_closures.drop_duplicates(subset=["SEGMENTID", "ZONE"])
+        rows_with_zone_and_time_collisions = pd.merge(rows_with_time_closures, rows_with_zone_closures,
+                                                      on="SEGMENTID", how="inner")
+        events_encountered[trip['tripID']] = {'num_of_crashes_passed': len(rows_with_zone_and_time_crashes),
+                                              'num_of_road_closures_passed': len(rows_with_zone_and_time_collisions)}
+    return events_encountered
+
+
+def benchmark_event_matching(n_trips: int = 1000000, n_crashes: int = 230000, n_closures: int = 26000,
+                             n_legacy_trips: int = 500, seed: int = 0) -> dict:
+    """
+    Compares the trips per second of event_counts_during_trips against the legacy trip loop.
+    The legacy loop only runs on the first n_legacy_trips trips because it is slow.
+    :param n_trips: number of trips given to event_counts_during_trips
+    :param n_crashes: number of crashes
+    :param n_closures: number of road closures
+    :param n_legacy_trips: number of trips given to the legacy loop
+    :param seed: seed for the random events
+    :return: dictionary with the trips per second of both engines and the speedup
+    """
+    trips, crashes, closures, closure_zones = random_events(n_trips, n_crashes, n_closures, seed)
+
+    start = time.perf_counter()
+    event_counts = fc.event_counts_during_trips(trips, crashes, closures, closure_zones)
+    interval_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    legacy_counts = legacy_events_loop(trips.head(n_legacy_trips), crashes, closures, closure_zones)
+    legacy_seconds = time.perf_counter() - start
+
+    if event_counts.head(n_legacy_trips).to_dict(orient='index') != legacy_counts:
+        raise AssertionError('event_counts_during_trips and the legacy trip loop disagree')
+
+    interval_rate = n_trips / interval_seconds
+    legacy_rate = n_legacy_trips / legacy_seconds
+    return {'stage': 'event_counts_during_trips', 'interval_trips_per_s': interval_rate,
+            'legacy_trips_per_s': legacy_rate, 'speedup': interval_rate / legacy_rate}
+
+
+def parse_scale(scale: str) -> int:
+    """
+    Reads a number of trips given as a --scales name or an integer.
+    :param scale: name in SCALES or integer string
+    :return: number of trips
+    >>> parse_scale('1m'), parse_scale('2500')
+    (1000000, 2500)
+    """
+    return SCALES[scale.lower()] if scale.lower() in SCALES else int(scale)
+
+
+def points_in_zones(nyc_geo: gpd.GeoDataFrame, zone_positions: np.ndarray, rng: np.random.Generator) -> tuple:
+    """
+    Draws one uniformly distributed point inside each of the given zones. Points are drawn in the bounding box of their
+    zone until they fall inside it.
+    :param nyc_geo: geopandas dataframe with taxi zone data
+    :param zone_positions: numpy array with the row position in nyc_geo of the zone of every point
+    :param rng: numpy random generator
+    :return: tuple of numpy arrays with the longitude and latitude of the points
+    """
+    geometries = np.asarray(nyc_geo.geometry.values)
+    shapely.prepare(geometries)
+    bounds = shapely.bounds(geometries)[zone_positions]
+    lon = np.empty(len(zone_positions))
+    lat = np.empty(len(zone_positions))
+    todo = np.arange(len(zone_positions))
+    while len(todo):
+        x = rng.uniform(bounds[todo, 0], bounds[todo, 2])
+        y = rng.uniform(bounds[todo, 1], bounds[todo, 3])
+        inside = shapely.contains_xy(geometries[zone_positions[todo]], x, y)
+        lon[todo[inside]] = x[inside]
+        lat[todo[inside]] = y[inside]
+        todo = todo[~inside]
+    return lon, lat
+
+
+def synthetic_trips(nyc_geo: gpd.GeoDataFrame, n_trips: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Makes prepared taxi trips over 2018. Half of the trips end in a neighbor of their pickup zone and the others in a
+    random zone.
+    :param nyc_geo: geopandas dataframe with taxi zone data
+    :param n_trips: number of trips
+    :param rng: numpy random generator
+    :return: pandas dataframe with the columns of main.prepare_trips
+    """
+    zone_ids = nyc_geo['objectid'].astype(int).to_numpy()
+    adjacency = zones.build_adjacency(nyc_geo)
+    pickup_zones = zone_ids[rng.integers(0, len(zone_ids), n_trips)]
+    degrees = np.diff(adjacency.indptr)[pickup_zones]
+    neighbor = adjacency.indices[adjacency.indptr[pickup_zones] + (rng.random(n_trips) * degrees).astype(np.int64)
+                                 .clip(max=np.maximum(degrees - 1, 0))]
+    dropoff_zones = np.where(rng.random(n_trips) < 0.5, np.where(degrees > 0, neighbor, pickup_zones),
+                             zone_ids[rng.integers(0, len(zone_ids), n_trips)])
+
+    seconds_in_year = 365 * 24 * 60 * 60
+    pickup = np.datetime64('2018-01-01', 's') + rng.integers(0, seconds_in_year, n_trips).astype('timedelta64[s]')
+    trip_seconds = rng.gamma(2, 480, n_trips).clip(60, 4 * 60 * 60).astype(np.int64)
+    trip_time_h = trip_seconds / 3600
+    avg_speed = rng.uniform(3, 30, n_trips)
+    trip_distance = avg_speed * trip_time_h
+    return pd.DataFrame({'tripID': np.arange(n_trips, dtype=np.int32),
+                         'PULocationID': pickup_zones.astype(np.int16),
+                         'DOLocationID': dropoff_zones.astype(np.int16),
+                         'tpep_pickup_datetime': pickup,
+                         'tpep_dropoff_datetime': pickup + trip_seconds.astype('timedelta64[s]'),
+                         'trip_distance': trip_distance.astype(np.float32),
+                         'fare_amount': (2.5 + 2.5 * trip_distance + 0.5 * trip_seconds / 60).astype(np.float32),
+                         'trip_time_h': trip_time_h.astype(np.float32),
+                         'avg speed': avg_speed.astype(np.float32)})
+
+
+def synthetic_crashes(nyc_geo: gpd.GeoDataFrame, n_crashes: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Makes crashes at random places inside the taxi zones over 2018, in the format of the crash file.
+    :param nyc_geo: geopandas dataframe with taxi zone data
+    :param n_crashes: number of crashes
+    :param rng: numpy random generator
+    :return: pandas dataframe with the index, CRASH DATE_CRASH TIME and LOCATION columns of crash_file_setup and the
+        objectid of the zone of every crash as zone_id
+    """
+    zone_positions = rng.integers(0, len(nyc_geo), n_crashes)
+    lon, lat = points_in_zones(nyc_geo, zone_positions, rng)
+    crash_times = pd.Timestamp('2018-01-01') + pd.to_timedelta(rng.integers(0, 365 * 24 * 60, n_crashes), unit='min')
+    return pd.DataFrame({'index': np.arange(n_crashes),
+                         'CRASH DATE_CRASH TIME': crash_times,
+                         'LOCATION': [f'({y:.6f}, {x:.6f})' for x, y in zip(lon, lat)],
+                         'zone_id': nyc_geo['objectid'].astype(int).to_numpy()[zone_positions]})
+
+
+def synthetic_closures(nyc_geo: gpd.GeoDataFrame, n_closures: int, n_streets: int, rng: np.random.Generator) -> tuple:
+    """
+    Makes street segments inside the taxi zones and road closures on their streets over 2018. Every street name has
+    about four segments.
+    :param nyc_geo: geopandas dataframe with taxi zone data
+    :param n_closures: number of road closures
+    :param n_streets: number of street segments
+    :param rng: numpy random generator
+    :return: tuple of the closures pandas dataframe in the format of closures_cleaned and the street geometries pandas
+        dataframe with name and LineString geometry columns
+    """
+    zone_positions = rng.integers(0, len(nyc_geo), n_streets)
+    lon, lat = points_in_zones(nyc_geo, zone_positions, rng)
+    ends = rng.uniform(-0.005, 0.005, (2, n_streets))
+    names = np.char.add('street ', (np.arange(n_streets) % max(n_streets // 4, 1)).astype(str))
+    streets = pd.DataFrame({'name': names,
+                            'geometry': shapely.linestrings(np.stack([np.stack([lon, lat], axis=1),
+                                                                      np.stack([lon + ends[0], lat + ends[1]], axis=1)],
+                                                                     axis=1))})
+
+    closed_streets = rng.integers(0, n_streets, n_closures)
+    work_start = pd.Timestamp('2018-01-01') + pd.to_timedelta(rng.integers(0, 365 * 24 * 60, n_closures), unit='min')
+    closures = pd.DataFrame({'SEGMENTID': np.arange(n_closures),
+                             'ONSTREETNAME': names[closed_streets],
+                             'WORK_START_DATE': work_start,
+                             'WORK_END_DATE': work_start + pd.to_timedelta(rng.integers(60, 60 * 24 * 30, n_closures),
+                                                                           unit='min'),
+                             'BOROUGH_CODE': nyc_geo['borough'].map(BOROUGH_CODES).to_numpy()[
+                                 zone_positions[closed_streets]]})
+    return closures, streets
+
+
+def synthetic_data(nyc_geo: gpd.GeoDataFrame, n_trips: int, n_crashes: int = YEAR_CRASHES,
+                   n_closures: int = YEAR_CLOSURES, n_streets: int = STREET_SEGMENTS, seed: int = 0) -> dict:
+    """
+    Makes a seeded synthetic data set over the taxi zones for the pipeline benchmarks. The same seed and sizes always
+    give the same data.
+    :param nyc_geo: geopandas dataframe with taxi zone data
+    :param n_trips: number of taxi trips
+    :param n_crashes: number of crashes
+    :param n_closures: number of road closures
+    :param n_streets: number of street segments
+    :param seed: seed for the random number generators
+    :return: dictionary with the trips, crashes, closures and streets pandas dataframes
+    """
+    trips_seed, crashes_seed, closures_seed = np.random.SeedSequence(seed).spawn(3)
+    trips = synthetic_trips(nyc_geo, n_trips, np.random.default_rng(trips_seed))
+    crashes = synthetic_crashes(nyc_geo, n_crashes, np.random.default_rng(crashes_seed))
+    closures, streets = synthetic_closures(nyc_geo, n_closures, n_streets, np.random.default_rng(closures_seed))
+    return {'trips': trips, 'crashes': crashes, 'closures': closures, 'streets': streets}
+
+
+def measure_stage(stage: str, function, rows_in: int, *args, memory: bool = True, **kwargs) -> tuple:
+    """
+    Runs one pipeline stage and measures its time and peak memory. Printed output and figures of the stage are
+    discarded.
+    :param stage: name of the stage
+    :param function: function running the stage
+    :param rows_in: number of input rows of the stage
+    :param args: arguments of function
+    :param memory: trace the peak memory allocated by the stage with tracemalloc. Tracing slows the stage down.
+    :param kwargs: keyword arguments of function
+    :return: tuple of the result of function and a dictionary with the stage measurements
+    """
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak_mb = None
+    if memory:
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    plt.close('all')
+    return result, {'stage': stage, 'rows_in': rows_in, 'rows_out': len(result), 'seconds': seconds,
+                    'rows_per_s': rows_in / seconds if seconds else None, 'peak_mb': peak_mb}
+
+
+def benchmark_pipeline(nyc_geo: gpd.GeoDataFrame, n_trips: int, n_crashes: int = YEAR_CRASHES,
+                       n_closures: int = YEAR_CLOSURES, n_streets: int = STREET_SEGMENTS, seed: int = 0,
+                       memory: bool = True) -> dict:
+    """
+    Runs the hot pipeline stages on a synthetic data set and measures each of them.
+    :param nyc_geo: geopandas dataframe with taxi zone data
+    :param n_trips: number of taxi trips
+    :param n_crashes: number of crashes
+    :param n_closures: number of road closures
+    :param n_streets: number of street segments
+    :param seed: seed of the synthetic data
+    :param memory: trace the peak memory of every stage
+    :return: dictionary with the data sizes and a list with the measurements of every stage
+    """
+    start = time.perf_counter()
+    data = synthetic_data(nyc_geo, n_trips, n_crashes, n_closures, n_streets, seed)
+    generate_seconds = time.perf_counter() - start
+    trips, closures = data['trips'], data['closures']
+    stages = []
+
+    neighbors, record = measure_stage('find_neighbors', main.find_neighbors, len(nyc_geo), nyc_geo, memory=memory)
+    stages.append(record)
+    _, record = measure_stage('filter_trips_based_on_zones', main.filter_trips_based_on_zones, n_trips, trips,
+                              neighbors, memory=memory)
+    stages.append(record)
+
+    raw_crashes = data['crashes'][['index', 'CRASH DATE_CRASH TIME', 'LOCATION']]
+    crash_zones, record = measure_stage('add_zone_to_crash', fc.add_zone_to_crash, n_crashes, raw_crashes.copy(),
+                                        nyc_geo, save_path=None, memory=memory)
+    stages.append(record)
+    closure_zones, record = measure_stage('add_zone_to_closures', fc.add_zone_to_closures, n_closures, closures,
+                                          data['streets'].copy(), nyc_geo, save_path=None, memory=memory)
+    stages.append(record)
+
+    crashes = crash_zones
+    _, record = measure_stage('event_counts_during_trips', fc.event_counts_during_trips, n_trips, trips, crashes,
+                              closures, closure_zones, memory=memory)
+    stages.append(record)
+
+    pairs, record = measure_stage('cluster_crashes', c.cluster_crashes, n_crashes, crashes, memory=memory)
+    stages.append(record)
+    _, record = measure_stage('cluster_clusters', c.cluster_clusters, len(pairs), pairs, nyc_geo, plot=False,
+                              memory=memory)
+    stages.append(record)
+
+    return {'trips': n_trips, 'crashes': n_crashes, 'closures': n_closures, 'streets': n_streets, 'seed': seed,
+            'generate_seconds': generate_seconds, 'stages': stages}
+
+
+def compare_results(old_results: dict, new_results: dict) -> pd.DataFrame:
+    """
+    Compares the stage times of two benchmark result files.
+    :param old_results: benchmark results of the baseline
+    :param new_results: benchmark results to compare
+    :return: pandas dataframe with the seconds and peak memory of both runs by trips and stage, and the ratio of the
+        new to the old time. A ratio above 1 is a slowdown.
+    """
+    def stage_table(results):
+        return pd.DataFrame([{'trips': run['trips'], **stage} for run in results['runs'] for stage in run['stages']]
+                            ).set_index(['trips', 'stage'])[['seconds', 'peak_mb']]
+
+    table = stage_table(old_results).join(stage_table(new_results), how='inner', lsuffix='_old', rsuffix='_new')
+    table['time_ratio'] = table['seconds_new'] / table['seconds_old']
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the pipeline stages on synthetic data over the taxi zones.')
+    parser.add_argument('--scales', nargs='+', default=['10k'],
+                        help=f'numbers of trips, as integers or names from {list(SCALES)}')
+    parser.add_argument('--crashes', type=int, default=YEAR_CRASHES, help='number of crashes')
+    parser.add_argument('--closures', type=int, default=YEAR_CLOSURES, help='number of road closures')
+    parser.add_argument('--streets', type=int, default=STREET_SEGMENTS, help='number of street segments')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--zones', default='NYC_Taxi_Zones.geojson', help='path to the taxi zones file')
+    parser.add_argument('--output', help='path of the JSON results. benchmark_<commit>.json if not given')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace the peak memory of the stages')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare the stage times with')
+    parser.add_argument('--legacy', action='store_true', help='also compare against the legacy zone and event loops')
+    args = parser.parse_args()
+
+    nyc_taxi_geo = zones.read_zones(args.zones)
+    if args.legacy:
+        print(benchmark_zone_assignment(nyc_taxi_geo))
+        print(benchmark_event_matching())
+
+    results = {**profiling.git_commit(), 'created': datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'platform': platform.platform(), 'runs': []}
+    for scale in args.scales:
+        run = benchmark_pipeline(nyc_taxi_geo, parse_scale(scale), args.crashes, args.closures, args.streets,
+                                 args.seed, memory=not args.no_memory)
+        print(pd.DataFrame(run['stages']).set_index('stage').to_string())
+        results['runs'].append(run)
+
+    output = args.output or f"benchmark_{(results['commit'] or 'nocommit')[:7]}.json"
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Results saved to {output}')
+
+    if args.compare:
+        with open(args.compare) as file:
+            print(compare_results(json.load(file), results).to_string())
@@ -1,14 +1,17 @@
 import geopandas as gpd
 import pandas as pd
-from shapely import wkt
-import matplotlib.pyplot as plt
+import numpy as np
+import heapq
+import shapely
 import File_creation as fc
 import datetime
 
-def cluster_crashes(crashes_df: pd.DataFrame):
+def cluster_crashes(crashes_df: pd.DataFrame, plot: bool = True, figure_path: str = None):
     """
 
     :param crashes_df:
+    :param plot: draw a histogram of the crash pairs per zone if True
+    :param figure_path: path of the image file the histogram is saved to. The histogram is shown if None.
     :return:
     >>> nyc_taxi_geo = gpd.read_file('NYC_Taxi_Zones.geojson')
     >>> crashes_data = datetime_conversions(fc.open_file("Crash_zones.csv"), ['CRASH DATE_CRASH TIME'], '%Y-%m-%d %H:%M:%S')
@@ -18,85 +21,198 @@ def cluster_crashes(crashes_df: pd.DataFrame):
     [38996 rows x 9 columns]
     """
     # Create Date Column
-    crashes_df['Date'] = crashes_df.apply(lambda x: x['CRASH DATE_CRASH TIME'].date(), axis=1)
+    crashes_df['Date'] = crashes_df['CRASH DATE_CRASH TIME'].dt.date
     # Create Time column (Copy of datetime column)
-    crashes_df['Time'] = crashes_df.apply(lambda x: x['CRASH DATE_CRASH TIME'], axis=1)
-    # Merge dataframe with itself on Zone and Date columns
-    clusters = pd.merge(crashes_df[['index', 'Date', 'Time', 'ZONE', 'geometry']], crashes_df, how='inner',
-                        left_on=['ZONE', 'Date'], right_on=['ZONE', 'Date'])
-    # Drop NaNs
-    clusters = clusters.dropna()
-    # Keep only these columns
-    clusters_df = clusters[['Unnamed: 0', 'index_x', 'index_y', 'geometry_x', 'geometry_y', 'ZONE', 'Date', 'Time_x', 'Time_y']]
-    # Remove rows that merged the same collision with itself
-    clusters_df = clusters_df.loc[clusters_df['index_x'] != clusters_df['index_y']]
-    # Create a timedelta object of an hour to compare collision time differences to
-    time_delta_hour = datetime.timedelta(hours=1)
-
-    # Filter df to keep only crashes that occurred within an hour of one another
-    clusters_df = clusters_df[(abs(clusters_df['Time_x']-clusters_df['Time_y'])) < time_delta_hour]
-
-    # Getting rid of reverse duplicates:
-
-    # Create a set for pairs of collisions that have been processed
-    processed = set()
-    # Create an empty list to keep track of rows to be removed
-    to_remove = []
-    # Loop through the rows of the dataframe
-    for index, row in clusters_df.iterrows():
-        # Check if the reverse of the row has already been processed
-        if (row['index_y'], row['index_x']) in processed:
-            # If it has, add the index of the row to the list of rows to be removed
-            to_remove.append(index)
-        else:
-            # If it hasn't, add the row to the set of processed rows
-            processed.add((row['index_x'], row['index_y']))
-
-    # Drop rows of pairs which have already been processed
-    clusters_df = clusters_df.drop(to_remove)
-
-    # Create figure
-    fig, ax = plt.subplots()
+    crashes_df['Time'] = crashes_df['CRASH DATE_CRASH TIME']
+    # Find pairs of crashes in the same zone within an hour of one another
+    clusters_df = crash_pairs(crashes_df)
+
+    if plot:
+        plot_crash_pairs(clusters_df, figure_path)
+    return clusters_df
+
+
+def plot_crash_pairs(clusters_df: pd.DataFrame, figure_path: str = None):
+    """
+    Draws a histogram of the number of days with crash pairs in every zone.
+    :param clusters_df: cluster df made by cluster_crashes
+    :param figure_path: path of the image file the histogram is saved to. The histogram is shown if None.
+    """
+    import Vis
+    fig, ax = Vis.pyplot().subplots()
     clusters_df.groupby(['Date', 'ZONE']).count().reset_index().hist(['ZONE'], ax=ax, bins=247)
     ax.set_xlabel('Zone')
     ax.set_ylabel('Collision Pairs')
     ax.set_title('Collisions Occurring within an Hour of Another Collision in the Same Zone')
-    plt.show()
-    # Group by Date and Zone, count, and sort in descending order
-    return clusters_df
+    Vis.show_figure(fig, figure_path)
+
+
+def crash_pairs(crashes_df: pd.DataFrame, window: datetime.timedelta = datetime.timedelta(hours=1)) -> pd.DataFrame:
+    """
+    Finds every pair of crashes in the same zone less than window apart. The crashes are sorted by zone and time and
+    a sliding window over the sorted times gives the pairs, so the work grows with the number of pairs found. Every
+    pair appears once, with the crash that comes first in crashes_df as x. Pairs across midnight are included.
+    :param crashes_df: pandas dataframe of car crashes with index, CRASH DATE_CRASH TIME, ZONE and geometry columns
+    :param window: maximum time between the crashes of a pair
+    :return: pandas dataframe with one row per pair of crashes
+    >>> crashes = pd.DataFrame({'index': [1, 2, 3, 4],
+    ...                         'CRASH DATE_CRASH TIME': pd.to_datetime(['2018-01-01 23:40', '2018-01-02 00:20',
+    ...                                                                  '2018-01-01 23:50', '2018-01-01 23:45']),
+    ...                         'ZONE': [7, 7, 7, 8], 'geometry': ['a', 'b', 'c', 'd']})
+    >>> crash_pairs(crashes)[['index_x', 'index_y', 'ZONE', 'Date']]
+       index_x  index_y  ZONE        Date
+    0        1        2     7  2018-01-01
+    1        1        3     7  2018-01-01
+    2        2        3     7  2018-01-02
+    """
+    crashes = crashes_df.dropna(subset=['index', 'CRASH DATE_CRASH TIME', 'ZONE', 'geometry'])
+    times = crashes['CRASH DATE_CRASH TIME'].to_numpy(dtype='datetime64[ns]').view(np.int64)
+    zone_codes = pd.factorize(crashes['ZONE'])[0]
+
+    # sort by zone, then time
+    order = np.lexsort((times, zone_codes))
+    sorted_times = times[order]
+    zone_starts = np.flatnonzero(np.diff(zone_codes[order], prepend=-1))
+    zone_ends = np.append(zone_starts[1:], len(order))
+
+    # for every crash, the end of its window in the sorted times of its zone
+    window_ends = np.empty(len(order), dtype=np.int64)
+    window_ns = pd.Timedelta(window).value
+    for start, end in zip(zone_starts, zone_ends):
+        zone_times = sorted_times[start:end]
+        window_ends[start:end] = start + np.searchsorted(zone_times, zone_times + window_ns, side='left')
 
-def cluster_clusters(df:gpd.GeoDataFrame, nyc_gdf:gpd.GeoDataFrame):
+    # emit the pairs (i, j) with i < j < window end of i
+    pair_counts = window_ends - np.arange(len(order)) - 1
+    first = np.repeat(np.arange(len(order)), pair_counts)
+    offsets = np.arange(len(first)) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+    second = first + 1 + offsets
+    first, second = order[first], order[second]
+    x, y = np.minimum(first, second), np.maximum(first, second)
+    pair_order = np.lexsort((y, x))
+    x, y = x[pair_order], y[pair_order]
+
+    pairs = {}
+    if 'Unnamed: 0' in crashes.columns:
+        pairs['Unnamed: 0'] = crashes['Unnamed: 0'].to_numpy()[y]
+    pairs.update({'index_x': crashes['index'].to_numpy()[x],
+                  'index_y': crashes['index'].to_numpy()[y],
+                  'geometry_x': crashes['geometry'].to_numpy()[x],
+                  'geometry_y': crashes['geometry'].to_numpy()[y],
+                  'ZONE': crashes['ZONE'].to_numpy()[x],
+                  'Date': crashes['CRASH DATE_CRASH TIME'].dt.date.to_numpy()[x],
+                  'Time_x': crashes['CRASH DATE_CRASH TIME'].to_numpy()[x],
+                  'Time_y': crashes['CRASH DATE_CRASH TIME'].to_numpy()[y]})
+    return pd.DataFrame(pairs)
+
+
+def union_find_components(n: int, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """
+    Finds the connected components of a graph with union-find over a numpy parent array. All edges are hooked and
+    the paths compressed at once, repeated until every edge joins nodes of the same tree.
+    :param n: number of nodes
+    :param first: numpy array with the first node of every edge
+    :param second: numpy array with the second node of every edge
+    :return: numpy array with the component number of every node. Components are numbered from 0 in order of their
+        first node.
+    >>> union_find_components(6, np.array([0, 3, 4]), np.array([1, 4, 5]))
+    array([0, 0, 1, 2, 2, 2])
     """
+    parent = np.arange(n)
+    first = np.asarray(first, dtype=np.int64)
+    second = np.asarray(second, dtype=np.int64)
+    while True:
+        # path compression: every node jumps to the parent of its parent until it points at its root
+        grandparent = parent[parent]
+        while not np.array_equal(grandparent, parent):
+            parent = grandparent
+            grandparent = parent[parent]
+        root_a, root_b = parent[first], parent[second]
+        joined = root_a != root_b
+        if not joined.any():
+            break
+        # union: the root of every edge that joins two trees hooks onto the smaller root
+        np.minimum.at(parent, np.maximum(root_a[joined], root_b[joined]), np.minimum(root_a[joined], root_b[joined]))
+    return np.unique(parent, return_inverse=True)[1]
 
-    :param df: cluster df
+
+def cluster_clusters(df: pd.DataFrame, nyc_gdf: gpd.GeoDataFrame, top_k: int = 35, plot: bool = True,
+                     figure_path: str = None):
+    """
+    Joins crash pairs that share a crash into clusters: chains of collisions in the same zone that each happened within
+    an hour of another collision in the chain. The clusters are the connected components of the crash pair graph.
+    :param df: cluster df made by cluster_crashes
     :param nyc_gdf: GeoDataFrame of NYC taxi zones
-    :return: DataFrame of clustered clusters with point geometry of collisions from the biggest
-    clusters
+    :param top_k: number of clusters to return
+    :param plot: draw a map of the clusters if True
+    :param figure_path: path of the image file the map is saved to. The map is shown if None.
+    :return: GeoDataFrame of the top_k clusters with the most collisions, with their size, zone, date, time span and the
+        centroid of their collisions as geometry
+    >>> pairs = pd.DataFrame({'index_x': [1, 2, 7], 'index_y': [2, 3, 8],
+    ...                       'geometry_x': ['POINT (0 0)', 'POINT (2 0)', 'POINT (5 5)'],
+    ...                       'geometry_y': ['POINT (2 0)', 'POINT (4 0)', 'POINT (5 7)'], 'ZONE': [4, 4, 9],
+    ...                       'Time_x': pd.to_datetime(['2018-03-01 10:00', '2018-03-01 10:40', '2018-05-02 08:00']),
+    ...                       'Time_y': pd.to_datetime(['2018-03-01 10:40', '2018-03-01 11:30', '2018-05-02 08:10'])})
+    >>> cluster_clusters(pairs, None, top_k=1, plot=False)[['Collisions in Cluster', 'ZONE', 'Date', 'time span', 'geometry']]
+             Date  ZONE  Collisions in Cluster
+    0  2018-03-01     4                      3
+       Collisions in Cluster  ZONE        Date       time span     geometry
+    0                      3     4  2018-03-01 0 days 01:30:00  POINT (2 0)
     """
+    # number the crashes of the pairs from 0
+    crash_codes, crash_ids = pd.factorize(np.concatenate([df['index_x'].to_numpy(), df['index_y'].to_numpy()]))
+    first, second = crash_codes[:len(df)], crash_codes[len(df):]
+    clusters = union_find_components(len(crash_ids), first, second)
+
+    # the time, location and zone of every crash
+    crash_times = np.empty(len(crash_ids), dtype='datetime64[ns]')
+    crash_times[first] = df['Time_x'].to_numpy(dtype='datetime64[ns]')
+    crash_times[second] = df['Time_y'].to_numpy(dtype='datetime64[ns]')
+    crash_geometries = np.empty(len(crash_ids), dtype=object)
+    for codes, column in [(first, 'geometry_x'), (second, 'geometry_y')]:
+        geometries = np.asarray(df[column], dtype=object)
+        if len(geometries) and isinstance(geometries[0], str):
+            geometries = shapely.from_wkt(geometries)
+        crash_geometries[codes] = geometries
+    pair_zones = df['ZONE'].to_numpy()
+    crash_zones = np.empty(len(crash_ids), dtype=pair_zones.dtype)
+    crash_zones[first] = pair_zones
+    crash_zones[second] = pair_zones
 
-    for i in ['x', 'y']:
-        # Rename geometry_x and geometry_y to geometry
-        df.rename(columns={f'geometry_{i}': 'geometry'}, inplace=True)
-        # Apply geometry from shapely to geometry objects in columns
-        df[f'geometry_{i}'] = df['geometry'].apply(wkt.loads)
-        # Remove geometry column
-        df.drop('geometry', inplace=True, axis=1)
-    df = gpd.GeoDataFrame(df, crs='epsg:4326', geometry='geometry_x')
-    df.set_geometry('geometry_y', inplace=True)
-
-    big_clusters = df.groupby(by='index_x').count().sort_values('Time_x', ascending=False).head(35)
-    big_clusters.rename(columns={'Unnamed: 0': 'Number of times 2 crashes occurred within an hour/day'}, inplace=True)
-
-    big_cluster_full = df.merge(big_clusters['Number of times 2 crashes occurred within an hour/day'], how='inner',
-                               left_on='index_x', right_on='index_x')
-    big_cluster_full.set_geometry('geometry_x').set_geometry('geometry_y')
-    big_cluster_full.rename(columns={'Number of times 2 crashes occurred '
-                                     'within an hour/day': 'Matches'}, inplace=True)
-    big_cluster_full['Collisions in Cluster'] = big_cluster_full['Matches']+1
-    print(big_cluster_full[['Date', 'ZONE', 'Collisions in Cluster']])
+    # pick the biggest clusters with a heap instead of sorting all of them
+    sizes = np.bincount(clusters)
+    biggest = heapq.nlargest(top_k, range(len(sizes)), key=sizes.__getitem__)
+
+    crashes = pd.DataFrame({'cluster': clusters, 'time': crash_times, 'x': shapely.get_x(crash_geometries),
+                            'y': shapely.get_y(crash_geometries), 'ZONE': crash_zones})
+    crashes = crashes[np.isin(clusters, biggest)]
+    big_clusters = crashes.groupby('cluster').agg(start=('time', 'min'), end=('time', 'max'), x=('x', 'mean'),
+                                                  y=('y', 'mean'), ZONE=('ZONE', 'first'))
+    big_clusters = big_clusters.loc[biggest].reset_index()
+    big_clusters.insert(1, 'Collisions in Cluster', sizes[biggest])
+    big_clusters['Date'] = big_clusters['start'].dt.date
+    big_clusters['time span'] = big_clusters['end'] - big_clusters['start']
+    big_clusters = gpd.GeoDataFrame(big_clusters.drop(columns=['x', 'y']),
+                                    geometry=gpd.points_from_xy(big_clusters['x'], big_clusters['y']),
+                                    crs='epsg:4326')
+    print(big_clusters[['Date', 'ZONE', 'Collisions in Cluster']])
+
+    if plot:
+        plot_clusters(big_clusters, nyc_gdf, figure_path)
+    return big_clusters
+
+
+def plot_clusters(big_clusters: gpd.GeoDataFrame, nyc_gdf: gpd.GeoDataFrame, figure_path: str = None):
+    """
+    Draws the clusters on a map of the taxi zones, sized by their number of collisions.
+    :param big_clusters: GeoDataFrame of clusters made by cluster_clusters
+    :param nyc_gdf: GeoDataFrame of NYC taxi zones
+    :param figure_path: path of the image file the map is saved to. The map is shown if None.
+    """
+    import Vis
+    plt = Vis.pyplot()
     fig, ax = plt.subplots()
-    nyc_gdf.geometry.plot(linewidth=0.05,ax=ax)
-    big_cluster_full.geometry.plot(ax=ax, c='r', alpha=.5)
+    nyc_gdf.geometry.plot(linewidth=0.05, ax=ax)
+    big_clusters.plot(ax=ax, c='r', alpha=.5, markersize=big_clusters['Collisions in Cluster'] * 5)
     plt.title('Map of NYC Illustrating Locations of Largest Collision Clusters in 2018')
-    plt.show()
-    return big_cluster_full
+    Vis.show_figure(fig, figure_path)
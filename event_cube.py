@@ -0,0 +1,308 @@
+import argparse
+import hashlib
+import json
+import os
+from datetime import timedelta
+from typing import NamedTuple
+import numpy as np
+import pandas as pd
+import File_creation as fc
+import zones
+
+CUBE_VERSION = 2
+
+
+class EventCube(NamedTuple):
+    """
+    Cumulative counts of crashes and road closures by zone and time bucket. Bucket k covers
+    [start_ns + k * bucket_ns, start_ns + (k + 1) * bucket_ns).
+    crashes[z, k] is the number of crashes in zone z before bucket k, closure_starts[z, k] the number of closures of
+    zone z that started before bucket k and closure_ends[z, k] the number that ended before bucket k. Every array has
+    one more column than there are buckets, so a count over any range of buckets is the difference of two cells.
+    Closures that started before the cube count as started in its first bucket. Queries outside the cube are clipped
+    to its range. The arrays can be numpy memory maps shared by many processes.
+    """
+    start_ns: int
+    bucket_ns: int
+    crashes: np.ndarray
+    closure_starts: np.ndarray
+    closure_ends: np.ndarray
+
+    def buckets(self, times, round_up: bool = False) -> np.ndarray:
+        """
+        Finds the cumulative column of every time: the column of its bucket, or of the next bucket if round_up is set
+        and the time is inside a bucket. Times outside the cube give the first or last column.
+        :param times: datetimes or epoch nanoseconds
+        :param round_up: round times inside a bucket up instead of down
+        :return: numpy int64 array of columns
+        """
+        values = np.atleast_1d(np.asarray(times))
+        offsets = (values.astype(np.int64) if values.dtype.kind in 'iu' else fc.to_epoch_ns(values)) - self.start_ns
+        return -(-offsets // self.bucket_ns) if round_up else offsets // self.bucket_ns
+
+    def clip(self, columns: np.ndarray) -> np.ndarray:
+        """
+        Keeps columns inside the cube.
+        :param columns: numpy array of columns
+        :return: numpy array of columns from 0 to the last column
+        """
+        return np.clip(columns, 0, self.crashes.shape[1] - 1)
+
+    def zone_sum(self, counts: np.ndarray, zone_sets, first: np.ndarray, last: np.ndarray) -> np.ndarray:
+        """
+        Adds up counts[z, last] - counts[z, first] over the zones of every query.
+        :param counts: cumulative count array of the cube
+        :param zone_sets: one zone set for all queries (1-D), or one zone set per query (2-D, padded with -1)
+        :param first: numpy array with the first cumulative column of every query
+        :param last: numpy array with the last cumulative column of every query
+        :return: numpy int64 array with the count of every query
+        """
+        zone_sets = np.asarray(zone_sets, dtype=np.int64)
+        if zone_sets.ndim < 2:
+            zone_sets = np.broadcast_to(np.atleast_1d(zone_sets), (len(first), np.atleast_1d(zone_sets).size))
+        known = (zone_sets >= 0) & (zone_sets < counts.shape[0])
+        rows = np.where(known, zone_sets, 0)
+        differences = (counts[rows, last[:, None]].astype(np.int64) - counts[rows, first[:, None]])
+        return (differences * known).sum(axis=1)
+
+    def crash_counts(self, zone_sets, window_start, window_end) -> np.ndarray:
+        """
+        Counts the crashes in a set of zones from window_start to window_end (both included) for many windows at once.
+        Counts are exact for crash times that fall on bucket starts, like the minute times of the crash file.
+        :param zone_sets: one zone set for all windows (1-D), or one zone set per window (2-D, padded with -1)
+        :param window_start: datetimes or epoch nanoseconds of the window starts
+        :param window_end: datetimes or epoch nanoseconds of the window ends
+        :return: numpy int64 array with the number of crashes of every window
+        >>> cube = build_event_cube(pd.DataFrame({'ZONE': [4, 4, 7], 'CRASH DATE_CRASH TIME': pd.to_datetime(
+        ...     ['2018-01-01 10:00', '2018-01-01 10:30', '2018-01-01 10:10'])}), None, None)
+        >>> cube.crash_counts([4, 7], pd.to_datetime(['2018-01-01 10:00', '2018-01-01 10:15']),
+        ...                   pd.to_datetime(['2018-01-01 10:10', '2018-01-01 11:00']))
+        array([2, 1])
+        >>> cube.crash_counts([[4, -1], [4, 7]], pd.to_datetime(['2018-01-01 09:00'] * 2),
+        ...                   pd.to_datetime(['2018-01-01 12:00'] * 2))
+        array([2, 3])
+        """
+        first = self.clip(self.buckets(window_start, round_up=True))
+        last = self.clip(self.buckets(window_end) + 1)
+        return self.zone_sum(self.crashes, zone_sets, first, last)
+
+    def closure_counts(self, zone_sets, times) -> np.ndarray:
+        """
+        Counts the road closures active in a set of zones at many times at once. A closure is active from its start
+        to its end, both included. Counts are exact for closure times that fall on bucket starts.
+        :param zone_sets: one zone set for all times (1-D), or one zone set per time (2-D, padded with -1)
+        :param times: datetimes or epoch nanoseconds
+        :return: numpy int64 array with the number of active closures at every time
+        """
+        started = self.clip(self.buckets(times) + 1)
+        ended = self.clip(self.buckets(times, round_up=True))
+        return (self.zone_sum(self.closure_starts, zone_sets, np.zeros_like(started), started) -
+                self.zone_sum(self.closure_ends, zone_sets, np.zeros_like(ended), ended))
+
+    def trip_event_counts(self, trips_df: pd.DataFrame, time_window: timedelta = timedelta(minutes=30)
+                          ) -> pd.DataFrame:
+        """
+        Counts the events in the pickup or drop off zone of every taxi trip, like
+        File_creation.event_counts_during_trips, with lookups in the cube instead of the event tables.
+        :param trips_df: pandas dataframe of taxi trips data
+        :param time_window: time before the pickup and after the drop off in which crashes are counted
+        :return: pandas dataframe indexed by trip ID with the columns num_of_crashes_passed and
+            num_of_road_closures_passed
+        """
+        pick_times = fc.to_epoch_ns(trips_df['tpep_pickup_datetime'])
+        drop_times = fc.to_epoch_ns(trips_df['tpep_dropoff_datetime'])
+        window = pd.Timedelta(time_window).value
+        pickup_zones = trips_df['PULocationID'].to_numpy(dtype=np.int64)
+        dropoff_zones = trips_df['DOLocationID'].to_numpy(dtype=np.int64)
+        # the drop off zone is not counted twice for trips that stay in their pickup zone
+        zone_sets = np.stack([pickup_zones, np.where(dropoff_zones != pickup_zones, dropoff_zones, -1)], axis=1)
+        return pd.DataFrame({'num_of_crashes_passed': self.crash_counts(zone_sets, pick_times - window,
+                                                                        drop_times + window),
+                             'num_of_road_closures_passed': self.closure_counts(zone_sets, pick_times)},
+                            index=pd.Index(trips_df['tripID'].to_numpy(), name='tripID'))
+
+
+def cumulative_counts(event_zones: np.ndarray, event_buckets: np.ndarray, shape: tuple, out: np.ndarray = None
+                      ) -> np.ndarray:
+    """
+    Counts events by zone and bucket and sums the counts along the buckets.
+    :param event_zones: numpy array with the zone of every event
+    :param event_buckets: numpy array with the bucket of every event, from 0 to shape[1] - 2
+    :param shape: shape of the cube arrays
+    :param out: array to write the counts to, like a memory map. A new array if None.
+    :return: array where [z, k] is the number of events of zone z in the buckets before k
+    >>> cumulative_counts(np.array([1, 1, 0]), np.array([0, 2, 1]), (2, 4))
+    array([[0, 0, 1, 1],
+           [0, 1, 1, 2]], dtype=uint8)
+    """
+    totals = np.bincount(event_zones, minlength=shape[0])
+    if out is None:
+        out = np.zeros(shape, dtype=np.min_scalar_type(max(int(totals.max(initial=0)), 1)))
+    order = np.argsort(event_zones, kind='stable')
+    bounds = np.searchsorted(event_zones[order], np.arange(shape[0] + 1))
+    for zone in range(shape[0]):
+        zone_buckets = event_buckets[order[bounds[zone]:bounds[zone + 1]]]
+        out[zone, 0] = 0
+        out[zone, 1:] = np.cumsum(np.bincount(zone_buckets, minlength=shape[1] - 1)[:shape[1] - 1])
+    return out
+
+
+def event_zone_numbers(zone_column: pd.Series, zone_numbers: dict = None) -> np.ndarray:
+    """
+    Turns a ZONE column into integer zone numbers. The crash and closure zone files store zone numbers (objectid),
+    which are kept. Zone names, as stored by older crash files, are mapped with zone_numbers.
+    :param zone_column: pandas Series of zones
+    :param zone_numbers: dictionary mapping zone names to zone numbers. See zone_number_map.
+    :return: numpy int64 array of zone numbers, -1 for missing or unknown zones
+    >>> event_zone_numbers(pd.Series([4, None, 12], dtype='Int16')).tolist()
+    [4, -1, 12]
+    >>> event_zone_numbers(pd.Series(['Astoria', 'Nowhere']), {'Astoria': 7}).tolist()
+    [7, -1]
+    """
+    if not (pd.api.types.is_numeric_dtype(zone_column.dtype) or
+            pd.api.types.is_numeric_dtype(zone_column.dropna().infer_objects())):
+        if zone_numbers is None:
+            raise ValueError('The ZONE column holds names. Pass zone_numbers to map them to zone numbers.')
+        zone_column = zone_column.astype(object).map(zone_numbers)
+    return pd.to_numeric(zone_column).fillna(-1).to_numpy(dtype=np.int64)
+
+
+def zone_number_map(nyc_geo: pd.DataFrame) -> dict:
+    """
+    Maps the zone names of older crash files to the zone numbers (objectid) of the taxi trips. Names shared by several
+    zones map to the last of them.
+    :param nyc_geo: geopandas dataframe of taxi zones
+    :return: dictionary with zone names as keys and zone numbers as values
+    """
+    return dict(zip(nyc_geo['zone'], nyc_geo['objectid'].astype(int).to_numpy()))
+
+
+def build_event_cube(crashes_df: pd.DataFrame, closures_df: pd.DataFrame, closure_zones_df: pd.DataFrame,
+                     start=None, end=None, bucket: timedelta = timedelta(minutes=1), path: str = None,
+                     zone_numbers: dict = None, n_zones: int = zones.NUM_ZONE_IDS) -> EventCube:
+    """
+    Builds the event cube from the crash and road closure tables.
+    :param crashes_df: pandas dataframe of car crashes data with ZONE and CRASH DATE_CRASH TIME columns
+    :param closures_df: pandas dataframe of road closure data. No closures if None.
+    :param closure_zones_df: pandas dataframe of road closure zones data. No closures if None.
+    :param start: first time of the cube. The day of the first crash if None.
+    :param end: end of the cube. The day after the last crash if None.
+    :param bucket: length of a time bucket
+    :param path: directory to save the cube arrays to as .npy files, written through memory maps so the cube is
+        never fully in memory. Not saved if None.
+    :param zone_numbers: dictionary mapping zone names to zone numbers, for crash files that hold zone names. See
+        zone_number_map.
+    :param n_zones: number of zone rows. Zones from 0 to n_zones - 1 can be counted.
+    :return: EventCube
+    """
+    # add_zone_to_crash stores the zone of a crash in a list
+    crashes = crashes_df[['ZONE', 'CRASH DATE_CRASH TIME']].explode('ZONE').dropna()
+    crash_times = fc.to_epoch_ns(crashes['CRASH DATE_CRASH TIME'])
+    start_ns = pd.Timestamp(start).value if start is not None else pd.Timestamp(crash_times.min()).floor('D').value
+    end_ns = pd.Timestamp(end).value if end is not None else (pd.Timestamp(crash_times.max()).floor('D') +
+                                                              pd.Timedelta(days=1)).value
+    bucket_ns = pd.Timedelta(bucket).value
+    shape = (n_zones, -(-(end_ns - start_ns) // bucket_ns) + 1)
+
+    def event_buckets(times):
+        return np.clip((times - start_ns) // bucket_ns, 0, shape[1] - 2)
+
+    crash_zones = event_zone_numbers(crashes['ZONE'], zone_numbers)
+    in_cube = (crash_zones >= 0) & (crash_zones < n_zones) & (crash_times >= start_ns) & (crash_times < end_ns)
+    tables = {'crashes': (crash_zones[in_cube], event_buckets(crash_times[in_cube]))}
+
+    if closures_df is not None and closure_zones_df is not None:
+        closure_zones = closure_zones_df[['SEGMENTID', 'ZONE']].drop_duplicates()
+        closures = closures_df[['SEGMENTID', 'WORK_START_DATE', 'WORK_END_DATE']].dropna()
+        zone_closures = pd.merge(closures, closure_zones, on='SEGMENTID', how='inner')
+        starts = fc.to_epoch_ns(zone_closures['WORK_START_DATE'])
+        ends = fc.to_epoch_ns(zone_closures['WORK_END_DATE'])
+        closure_zone_numbers = event_zone_numbers(zone_closures['ZONE'], zone_numbers)
+        # closures that start after the cube cannot be active in it, and ends after the cube are never reached
+        valid = ((closure_zone_numbers >= 0) & (closure_zone_numbers < n_zones) & (starts <= ends) &
+                 (starts < end_ns))
+        ended = valid & (ends < end_ns)
+        tables['closure_starts'] = (closure_zone_numbers[valid], event_buckets(starts[valid]))
+        tables['closure_ends'] = (closure_zone_numbers[ended], event_buckets(ends[ended]))
+    else:
+        tables['closure_starts'] = tables['closure_ends'] = (np.array([], dtype=np.int64),
+                                                             np.array([], dtype=np.int64))
+
+    arrays = {}
+    for name, (event_zones, buckets) in tables.items():
+        out = None
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            dtype = np.min_scalar_type(max(int(np.bincount(event_zones, minlength=n_zones).max(initial=0)), 1))
+            out = np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='w+', dtype=dtype, shape=shape)
+        arrays[name] = cumulative_counts(event_zones, buckets, shape, out)
+        if path is not None:
+            arrays[name].flush()
+
+    cube = EventCube(start_ns, bucket_ns, arrays['crashes'], arrays['closure_starts'], arrays['closure_ends'])
+    if path is not None:
+        with open(os.path.join(path, 'cube.json'), 'w') as file:
+            json.dump({'version': CUBE_VERSION, 'start_ns': start_ns, 'bucket_ns': bucket_ns}, file)
+    return cube
+
+
+def open_event_cube(path: str) -> EventCube:
+    """
+    Opens a saved event cube as read-only memory maps. Only the cells that queries touch are read from disk, and
+    processes that open the same cube share its pages.
+    :param path: directory of the saved cube
+    :return: EventCube
+    """
+    with open(os.path.join(path, 'cube.json')) as file:
+        meta = json.load(file)
+    return EventCube(meta['start_ns'], meta['bucket_ns'],
+                     *(np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+                       for name in ('crashes', 'closure_starts', 'closure_ends')))
+
+
+def load_event_cube(path: str = 'event_cube', crashes_path: str = 'Crash_zones.parquet',
+                    closures_path: str = 'closures_cleaned.parquet', closure_zones_path: str = 'closure_zones.parquet',
+                    bucket: timedelta = timedelta(minutes=1), zone_numbers: dict = None) -> EventCube:
+    """
+    Opens the event cube saved by an earlier call. It is built and saved the first time, and again when the event
+    files or the bucket change.
+    :param path: directory of the saved cube
+    :param crashes_path: path to the crash file
+    :param closures_path: path to the cleaned closures file
+    :param closure_zones_path: path to the closure zones file
+    :param bucket: length of a time bucket
+    :param zone_numbers: dictionary mapping zone names to zone numbers, for crash files that hold zone names. See
+        zone_number_map.
+    :return: EventCube backed by memory maps
+    """
+    numbers_hash = hashlib.sha1(repr(sorted(map(repr, (zone_numbers or {}).items()))).encode()).hexdigest()
+    sources_hash = f'{CUBE_VERSION}-{pd.Timedelta(bucket).value}-{numbers_hash}-' + '-'.join(
+        zones.file_hash(source) for source in (crashes_path, closures_path, closure_zones_path))
+    meta_path = os.path.join(path, 'cube.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as file:
+            if json.load(file).get('sources_hash') == sources_hash:
+                return open_event_cube(path)
+
+    build_event_cube(fc.open_file(crashes_path), fc.open_file(closures_path), fc.open_file(closure_zones_path),
+                     bucket=bucket, path=path, zone_numbers=zone_numbers)
+    with open(meta_path) as file:
+        meta = json.load(file)
+    with open(meta_path, 'w') as file:
+        json.dump({**meta, 'sources_hash': sources_hash}, file)
+    return open_event_cube(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the zone and time event cube from the crash and closure '
+                                                 'files made by pipeline.py.')
+    parser.add_argument('--path', default='event_cube', help='directory of the saved cube')
+    parser.add_argument('--zones', default='NYC_Taxi_Zones.geojson', help='path to the taxi zones file')
+    parser.add_argument('--bucket-minutes', type=float, default=1, help='length of a time bucket in minutes')
+    args = parser.parse_args()
+
+    cube = load_event_cube(args.path, bucket=timedelta(minutes=args.bucket_minutes),
+                           zone_numbers=zone_number_map(zones.read_zones(args.zones)))
+    print(f'{cube.crashes.shape[0]} zones x {cube.crashes.shape[1] - 1} buckets from '
+          f'{pd.Timestamp(cube.start_ns)}: {int(cube.crashes[:, -1].sum())} crashes, '
+          f'{int(cube.closure_starts[:, -1].sum())} zone closures')
@@ -1,9 +1,14 @@
+import argparse
+import os
 import File_creation as fc
 import pandas as pd
 import geopandas as gpd
 import clusters as c
 import numpy as np
-import Vis as viz
+import zones
+import routing
+import profiling
+import trip_stats
 
 
 def find_neighbors(gdf: gpd.GeoDataFrame) -> dict:
@@ -11,60 +16,81 @@ def find_neighbors(gdf: gpd.GeoDataFrame) -> dict:
     :param zones: taxi zones
     :return: dictionary with format:
     {zone1:[neighbor1,neighbor2,...], zone2:[neighbor1,neighbor2,...], ...}
+    The keys and neighbors are the objectid of the zones.
 
     Reference:
     https://gis.stackexchange.com/questions/281652/finding-all-neighbors-using-geopandas
 
     """
-    neighbor_dict = {}
-    for index, zone in gdf.iterrows():
-        # get 'not disjoint' countries
-        neighbors = gdf[~gdf.geometry.disjoint(zone.geometry)].objectid.tolist()
+    adjacency = zones.build_adjacency(gdf)
+    return zones.neighbor_dict(adjacency, gdf['objectid'].astype(int))
 
-        # remove own zone number from the list
-        neighbors = [int(num) for num in neighbors if zone.objectid != num]
-
-        #add zone neighbors to neighbor dictionary
-        neighbor_dict[index + 1] = neighbors
+def neighbor_matrix(neighbor_dict: dict) -> np.ndarray:
+    """
+    Turns a neighbor dictionary into a 264x264 boolean matrix indexed by zone number
+    :param neighbor_dict: dictionary of zones and their neighbors
+    :return: numpy array where [zone1, zone2] is True if zone2 is a neighbor of zone1
+    >>> matrix = neighbor_matrix({1: [2], 2: [1, 3], 3: [2]})
+    >>> matrix.shape, bool(matrix[2, 3]), bool(matrix[1, 3])
+    ((264, 264), True, False)
+    """
+    matrix = np.zeros((264, 264), dtype=bool)
+    for zone, neighbors in neighbor_dict.items():
+        matrix[zone, neighbors] = True
+    return matrix
 
-    return neighbor_dict
 
-def filter_trips_based_on_zones(df:pd.DataFrame, neighbor_dict: dict):
+def zone_pair_mask(pickup_zones: np.ndarray, dropoff_zones: np.ndarray, neighbors: np.ndarray,
+                   mode: str = 'neighbors', hops: int = 1) -> np.ndarray:
+    """
+    Finds the trips whose pickup and drop off zones fit a zone mode
+    :param pickup_zones: numpy array of pickup zones
+    :param dropoff_zones: numpy array of drop off zones
+    :param neighbors: 264x264 boolean neighbor matrix made by neighbor_matrix
+    :param mode: 'same' for trips that stay in their pickup zone, 'neighbors' for trips that end within hops
+        neighbor steps of their pickup zone (but not in it), 'any' for all trips between known zones
+    :param hops: number of neighbor steps allowed in 'neighbors' mode
+    :return: numpy boolean array that is True for the trips to keep
+    >>> neighbors = neighbor_matrix({1: [2], 2: [1, 3], 3: [2]})
+    >>> pickup, dropoff = np.array([1, 1, 1, 1, 265]), np.array([1, 2, 3, 4, 1])
+    >>> zone_pair_mask(pickup, dropoff, neighbors)
+    array([False,  True, False, False, False])
+    >>> zone_pair_mask(pickup, dropoff, neighbors, hops=2)
+    array([False,  True,  True, False, False])
+    >>> zone_pair_mask(pickup, dropoff, neighbors, mode='same')
+    array([ True, False, False, False, False])
+    >>> zone_pair_mask(pickup, dropoff, neighbors, mode='any')
+    array([ True,  True,  True,  True, False])
+    """
+    # keep only trips that have PO and DO zones that aren't above 263
+    known_zones = (pickup_zones < 264) & (dropoff_zones < 264)
+    pickup_zones = np.where(known_zones, pickup_zones, 0)
+    dropoff_zones = np.where(known_zones, dropoff_zones, 0)
+    if mode == 'same':
+        return known_zones & (pickup_zones == dropoff_zones)
+    elif mode == 'neighbors':
+        reachable = zones.reachable_zones(neighbors, hops)
+        return known_zones & reachable[pickup_zones, dropoff_zones]
+    elif mode == 'any':
+        return known_zones
+    else:
+        raise ValueError(f"Invalid zone mode '{mode}'. Must be 'same', 'neighbors' or 'any'.")
+
+
+def filter_trips_based_on_zones(df: pd.DataFrame, neighbor_dict: dict, mode: str = 'neighbors',
+                                hops: int = 1) -> pd.DataFrame:
     """
     Get rid of trips that go beyond a neighboring zone
     :param df: taxi trip DataFrame
     :param neighbor_dict: dictionary of zones and their neighbors
-    :return:
+    :param mode: 'same' keeps trips that stay in their pickup zone, 'neighbors' keeps trips that end within hops
+        neighbor steps of their pickup zone, 'any' keeps all trips between known zones
+    :param hops: number of neighbor steps allowed in 'neighbors' mode
+    :return: taxi trip DataFrame with the trips that fit the zone mode
     """
-    trips_zones_dict = {}
-    # keep only trips that have PO and DO zones that aren't above 263
-    limit_mask = (df['PULocationID'] < 264) & (df['DOLocationID'] < 264)
-    trips_df = df[limit_mask]
-
-    # Find zones with no neighbors
-    dont_include = []
-    for x in neighbor_dict:
-        if neighbor_dict[x] == []:
-            dont_include.append(x)
-
-    # create mask to remove trips that start or end in a zone without neighbors
-    no_neighbors_mask = (~trips_df['PULocationID'].isin(dont_include)) & (~trips_df['DOLocationID'].isin(dont_include))
-
-    # apply masks
-    trips_df = trips_df[no_neighbors_mask]
-
-    for index, trip in trips_df.iterrows():
-        PUzone = trip['PULocationID']
-        PUzone_neighbors = neighbor_dict[PUzone]
-        trips_zones_dict[trip['tripID']] = set(PUzone_neighbors)
-    exclude = []
-    for x in trips_df.iterrows():
-        tripID = x[1][0]
-        DOzone = x[1][5]
-        if DOzone not in (trips_zones_dict[tripID]):
-            exclude.append(tripID)
-    trips_df = trips_df[~trips_df['tripID'].isin(exclude)]
-    return trips_df
+    keep = zone_pair_mask(df['PULocationID'].to_numpy(), df['DOLocationID'].to_numpy(),
+                          neighbor_matrix(neighbor_dict), mode, hops)
+    return df[keep]
 
 
 def datetime_conversions(df: pd.DataFrame, column_names: list, time_format: str) -> pd.DataFrame:
@@ -106,6 +132,102 @@ def removeWeirdTaxiData(df: pd.DataFrame) -> pd.DataFrame:
 
     return df
 
+def prepare_trip_chunk(chunk: pd.DataFrame, removed: dict, neighbors: np.ndarray = None, zone_mode: str = 'neighbors',
+                       hops: int = 1, time_format: str = '%m/%d/%Y %I:%M:%S %p') -> pd.DataFrame:
+    """
+    Converts, derives and filters one chunk of taxi trips. See prepare_trips.
+    :param chunk: pandas dataframe of raw taxi trips read with the dtypes of prepare_trips
+    :param removed: dictionary with the number of trips each rule removed. The trips removed from the chunk are added.
+    :param neighbors: 264x264 boolean neighbor matrix made by neighbor_matrix. The zone rule is skipped if None.
+    :param zone_mode: 'same', 'neighbors' or 'any'. See filter_trips_based_on_zones.
+    :param hops: number of neighbor steps allowed in 'neighbors' mode
+    :param time_format: format of the pickup and drop off times
+    :return: pandas dataframe of the kept trips with compact dtypes
+    """
+    pickup = pd.to_datetime(chunk['tpep_pickup_datetime'], format=time_format).to_numpy().astype('datetime64[s]')
+    dropoff = pd.to_datetime(chunk['tpep_dropoff_datetime'], format=time_format).to_numpy().astype('datetime64[s]')
+    # the rules are checked in float64 and the results are stored as float32
+    trip_time_h = (dropoff - pickup).astype(np.int64) / 3600
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avg_speed = chunk['trip_distance'].to_numpy(dtype=np.float64) / trip_time_h
+    pickup_zones = chunk['PULocationID'].to_numpy()
+    dropoff_zones = chunk['DOLocationID'].to_numpy()
+
+    rules = {'too_quick': trip_time_h >= 0.01666666667,                 # less than a minute
+             'too_long': trip_time_h <= 24,                              # more than 24hrs
+             'super_fast': avg_speed <= 90,                              # drove faster than 90mph
+             'super_slow': avg_speed >= 1}                               # drove slower than 1mph
+    if neighbors is not None:
+        rules['not_neighbor_zones'] = zone_pair_mask(pickup_zones, dropoff_zones, neighbors, zone_mode, hops)
+    keep = np.ones(len(chunk), dtype=bool)
+    for rule, passed in rules.items():
+        removed[rule] += int((keep & ~passed).sum())
+        keep &= passed
+
+    trip_ids = chunk['Unnamed: 0'] if 'Unnamed: 0' in chunk.columns else pd.Series(chunk.index, dtype='int32')
+    return pd.DataFrame({'tripID': trip_ids.to_numpy()[keep],
+                         'tpep_pickup_datetime': pickup[keep],
+                         'tpep_dropoff_datetime': dropoff[keep],
+                         'trip_distance': chunk['trip_distance'].to_numpy(dtype=np.float32)[keep],
+                         'PULocationID': pickup_zones[keep],
+                         'DOLocationID': dropoff_zones[keep],
+                         'fare_amount': chunk['fare_amount'].to_numpy()[keep],
+                         'tip_amount': chunk['tip_amount'].to_numpy()[keep],
+                         'tolls_amount': chunk['tolls_amount'].to_numpy()[keep],
+                         'total_amount': chunk['total_amount'].to_numpy()[keep],
+                         'trip_time_h': trip_time_h[keep].astype(np.float32),
+                         'avg speed': avg_speed[keep].astype(np.float32)})
+
+
+# columns prepare_trips reads and their dtypes
+PREPARE_DTYPES = {**fc.TAXI_DTYPES, 'trip_distance': 'float64', 'Unnamed: 0': 'int32'}
+
+
+def prepare_trips(taxi_path: str, neighbor_dict: dict = None, zone_mode: str = 'neighbors', hops: int = 1,
+                  time_format: str = '%m/%d/%Y %I:%M:%S %p', chunksize: int = 1000000) -> tuple:
+    """
+    Reads, converts, derives and filters taxi trips in one pass over the file. Does the work of taxi_file_setup,
+    datetime_conversions, add_time_and_speed, removeWeirdTaxiData and filter_trips_based_on_zones with compact
+    dtypes: int16 zones, float32 amounts, distances, trip times and speeds, and timestamps stored as int64 epoch
+    seconds (datetime64[s]).
+    The file is read in chunks, so only the kept trips are held in memory.
+    :param taxi_path: path or file object of taxi trip data
+    :param neighbor_dict: dictionary of zones and their neighbors. Trips that do not fit zone_mode are removed. The
+        zone rule is skipped if None.
+    :param zone_mode: 'same', 'neighbors' or 'any'. See filter_trips_based_on_zones.
+    :param hops: number of neighbor steps allowed in 'neighbors' mode
+    :param time_format: format of the pickup and drop off times
+    :param chunksize: number of trips read at a time
+    :return: tuple of the cleaned taxi dataframe and a dictionary with the number of trips each rule removed. The
+        dataframe is empty, with the same columns and dtypes, if the file has no trips or every trip was removed.
+    >>> import io
+    >>> quick_trip = pd.DataFrame([['01/01/2018 01:00:00 AM', '01/01/2018 01:00:10 AM', 1.0, 4, 4, 5, 0, 0, 5, 0]],
+    ...                           columns=list(PREPARE_DTYPES))
+    >>> trips, removed = prepare_trips(io.StringIO(quick_trip.to_csv(index=False)))
+    >>> len(trips), trips['avg speed'].dtype, removed['too_quick']
+    (0, dtype('float32'), 1)
+    >>> trips, removed = prepare_trips(io.StringIO(''))
+    >>> len(trips), len(trips.columns), sum(removed.values())
+    (0, 12, 0)
+    """
+    chunks = []
+    removed = {'too_quick': 0, 'too_long': 0, 'super_fast': 0, 'super_slow': 0, 'not_neighbor_zones': 0}
+    neighbors = neighbor_matrix(neighbor_dict) if neighbor_dict is not None else None
+    try:
+        reader = pd.read_csv(taxi_path, usecols=lambda column: column in PREPARE_DTYPES, dtype=PREPARE_DTYPES,
+                             chunksize=chunksize)
+    except pd.errors.EmptyDataError:
+        reader = []
+    for chunk in reader:
+        chunks.append(prepare_trip_chunk(chunk, removed, neighbors, zone_mode, hops, time_format))
+    if not chunks:
+        # a file without trips gives the columns and dtypes of an empty chunk
+        empty = pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in PREPARE_DTYPES.items()})
+        chunks.append(prepare_trip_chunk(empty, removed, neighbors, zone_mode, hops, time_format))
+    trips_df = pd.concat(chunks, ignore_index=True)
+    return trips_df, removed
+
+
 def two_random_zones(neighbor_dict: dict):
     """
     Select a random zone with neighbors and randomly select one of its neighboring zones
@@ -120,20 +242,57 @@ def two_random_zones(neighbor_dict: dict):
     zone2 = np.random.choice(neighbor_dict[zone1])
     return zone1, zone2
 
+def add_event_counts(trips_df: pd.DataFrame, event_counts_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds the event counts of every trip to the trips. The counts are in the order of trips_df, as returned by
+    fc.event_counts_during_trips_parallel, and are added by position because trip IDs repeat across the monthly
+    samples.
+    :param trips_df: pandas dataframe of taxi trips data
+    :param event_counts_df: pandas dataframe with the num_of_crashes_passed and num_of_road_closures_passed columns,
+        one row per trip in the order of trips_df
+    :return: pandas dataframe of the trips with the count columns
+    >>> trips = pd.DataFrame({'tripID': [7, 7, 8], 'PULocationID': [10, 20, 10]})
+    >>> counts = pd.DataFrame({'num_of_crashes_passed': [0, 1, 0], 'num_of_road_closures_passed': [2, 0, 0]},
+    ...                       index=pd.Index([7, 7, 8], name='tripID'))
+    >>> add_event_counts(trips, counts)
+       tripID  PULocationID  num_of_crashes_passed  num_of_road_closures_passed
+    0       7            10                      0                            2
+    1       7            20                      1                            0
+    2       8            10                      0                            0
+    """
+    if len(event_counts_df) != len(trips_df):
+        raise ValueError('event_counts_df must have one row per trip in the order of trips_df')
+    return trips_df.assign(**{column: event_counts_df[column].to_numpy()
+                              for column in ['num_of_crashes_passed', 'num_of_road_closures_passed']})
+
+
 def trips_during_events_avg_time(trips_df: pd.DataFrame, crashes_df: pd.DataFrame, closures_df: pd.DataFrame,
-                                 closure_zones_df: pd.DataFrame):
+                                 closure_zones_df: pd.DataFrame, workers: int = 1, partition_by: str = 'month',
+                                 corridors: routing.ZoneRoutes = None, strata: list = None,
+                                 n_resamples: int = trip_stats.N_RESAMPLES) -> tuple:
     """
     Shows the statistics for fare amount, trip time, and average speed for taxi trips that pass a traffic event
-    and those that do not.
+    and those that do not, and how much they differ with bootstrap confidence intervals.
     :param trips_df: pandas dataframe of taxi trips data
     :param crashes_df: pandas dataframe of car crashes data
     :param closures_df: pandas dataframe of road closure data
     :param closure_zones_df: pandas dataframe of road closure zones data
+    :param workers: number of processes matching trips with events. Uses all cores if None.
+    :param partition_by: 'month' or 'zone'. How the trips are split between the processes.
+    :param corridors: ZoneRoutes to count the events in every zone along the route of a trip. Only the pickup and
+        drop off zones are used if None.
+    :param strata: list of 'zone', 'hour', 'month' or column names to compare the trips within. All trips are compared
+        at once if None.
+    :param n_resamples: number of bootstrap resamples. The bootstrap is skipped if 0.
+    :return: tuple of the trips with their event counts, the numpy boolean array that is True for the trips that
+        passed an event, and the pandas dataframe made by trip_stats.bootstrap_effects (None if skipped). Pass the
+        first two to trip_stats.bootstrap_effects to compare other strata without matching the events again.
     """
 
-    trips_during_events = fc.events_during_trips(trips_df, crashes_df, closures_df, closure_zones_df)
-    trips_during_events_df = pd.DataFrame.from_dict(trips_during_events, orient='index')
-    merged_df = trips_df.merge(trips_during_events_df, left_on='tripID', right_index=True, how='left')
+    trips_during_events_df = fc.event_counts_during_trips_parallel(trips_df, crashes_df, closures_df,
+                                                                   closure_zones_df, workers=workers,
+                                                                   partition_by=partition_by, corridors=corridors)
+    merged_df = add_event_counts(trips_df, trips_during_events_df)
 
     during_events_mask = (merged_df['num_of_crashes_passed'] > 0) | (merged_df['num_of_road_closures_passed'] > 0)
 
@@ -143,43 +302,87 @@ def trips_during_events_avg_time(trips_df: pd.DataFrame, crashes_df: pd.DataFram
     print(taxi_data_during_events[['fare_amount', 'trip_time_h', 'avg speed']].describe())
     print(taxi_data_not_during_events[['fare_amount', 'trip_time_h', 'avg speed']].describe())
 
+    passed_event = during_events_mask.to_numpy()
+    effects = None
+    if n_resamples:
+        effects = trip_stats.bootstrap_effects(merged_df, passed_event, strata, n_resamples=n_resamples,
+                                               workers=workers)
+        print(effects)
+    return merged_df, passed_event, effects
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the taxi, crash and road closure analysis.')
+    parser.add_argument('--plots', choices=['show', 'save', 'none'], default='show',
+                        help='show the figures, save them to --figure-dir without a display, or skip them')
+    parser.add_argument('--figure-dir', default='figures', help='directory the figures are saved to with --plots save')
+    args = parser.parse_args()
+    plot = args.plots != 'none'
+    if args.plots != 'show':
+        # batch runs draw without a display and never block on a window
+        import Vis as viz
+        viz.pyplot(headless=True)
+
+    def figure_path(name):
+        return os.path.join(args.figure_dir, f'{name}.png') if args.plots == 'save' else None
+
+    # neighbors and zones
+    with profiling.stage('neighbors') as stage:
+        nyc_taxi_geo = zones.read_zones('NYC_Taxi_Zones.geojson')
+        neighbors = zones.neighbor_dict(zones.load_adjacency('NYC_Taxi_Zones.geojson', nyc_taxi_geo))
+        stage['rows_out'] = len(neighbors)
 
     # set up for taxi data
-    taxi_data = fc.taxi_file_setup("sampled_combined_taxi_2018_600k.csv")
-    taxi_data = datetime_conversions(taxi_data, ['tpep_pickup_datetime', 'tpep_dropoff_datetime'],
-                                     '%m/%d/%Y %I:%M:%S %p')
-    taxi_data = add_time_and_speed(taxi_data)
-    taxi_data = removeWeirdTaxiData(taxi_data)
+    with profiling.stage('trip_setup') as stage:
+        taxi_data, removed_trips = prepare_trips("sampled_combined_taxi_2018_600k.csv", neighbors)
+        stage['rows_in'] = len(taxi_data) + sum(removed_trips.values())
+        stage['rows_out'] = len(taxi_data)
+    print(f'Trips removed by each rule: {removed_trips}')
 
-
-    # neighbors and zones
-    nyc_taxi_geo = gpd.read_file('NYC_Taxi_Zones.geojson')
-    neighbors = find_neighbors(nyc_taxi_geo)
-    taxi_data = filter_trips_based_on_zones(taxi_data, neighbors)
+    # compare the trips to the shortest network routes between their zones
+    with profiling.stage('routing', rows_in=len(taxi_data)) as stage:
+        zone_routes = routing.load_zone_routes('NYC_Taxi_Zones.geojson', nyc_geo=nyc_taxi_geo)
+        network_baseline = routing.network_baseline(taxi_data, zone_routes)
+        stage['rows_out'] = len(network_baseline)
+    print(network_baseline.describe())
 
 
     # set up for crash data
-    # crashes = fc.crash_file_setup("2018_crashes.csv", nyc_taxi_geo)
-    crashes = fc.open_file("Crash_zones.csv")
-    crashes = datetime_conversions(crashes, ['CRASH DATE_CRASH TIME'], '%Y-%m-%d %H:%M:%S')
+    with profiling.stage('crash_load') as stage:
+        # crashes = fc.crash_file_setup("2018_crashes.csv", nyc_taxi_geo), or run: python pipeline.py crash_zones
+        crashes = fc.open_file("Crash_zones.parquet")
+        stage['rows_out'] = len(crashes)
 
 
-    clusters_df = c.cluster_crashes(crashes)
-    print(clusters_df.groupby(by=['Date', 'ZONE']).count().sort_values('index_x', ascending=False))
+    with profiling.stage('clustering', rows_in=len(crashes)) as stage:
+        clusters_df = c.cluster_crashes(crashes, plot=plot, figure_path=figure_path('crash_pairs'))
+        print(clusters_df.groupby(by=['Date', 'ZONE']).count().sort_values('index_x', ascending=False))
 
-    clustered = c.cluster_clusters(clusters_df, nyc_taxi_geo)
+        clustered = c.cluster_clusters(clusters_df, nyc_taxi_geo, plot=plot, figure_path=figure_path('clusters'))
+        stage['rows_out'] = len(clustered)
 
-    random_zones = two_random_zones(neighbors)
-    viz.plot_routes_for_random_addresses_in_2_zones(nyc_taxi_geo, random_zones[0], random_zones[1])
+    if plot:
+        with profiling.stage('route_plot'):
+            import Vis as viz
+            random_zones = two_random_zones(neighbors)
+            viz.plot_routes_for_random_addresses_in_2_zones(nyc_taxi_geo, random_zones[0], random_zones[1],
+                                                            figure_path=figure_path('route'))
 
 
     # set up for collision data
-    #closures, closure_zones = fc.closure_file_setup("2018_street_closures.csv", "street_geometries.csv", nyc_taxi_geo)
-    closures = fc.open_file("closures_cleaned.csv")
-    closure_zones = fc.open_file("closure_zones.csv")
-    closures = datetime_conversions(closures, ['WORK_START_DATE', 'WORK_END_DATE'],
-                                    '%Y-%m-%d %H:%M:%S')
-    trips_during_events_avg_time(taxi_data, crashes, closures, closure_zones)
-
-
+    with profiling.stage('closure_load') as stage:
+        #closures, closure_zones = fc.closure_file_setup("2018_street_closures.csv", "street_geometries.csv", nyc_taxi_geo)
+        # or run: python pipeline.py closure_zones
+        closures = fc.open_file("closures_cleaned.parquet")
+        closure_zones = fc.open_file("closure_zones.parquet")
+        stage['rows_out'] = len(closures)
+    with profiling.stage('event_matching', rows_in=len(taxi_data)):
+        matched_trips, passed_event, _ = trips_during_events_avg_time(taxi_data, crashes, closures, closure_zones,
+                                                                      workers=None)
+    with profiling.stage('event_matching_corridors', rows_in=len(taxi_data)):
+        trips_during_events_avg_time(taxi_data, crashes, closures, closure_zones, workers=None, corridors=zone_routes)
+    with profiling.stage('event_effects_by_month', rows_in=len(taxi_data)):
+        # reuses the events matched above, only the strata change
+        print(trip_stats.bootstrap_effects(matched_trips, passed_event, ['month'], workers=None))
+
+    profiling.write_report()
+    print(profiling.summary())
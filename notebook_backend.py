@@ -0,0 +1,202 @@
+import functools
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import main
+import zones
+
+CLUSTERS_PATH = 'clusters.csv'
+TAXI_PATH = 'sampled_combined_taxi_2018_600k.csv'
+ZONES_PATH = 'NYC_Taxi_Zones.geojson'
+COUNT_COLUMN = 'Number of times 2 crashes occured within an hour/day'
+TOP_DAYS = 10
+SPEED_BINS = 60
+# results the widgets keep for the zones shown most recently
+ZONE_CACHE_SIZE = 512
+
+
+def zone_labels(zones: pd.Series, names: dict = None) -> pd.Series:
+    """
+    Turns the ZONE column of the crash files into plain zone names. add_zone_to_crash stores the zone number, older
+    crash files store the zone name in a list, which a csv file keeps as text.
+    :param zones: pandas Series of zones
+    :param names: dictionary mapping zone numbers to zone names. The names of the compiled taxi zones if None, only
+        read when the zones are numbers.
+    :return: pandas Series of zone names
+    >>> zone_labels(pd.Series(["['Astoria']", 'Bronx Park', '["Randalls Island"]'])).tolist()
+    ['Astoria', 'Bronx Park', 'Randalls Island']
+    >>> zone_labels(pd.Series([7, 3]), {3: 'Alphabet City', 7: 'Astoria'}).tolist()
+    ['Astoria', 'Alphabet City']
+    """
+    if pd.api.types.is_numeric_dtype(zones):
+        return zones.map(zone_names() if names is None else names)
+    return zones.astype(str).str.strip('[] ').str.replace(r"^['\"]|['\"]$", '', regex=True)
+
+
+def zone_day_counts(clusters_df: pd.DataFrame) -> dict:
+    """
+    Counts the crash pairs of every zone and day once, so a zone only needs a dictionary lookup.
+    :param clusters_df: pandas dataframe of crash pairs with ZONE and Date columns, like clusters.csv
+    :return: dictionary with zone name as key and a pandas dataframe with the ZONE, Date and count columns of its days,
+        most pairs first, as value
+    >>> pairs = pd.DataFrame({'ZONE': ['a', 'a', 'a', 'b'], 'Date': ['2018-01-02', '2018-01-03', '2018-01-03', '2018-01-02']})
+    >>> zone_day_counts(pairs)['a'][['Date', COUNT_COLUMN]].values.tolist()
+    [['2018-01-03', 2], ['2018-01-02', 1]]
+    """
+    counts = clusters_df.groupby([zone_labels(clusters_df['ZONE']), 'Date']).size().rename(COUNT_COLUMN)
+    counts = counts.reset_index().sort_values(COUNT_COLUMN, ascending=False, kind='stable')
+    return {zone: days.reset_index(drop=True) for zone, days in counts.groupby('ZONE', sort=True)}
+
+
+def speed_histograms(trips_df: pd.DataFrame, zone_names: dict = None, bins: int = SPEED_BINS) -> dict:
+    """
+    Makes the histogram of the average speed of the trips that start or end in every zone once. A trip that starts
+    and ends in the same zone counts twice for it, like the pickup and drop off trips concatenated.
+    :param trips_df: pandas dataframe of taxi trips with PULocationID, DOLocationID and avg speed columns
+    :param zone_names: dictionary mapping zone numbers to the zone names used as keys. Zone numbers are the keys if
+        None. Trips of zones that are not in the dictionary are left out.
+    :param bins: number of bins of every histogram. The bins span the speeds of the zone.
+    :return: dictionary with the zone as key and a tuple of the bin counts and bin edges as value
+    >>> trips = pd.DataFrame({'PULocationID': [4, 4, 7], 'DOLocationID': [7, 4, 9], 'avg speed': [10.0, 20.0, 30.0]})
+    >>> histograms = speed_histograms(trips, bins=2)
+    >>> histograms[4]
+    (array([1, 2]), array([10., 15., 20.]))
+    >>> sorted(speed_histograms(trips, {4: 'a', 7: 'b'}, bins=2))
+    ['a', 'b']
+    """
+    trip_zones = np.concatenate([trips_df['PULocationID'].to_numpy(), trips_df['DOLocationID'].to_numpy()])
+    speeds = np.tile(trips_df['avg speed'].to_numpy(dtype=np.float64), 2)
+    keys = pd.Series(trip_zones).map(zone_names) if zone_names is not None else pd.Series(trip_zones)
+    codes, labels = pd.factorize(keys, sort=True)
+    codes[np.isnan(speeds)] = -1
+
+    # one sort puts the speeds of every zone next to each other
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(labels) + 1))
+    histograms = {}
+    for code, label in enumerate(labels):
+        if bounds[code + 1] > bounds[code]:
+            histograms[label] = np.histogram(speeds[order[bounds[code]:bounds[code + 1]]], bins=bins)
+    return histograms
+
+
+@functools.lru_cache(maxsize=None)
+def cluster_day_counts(clusters_path: str = CLUSTERS_PATH) -> dict:
+    """
+    Reads the zone and date of the crash pairs, without their geometries, and counts them by zone and day.
+    :param clusters_path: path to the crash pairs file
+    :return: dictionary made by zone_day_counts
+    """
+    return zone_day_counts(pd.read_csv(clusters_path, usecols=['ZONE', 'Date']))
+
+
+def cluster_zones(clusters_path: str = CLUSTERS_PATH) -> list:
+    """
+    Lists the zones with crash pairs, for the zone sliders.
+    :param clusters_path: path to the crash pairs file
+    :return: sorted list of zone names
+    """
+    return list(cluster_day_counts(clusters_path))
+
+
+def zone_top_days(zone: str, top: int = TOP_DAYS, clusters_path: str = CLUSTERS_PATH) -> pd.DataFrame:
+    """
+    Finds the days with the most crash pairs in a zone. The days of every zone are counted once by
+    cluster_day_counts, so this is a dictionary lookup.
+    :param zone: zone name
+    :param top: number of days
+    :param clusters_path: path to the crash pairs file
+    :return: pandas dataframe with the ZONE, Date and count columns of the top days. It is a copy, so changing it does
+        not change the cached counts.
+    """
+    days = cluster_day_counts(clusters_path).get(zone)
+    if days is None:
+        return pd.DataFrame(columns=['ZONE', 'Date', COUNT_COLUMN])
+    return days.head(top).copy()
+
+
+@functools.lru_cache(maxsize=None)
+def load_trips(taxi_path: str = TAXI_PATH) -> pd.DataFrame:
+    """
+    Prepares the taxi trips once with main.prepare_trips, without the zone rule.
+    :param taxi_path: path to the taxi trips file
+    :return: pandas dataframe of the cleaned trips. Do not change it, it is shared by later calls.
+    """
+    return main.prepare_trips(taxi_path)[0]
+
+
+@functools.lru_cache(maxsize=None)
+def zone_names(zones_path: str = ZONES_PATH) -> dict:
+    """
+    Reads the names of the taxi zones from the compiled zones.
+    :param zones_path: path to the taxi zones file
+    :return: dictionary with zone number as key and zone name as value
+    """
+    asset = zones.load_zone_asset(zones_path)
+    return dict(zip(asset.zone_ids.tolist(), asset.names.tolist()))
+
+
+@functools.lru_cache(maxsize=None)
+def zone_speed_histograms(taxi_path: str = TAXI_PATH, zones_path: str = ZONES_PATH, bins: int = SPEED_BINS) -> dict:
+    """
+    Makes the speed histograms of all zones once, keyed by zone name like the crash pair zones.
+    :param taxi_path: path to the taxi trips file
+    :param zones_path: path to the taxi zones file
+    :param bins: number of bins of every histogram
+    :return: dictionary made by speed_histograms
+    """
+    return speed_histograms(load_trips(taxi_path), zone_names(zones_path), bins)
+
+
+@functools.lru_cache(maxsize=ZONE_CACHE_SIZE)
+def zone_speed_histogram(zone: str, taxi_path: str = TAXI_PATH, zones_path: str = ZONES_PATH,
+                         bins: int = SPEED_BINS) -> tuple:
+    """
+    Finds the speed histogram of a zone.
+    :param zone: zone name
+    :param taxi_path: path to the taxi trips file
+    :param zones_path: path to the taxi zones file
+    :param bins: number of bins of the histogram
+    :return: tuple of the bin counts and bin edges. Both are empty if no trip starts or ends in the zone.
+    """
+    return zone_speed_histograms(taxi_path, zones_path, bins).get(zone, (np.array([], dtype=np.int64),
+                                                                         np.array([0.0])))
+
+
+@functools.lru_cache(maxsize=None)
+def cluster_points(clusters_path: str = CLUSTERS_PATH) -> gpd.GeoDataFrame:
+    """
+    Reads the locations of the crash pairs. Only called when a map is drawn, so the other widgets never parse the
+    geometries.
+    :param clusters_path: path to the crash pairs file
+    :return: GeoDataFrame with the zone name of every crash pair and the location of its first crash
+    """
+    pairs = pd.read_csv(clusters_path, usecols=['ZONE', 'geometry_x'])
+    return gpd.GeoDataFrame({'ZONE': zone_labels(pairs['ZONE'])},
+                            geometry=shapely.from_wkt(pairs['geometry_x'].to_numpy(), on_invalid='ignore'),
+                            crs='epsg:4326')
+
+
+@functools.lru_cache(maxsize=None)
+def zone_shapes(zones_path: str = ZONES_PATH) -> gpd.GeoDataFrame:
+    """
+    Reads the simplified taxi zone boundaries. Only called when a map is drawn.
+    :param zones_path: path to the taxi zones file
+    :return: GeoDataFrame of the taxi zones
+    """
+    return zones.read_zones(zones_path, simplified=True)
+
+
+@functools.lru_cache(maxsize=ZONE_CACHE_SIZE)
+def zone_map_data(zone: str, clusters_path: str = CLUSTERS_PATH, zones_path: str = ZONES_PATH) -> tuple:
+    """
+    Finds the boundary and crash pair locations of a zone.
+    :param zone: zone name
+    :param clusters_path: path to the crash pairs file
+    :param zones_path: path to the taxi zones file
+    :return: tuple of the GeoDataFrame of the zone boundary and the GeoDataFrame of its crash pairs
+    """
+    shapes = zone_shapes(zones_path)
+    points = cluster_points(clusters_path)
+    return shapes[shapes['zone'] == zone], points[points['ZONE'] == zone]
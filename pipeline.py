@@ -0,0 +1,419 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import NamedTuple
+import numpy as np
+import pandas as pd
+import File_creation as fc
+import event_cube
+import routing
+import zones
+
+STATE_PATH = '.pipeline_state.json'
+ZONES_PATH = 'NYC_Taxi_Zones.geojson'
+# monthly taxi files are named Yellow_Taxi_Trip_Data_<month>_<year>.csv
+TAXI_FILE = re.compile(r'Yellow_Taxi_Trip_Data_(\d+)_(\d{4})\.csv$')
+
+
+class Stage(NamedTuple):
+    """
+    One step of the pipeline. The stage runs function(**kwargs), which reads the inputs and writes the outputs.
+    A stage depends on the stages that write its inputs.
+    """
+    name: str
+    function: callable
+    inputs: tuple
+    outputs: tuple
+    kwargs: dict = {}
+    # format of the outputs. A stage whose version changed reruns like one whose parameters changed.
+    version: int = 0
+
+
+def path_hash(path: str, files: dict) -> str:
+    """
+    Hashes the content of a file, or of all files in a directory. The hash of a file is reused while its size and
+    modification time stay the same, so unchanged inputs are not read again.
+    :param path: path to a file or directory
+    :param files: dictionary with path as key and [size, modification time, hash] as value. Updated with new hashes.
+    :return: sha1 hex digest. None if the path does not exist.
+    """
+    if os.path.isdir(path):
+        digest = hashlib.sha1()
+        for root, _, names in sorted(os.walk(path)):
+            for name in sorted(names):
+                file_path = os.path.join(root, name)
+                digest.update(os.path.relpath(file_path, path).encode())
+                digest.update(path_hash(file_path, files).encode())
+        return digest.hexdigest()
+    if not os.path.exists(path):
+        return None
+
+    status = os.stat(path)
+    known = files.get(path)
+    if known is not None and known[:2] == [status.st_size, status.st_mtime_ns]:
+        return known[2]
+    content_hash = zones.file_hash(path)
+    files[path] = [status.st_size, status.st_mtime_ns, content_hash]
+    return content_hash
+
+
+def params_hash(stage: Stage) -> str:
+    """
+    Hashes the function, keyword arguments and version of a stage, so a stage reruns when its parameters change.
+    :param stage: Stage
+    :return: sha1 hex digest
+    """
+    params = {'function': stage.function.__name__, 'kwargs': stage.kwargs}
+    if stage.version:
+        params['version'] = stage.version
+    params = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(params.encode()).hexdigest()
+
+
+def load_state(state_path: str = STATE_PATH) -> dict:
+    """
+    Loads the fingerprints of the last successful run of every stage.
+    :param state_path: path of the state file
+    :return: dictionary with the known file hashes under 'files' and the stage fingerprints under 'stages'
+    """
+    if os.path.exists(state_path):
+        with open(state_path) as file:
+            return json.load(file)
+    return {'files': {}, 'stages': {}}
+
+
+def save_state(state: dict, state_path: str = STATE_PATH):
+    """
+    Saves the state file. It is written to a temporary file first, so an interrupted run never leaves a broken state.
+    :param state: dictionary made by load_state
+    :param state_path: path of the state file
+    """
+    with open(state_path + '.tmp', 'w') as file:
+        json.dump(state, file, indent=2, sort_keys=True)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def stale_reason(stage: Stage, state: dict, input_hashes: dict) -> str:
+    """
+    Finds why a stage has to run.
+    :param stage: Stage
+    :param state: dictionary made by load_state
+    :param input_hashes: dictionary with the current hash of every input of the stage
+    :return: the reason the stage is out of date. None if its outputs are up to date.
+    """
+    record = state['stages'].get(stage.name)
+    if record is None:
+        return 'never run'
+    if record['params'] != params_hash(stage):
+        return 'parameters changed'
+    for path, content_hash in input_hashes.items():
+        if record['inputs'].get(path) != content_hash:
+            return f'input changed: {path}'
+    if set(record['inputs']) != set(input_hashes):
+        return 'inputs changed'
+    for path in stage.outputs:
+        if record['outputs'].get(path) != path_hash(path, state['files']):
+            return f'output missing or changed: {path}'
+    return None
+
+
+def select_stages(stages: list, targets: list = None) -> list:
+    """
+    Orders the stages so every stage comes after the stages it depends on, and keeps only the targets and the stages
+    they depend on.
+    :param stages: list of Stage
+    :param targets: names of the stages to run. All stages if None.
+    :return: list of Stage in dependency order
+    >>> first = Stage('first', print, (), ('a.csv',))
+    >>> second = Stage('second', print, ('a.csv',), ('b.csv',))
+    >>> other = Stage('other', print, (), ('c.csv',))
+    >>> [stage.name for stage in select_stages([second, other, first], ['second'])]
+    ['first', 'second']
+    """
+    by_name = {stage.name: stage for stage in stages}
+    producers = {output: stage.name for stage in stages for output in stage.outputs}
+    unknown = set(targets or []) - set(by_name)
+    if unknown:
+        raise ValueError(f'Unknown stages: {sorted(unknown)}. Stages are {list(by_name)}.')
+
+    ordered, visiting, done = [], set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f'The stages depending on {name} form a cycle.')
+        visiting.add(name)
+        for path in by_name[name].inputs:
+            if path in producers:
+                visit(producers[path])
+        visiting.discard(name)
+        done.add(name)
+        ordered.append(by_name[name])
+
+    for name in targets or by_name:
+        visit(name)
+    return ordered
+
+
+def run_pipeline(stages: list, targets: list = None, workers: int = None, force: list = (), dry_run: bool = False,
+                 state_path: str = STATE_PATH) -> dict:
+    """
+    Runs the stages that are out of date. A stage is up to date if its parameters, the content of its inputs and the
+    content of its outputs are the same as after its last successful run. Stages whose dependencies are finished run
+    at the same time in a process pool.
+    :param stages: list of Stage
+    :param targets: names of the stages to bring up to date, with the stages they depend on. All stages if None.
+    :param workers: number of stages run at the same time. Uses all cores if None and runs in this process if 1.
+    :param force: names of stages to run even if they are up to date
+    :param dry_run: only report which stages would run
+    :param state_path: path of the state file
+    :return: dictionary with the name of every selected stage as key and its result as value: 'up to date', 'ran',
+        'would run', 'failed' or 'blocked' (a stage it depends on failed)
+    """
+    stages = select_stages(stages, targets)
+    producers = {output: stage.name for stage in stages for output in stage.outputs}
+    upstream = {stage.name: {producers[path] for path in stage.inputs if path in producers} for stage in stages}
+    state = load_state(state_path)
+    results = {}
+    pending = list(stages)
+    running = {}
+    workers = os.cpu_count() if workers is None else workers
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 and not dry_run else None
+
+    try:
+        while pending or running:
+            for stage in list(pending):
+                if any(name not in results for name in upstream[stage.name]):
+                    continue
+                pending.remove(stage)
+                if any(results[name] in ('failed', 'blocked') for name in upstream[stage.name]):
+                    results[stage.name] = 'blocked'
+                    print(f'{stage.name}: blocked')
+                    continue
+
+                input_hashes = {path: path_hash(path, state['files']) for path in stage.inputs}
+                missing = [path for path, content_hash in input_hashes.items() if content_hash is None]
+                if any(results[name] == 'would run' for name in upstream[stage.name]):
+                    reason = 'upstream would run'
+                elif missing and not dry_run:
+                    results[stage.name] = 'failed'
+                    print(f'{stage.name}: failed, missing inputs {missing}')
+                    continue
+                elif stage.name in force:
+                    reason = 'forced'
+                else:
+                    reason = stale_reason(stage, state, input_hashes)
+                if reason is None:
+                    results[stage.name] = 'up to date'
+                    print(f'{stage.name}: up to date')
+                    continue
+                if dry_run:
+                    results[stage.name] = 'would run'
+                    print(f'{stage.name}: would run ({reason})')
+                    continue
+
+                print(f'{stage.name}: running ({reason})')
+                if executor is None:
+                    future = Future()
+                    try:
+                        future.set_result(stage.function(**stage.kwargs))
+                    except Exception as error:
+                        future.set_exception(error)
+                else:
+                    future = executor.submit(stage.function, **stage.kwargs)
+                running[future] = (stage, input_hashes)
+
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, input_hashes = running.pop(future)
+                error = future.exception()
+                missing = [path for path in stage.outputs if not os.path.exists(path)]
+                if error is not None or missing:
+                    results[stage.name] = 'failed'
+                    print(f'{stage.name}: failed, {error!r}' if error is not None else
+                          f'{stage.name}: failed, outputs not written {missing}')
+                    continue
+                # the inputs are recorded as they were when the stage started, so a change during the run reruns it
+                state['stages'][stage.name] = {'params': params_hash(stage), 'inputs': input_hashes,
+                                               'outputs': {path: path_hash(path, state['files'])
+                                                           for path in stage.outputs}}
+                save_state(state, state_path)
+                results[stage.name] = 'ran'
+                print(f'{stage.name}: done')
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if not dry_run:
+            save_state(state, state_path)
+    return results
+
+
+def build_adjacency(zones_path: str):
+    """
+    Stage function: saves the neighbors of the taxi zones next to the zones file.
+    """
+    zones.load_adjacency(zones_path)
+
+
+def build_street_geometries(save_path: str):
+    """
+    Stage function: saves the street geometries of the road network.
+    """
+    fc.street_geometries(save_path)
+
+
+def build_zone_routes(zones_path: str, cache_dir: str, save_path: str):
+    """
+    Stage function: saves the shortest routes between the taxi zones.
+    """
+    routing.load_zone_routes(zones_path, save_path, cache_dir, workers=1)
+
+
+def build_crash_zones(crashes_path: str, zones_path: str):
+    """
+    Stage function: cleans the crash file and saves the crashes with their zone as Crash_zones.parquet.
+    """
+    fc.crash_file_setup(crashes_path, zones.read_zones(zones_path))
+
+
+def build_closure_zones(closures_path: str, streets_path: str, zones_path: str):
+    """
+    Stage function: cleans the closure file and saves closures_cleaned.parquet and closure_zones.parquet.
+    """
+    fc.closure_file_setup(closures_path, streets_path, zones.read_zones(zones_path))
+
+
+def build_event_cube(zones_path: str, crashes_path: str, closures_path: str, closure_zones_path: str,
+                     save_path: str):
+    """
+    Stage function: saves the zone and time event cube of the crashes and road closures. Uses the loader of
+    event_cube.py, so the cube records the hash of its sources and later loads do not build it again.
+    """
+    event_cube.load_event_cube(save_path, crashes_path, closures_path, closure_zones_path,
+                               zone_numbers=event_cube.zone_number_map(zones.read_zones(zones_path)))
+
+
+def sample_taxi_file(taxi_path: str, save_path: str, month: int, sample_size: int, seed: int):
+    """
+    Stage function: samples one monthly taxi file. The seed of every month is the one combine_taxi_dfs gives it, so
+    the samples are the same as sampling all months at once.
+    """
+    month_seed = np.random.SeedSequence(seed).spawn(month)[month - 1]
+    os.makedirs(os.path.dirname(save_path) or '.', exist_ok=True)
+    fc.save_file(fc.sample_taxi_month(taxi_path, sample_size, month_seed), save_path)
+
+
+def combine_taxi_samples(sample_paths: list, save_path: str):
+    """
+    Stage function: combines the monthly taxi samples into one csv file, like combine_taxi_dfs.
+    """
+    samples = pd.concat([fc.open_file(path).set_index('Unnamed: 0') for path in sample_paths])
+    samples.index.name = None
+    samples.to_csv(save_path)
+
+
+def count_trip_events(taxi_path: str, zones_path: str, crashes_path: str, closures_path: str,
+                      closure_zones_path: str, save_path: str):
+    """
+    Stage function: prepares the sampled trips and saves the number of crashes and road closures during every trip.
+    """
+    import main
+    neighbors = zones.neighbor_dict(zones.load_adjacency(zones_path))
+    trips, _ = main.prepare_trips(taxi_path, neighbors)
+    event_counts = fc.event_counts_during_trips(trips, fc.open_file(crashes_path), fc.open_file(closures_path),
+                                                fc.open_file(closure_zones_path))
+    fc.save_file(event_counts.reset_index(), save_path)
+
+
+def build_stages(taxi_dir: str = 'taxi', sample_size: int = 50000, seed: int = 0, zones_path: str = ZONES_PATH,
+                 cache_dir: str = 'cache', crashes_path: str = '2018_crashes.csv',
+                 closures_path: str = '2018_street_closures.csv',
+                 taxi_path: str = 'sampled_combined_taxi_2018_600k.csv') -> list:
+    """
+    Declares the stages of the pipeline with their inputs and outputs. Every monthly taxi file in taxi_dir gets its
+    own sampling stage, so adding a month only samples that month again.
+    :param taxi_dir: directory with the monthly taxi files
+    :param sample_size: number of trips sampled from every month
+    :param seed: seed of the taxi samples
+    :param zones_path: path to the taxi zones file
+    :param cache_dir: directory with the osmnx cache
+    :param crashes_path: path to the crash file
+    :param closures_path: path to the street closures file
+    :param taxi_path: path of the combined taxi sample
+    :return: list of Stage
+    """
+    adjacency_path = os.path.splitext(zones_path)[0] + '.adjacency.npz'
+    stages = [
+        Stage('adjacency', build_adjacency, (zones_path,), (adjacency_path,), {'zones_path': zones_path}),
+        Stage('street_geometries', build_street_geometries, (cache_dir,), ('street_geometries.parquet',),
+              {'save_path': 'street_geometries.parquet'}),
+        Stage('zone_routes', build_zone_routes, (zones_path, cache_dir), ('zone_routes.npz',),
+              {'zones_path': zones_path, 'cache_dir': cache_dir, 'save_path': 'zone_routes.npz'}),
+        Stage('crash_zones', build_crash_zones, (crashes_path, zones_path), ('Crash_zones.parquet',),
+              {'crashes_path': crashes_path, 'zones_path': zones_path}, fc.ZONE_FILE_VERSION),
+        Stage('closure_zones', build_closure_zones, (closures_path, 'street_geometries.parquet', zones_path),
+              ('closures_cleaned.parquet', 'closure_zones.parquet'),
+              {'closures_path': closures_path, 'streets_path': 'street_geometries.parquet', 'zones_path': zones_path},
+              fc.ZONE_FILE_VERSION),
+        Stage('event_cube', build_event_cube,
+              (zones_path, 'Crash_zones.parquet', 'closures_cleaned.parquet', 'closure_zones.parquet'), ('event_cube',),
+              {'zones_path': zones_path, 'crashes_path': 'Crash_zones.parquet',
+               'closures_path': 'closures_cleaned.parquet', 'closure_zones_path': 'closure_zones.parquet',
+               'save_path': 'event_cube'}),
+    ]
+
+    sample_paths = []
+    for path in sorted(glob.glob(os.path.join(taxi_dir, '*.csv'))):
+        match = TAXI_FILE.search(path)
+        if match is None:
+            continue
+        month, year = int(match.group(1)), int(match.group(2))
+        sample_path = os.path.join(taxi_dir, 'samples', f'{year}_{month:02d}.parquet')
+        sample_paths.append(sample_path)
+        stages.append(Stage(f'taxi_{year}_{month:02d}', sample_taxi_file, (path,), (sample_path,),
+                            {'taxi_path': path, 'save_path': sample_path, 'month': month, 'sample_size': sample_size,
+                             'seed': seed}))
+    if sample_paths:
+        stages.append(Stage('taxi_sample', combine_taxi_samples, tuple(sample_paths), (taxi_path,),
+                            {'sample_paths': sample_paths, 'save_path': taxi_path}))
+
+    stages.append(Stage('trip_events', count_trip_events,
+                        (taxi_path, adjacency_path, 'Crash_zones.parquet', 'closures_cleaned.parquet',
+                         'closure_zones.parquet'), ('trip_event_counts.parquet',),
+                        {'taxi_path': taxi_path, 'zones_path': zones_path, 'crashes_path': 'Crash_zones.parquet',
+                         'closures_path': 'closures_cleaned.parquet', 'closure_zones_path': 'closure_zones.parquet',
+                         'save_path': 'trip_event_counts.parquet'}))
+    return stages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Brings the pipeline files up to date, running only the stages whose '
+                                                 'inputs or parameters changed.')
+    parser.add_argument('targets', nargs='*', help='stages to bring up to date. All stages if none are given')
+    parser.add_argument('--workers', type=int, help='number of stages run at the same time. All cores by default')
+    parser.add_argument('--force', nargs='+', default=[], help='stages to run even if they are up to date')
+    parser.add_argument('--dry-run', action='store_true', help='only show which stages would run')
+    parser.add_argument('--list', action='store_true', help='list the stages with their inputs and outputs')
+    parser.add_argument('--taxi-dir', default='taxi', help='directory with the monthly taxi files')
+    parser.add_argument('--sample-size', type=int, default=50000, help='number of trips sampled from every month')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the taxi samples')
+    parser.add_argument('--state', default=STATE_PATH, help='path of the state file')
+    args = parser.parse_args()
+
+    pipeline_stages = build_stages(args.taxi_dir, args.sample_size, args.seed)
+    if args.list:
+        for pipeline_stage in select_stages(pipeline_stages, args.targets or None):
+            print(f'{pipeline_stage.name}: {list(pipeline_stage.inputs)} -> {list(pipeline_stage.outputs)}')
+        sys.exit()
+
+    stage_results = run_pipeline(pipeline_stages, args.targets or None, args.workers, args.force, args.dry_run,
+                                 args.state)
+    sys.exit(1 if any(result in ('failed', 'blocked') for result in stage_results.values()) else 0)
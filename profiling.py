@@ -0,0 +1,263 @@
+import cProfile
+import collections
+import contextlib
+import functools
+import json
+import os
+import platform
+import pstats
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:     # not available on Windows
+    resource = None
+
+# PIPELINE_PROFILE=cprofile or sample turns on a profiler for every stage, or for the stages named in
+# PIPELINE_PROFILE_STAGES (comma separated)
+PROFILE_ENV = 'PIPELINE_PROFILE'
+PROFILE_STAGES_ENV = 'PIPELINE_PROFILE_STAGES'
+PROFILE_DIR_ENV = 'PIPELINE_PROFILE_DIR'
+SAMPLE_INTERVAL_ENV = 'PIPELINE_SAMPLE_INTERVAL'
+REPORT_ENV = 'PIPELINE_REPORT'
+TOP_FUNCTIONS = 15
+
+# measurements of the stages run in this process, in the order they finished
+records = []
+run_start = time.perf_counter()
+
+
+def current_rss_mb() -> float:
+    """
+    Reads the resident memory of this process.
+    :return: resident memory in MiB. None if it cannot be read on this platform.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_mb() -> float:
+    """
+    Reads the highest resident memory of this process so far.
+    :return: peak resident memory in MiB. None if it cannot be read on this platform.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def row_count(value) -> int:
+    """
+    Counts the rows of a stage input or output.
+    :param value: dataframe, array, list or dictionary. The first element counts for a tuple.
+    :return: number of rows. None for values without rows.
+    >>> row_count([1, 2, 3]), row_count(({'a': 1}, 'removed')), row_count('trips.csv')
+    (3, 1, None)
+    """
+    if isinstance(value, tuple):
+        return row_count(value[0]) if value else None
+    if isinstance(value, (str, bytes)) or not hasattr(value, '__len__'):
+        return None
+    return len(value)
+
+
+def profile_mode(stage_name: str) -> str:
+    """
+    Finds the profiler the environment asks for a stage.
+    :param stage_name: name of the stage
+    :return: 'cprofile', 'sample' or None
+    """
+    mode = os.environ.get(PROFILE_ENV, '').strip().lower()
+    if mode not in ('cprofile', 'sample'):
+        return None
+    stages = os.environ.get(PROFILE_STAGES_ENV)
+    if stages and stage_name not in {name.strip() for name in stages.split(',')}:
+        return None
+    return mode
+
+
+def sample_stack(thread_id: int, stop: threading.Event, interval: float, self_counts: collections.Counter,
+                 total_counts: collections.Counter):
+    """
+    Samples the call stack of a thread until stop is set. Used by a sampling thread of stage.
+    :param thread_id: id of the thread to sample
+    :param stop: event that ends the sampling
+    :param interval: seconds between samples
+    :param self_counts: counter of the samples in which a function was running
+    :param total_counts: counter of the samples in which a function was on the stack
+    """
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            continue
+        self_counts[function_label(frame.f_code)] += 1
+        on_stack = set()
+        while frame is not None:
+            on_stack.add(function_label(frame.f_code))
+            frame = frame.f_back
+        total_counts.update(on_stack)
+
+
+def function_label(code) -> str:
+    """
+    Names a function for the profiles.
+    :param code: code object of the function
+    :return: string with the file, first line and name of the function
+    """
+    return f'{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})'
+
+
+def top_cprofile_functions(profiler: cProfile.Profile) -> list:
+    """
+    Lists the functions with the most cumulative time in a cProfile run.
+    :param profiler: finished cProfile profiler
+    :return: list of dictionaries with the function, number of calls, own seconds and cumulative seconds
+    """
+    stats = pstats.Stats(profiler).stats
+    rows = [{'function': f'{os.path.basename(file)}:{line}({name})', 'calls': calls, 'seconds': own,
+             'cumulative_seconds': cumulative}
+            for (file, line, name), (_, calls, own, cumulative, _) in stats.items()]
+    return sorted(rows, key=lambda row: row['cumulative_seconds'], reverse=True)[:TOP_FUNCTIONS]
+
+
+@contextlib.contextmanager
+def stage(name: str, rows_in: int = None):
+    """
+    Measures one pipeline stage: its time, resident memory and rows in and out. The measurements are added to records
+    when the stage ends, also when it raises. Set rows_out (or rows_in) on the yielded dictionary inside the block.
+    A cProfile or sampling profile of the stage is added when the PIPELINE_PROFILE environment variable asks for it.
+    :param name: name of the stage
+    :param rows_in: number of input rows
+    :return: dictionary with the measurements of the stage
+    >>> with stage('double', rows_in=3) as record:
+    ...     record['rows_out'] = len([2, 4, 6])
+    >>> records[-1]['stage'], records[-1]['rows_in'], records[-1]['rows_out'], records[-1]['seconds'] >= 0
+    ('double', 3, 3, True)
+    """
+    record = {'stage': name, 'rows_in': rows_in, 'rows_out': None, 'seconds': None, 'rss_start_mb': current_rss_mb()}
+    mode = profile_mode(name)
+    profiler, sampler = None, None
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+    elif mode == 'sample':
+        stop = threading.Event()
+        self_counts, total_counts = collections.Counter(), collections.Counter()
+        interval = float(os.environ.get(SAMPLE_INTERVAL_ENV, 0.005))
+        sampler = threading.Thread(target=sample_stack, daemon=True,
+                                   args=(threading.get_ident(), stop, interval, self_counts, total_counts))
+
+    peak_start = peak_rss_mb()
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    if sampler is not None:
+        sampler.start()
+    try:
+        yield record
+    except BaseException as error:
+        record['error'] = repr(error)
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if sampler is not None:
+            stop.set()
+            sampler.join()
+        record['seconds'] = time.perf_counter() - start
+        record['rss_end_mb'] = current_rss_mb()
+        record['peak_rss_mb'] = peak_rss_mb()
+        record['peak_rss_growth_mb'] = (record['peak_rss_mb'] - peak_start) if peak_start is not None else None
+        if record['rows_in'] is not None and record['seconds']:
+            record['rows_per_s'] = record['rows_in'] / record['seconds']
+
+        if profiler is not None:
+            profile_dir = os.environ.get(PROFILE_DIR_ENV, 'profiles')
+            os.makedirs(profile_dir, exist_ok=True)
+            record['profile_path'] = os.path.join(profile_dir, f'{name}.prof')
+            profiler.dump_stats(record['profile_path'])
+            record['profile'] = top_cprofile_functions(profiler)
+        if sampler is not None:
+            samples = sum(self_counts.values())
+            record['samples'] = samples
+            record['profile'] = [{'function': function, 'self_samples': count,
+                                  'total_samples': total_counts[function], 'self_share': count / samples}
+                                 for function, count in self_counts.most_common(TOP_FUNCTIONS)]
+        records.append(record)
+
+
+def profiled(name: str = None):
+    """
+    Decorator that runs a function as a stage. The rows of its first argument are the rows in, and the rows of its
+    result the rows out.
+    :param name: name of the stage. The function name if None.
+    :return: decorator
+    >>> @profiled()
+    ... def evens(values):
+    ...     return [value for value in values if value % 2 == 0]
+    >>> evens(range(10))
+    [0, 2, 4, 6, 8]
+    >>> records[-1]['stage'], records[-1]['rows_in'], records[-1]['rows_out']
+    ('evens', 10, 5)
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name or function.__name__, row_count(args[0]) if args else None) as record:
+                result = function(*args, **kwargs)
+                record['rows_out'] = row_count(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def git_commit() -> dict:
+    """
+    Finds the commit of the working tree, so run reports and benchmark results can be traced to the code that made
+    them.
+    :return: dictionary with the commit hash (None outside a git repository) and whether there are uncommitted changes
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                                text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+    return {'commit': commit, 'dirty': bool(status.strip())}
+
+
+def write_report(path: str = None) -> dict:
+    """
+    Writes the measurements of all stages of this run as JSON.
+    :param path: path of the report. The PIPELINE_REPORT environment variable or run_report.json if None.
+    :return: dictionary with the report
+    """
+    path = path or os.environ.get(REPORT_ENV, 'run_report.json')
+    report = {**git_commit(), 'created': datetime.now().isoformat(timespec='seconds'), 'argv': sys.argv,
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'total_seconds': time.perf_counter() - run_start, 'peak_rss_mb': peak_rss_mb(), 'stages': records}
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2, default=str)
+    return report
+
+
+def summary() -> str:
+    """
+    Formats the time, memory and rows of every stage as a table.
+    :return: string with one line per stage
+    """
+    lines = [f"{'stage':<32}{'seconds':>10}{'peak MiB':>10}{'rows in':>12}{'rows out':>12}"]
+    for record in records:
+        peak = record['peak_rss_mb']
+        lines.append(f"{record['stage']:<32}{record['seconds']:>10.2f}{peak if peak is not None else float('nan'):>10.0f}"
+                     f"{record['rows_in'] if record['rows_in'] is not None else '':>12}"
+                     f"{record['rows_out'] if record['rows_out'] is not None else '':>12}")
+    return '\n'.join(lines)
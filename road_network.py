@@ -0,0 +1,331 @@
+import glob
+import hashlib
+import heapq
+import json
+import os
+import re
+from typing import NamedTuple
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import zones
+
+# bump when the saved arrays change so older network files are rebuilt
+STORE_VERSION = 2
+
+# bounds of the taxi zones (west, south, east, north)
+NYC_BOUNDS = (-74.26, 40.49, -73.69, 40.92)
+
+# the highway values, access values and services osmnx leaves out of a drive network
+EXCLUDED_HIGHWAYS = {'abandoned', 'bridleway', 'bus_guideway', 'construction', 'corridor', 'cycleway', 'elevator',
+                     'escalator', 'footway', 'no', 'path', 'pedestrian', 'planned', 'platform', 'proposed', 'raceway',
+                     'razed', 'rest_area', 'service', 'services', 'steps', 'track'}
+EXCLUDED_SERVICES = {'alley', 'driveway', 'emergency_access', 'parking', 'parking_aisle', 'private'}
+
+EARTH_RADIUS_M = 6371009
+KPH_PER_MPH = 1.609344
+
+# speeds in kph for ways without a maxspeed tag
+DEFAULT_SPEEDS = {'motorway': 80, 'motorway_link': 50, 'trunk': 65, 'trunk_link': 45, 'primary': 50,
+                  'primary_link': 40, 'secondary': 40, 'secondary_link': 35, 'tertiary': 35, 'tertiary_link': 30,
+                  'unclassified': 30, 'residential': 30, 'living_street': 15}
+FALLBACK_SPEED = 40
+
+
+class RoadNetwork(NamedTuple):
+    """
+    NYC drive network as compressed sparse row (CSR) arrays. Nodes are numbered by their position in node_ids. The
+    edges leaving node n are indptr[n]:indptr[n + 1], going to the nodes in indices and with the lengths in meters in
+    lengths. Edge speeds are in kph. Every OSM way is kept as a sequence of nodes, way_nodes[way_indptr[w]:way_indptr[w + 1]], for the street
+    geometries. Street names are codes into names.
+    """
+    node_ids: np.ndarray
+    lon: np.ndarray
+    lat: np.ndarray
+    indptr: np.ndarray
+    indices: np.ndarray
+    lengths: np.ndarray
+    speeds: np.ndarray
+    edge_names: np.ndarray
+    way_indptr: np.ndarray
+    way_nodes: np.ndarray
+    way_names: np.ndarray
+    names: np.ndarray
+
+
+def is_drivable(tags: dict) -> bool:
+    """
+    Checks if an OSM way is part of the drive network, with the same tag filter osmnx uses for network_type='drive'.
+    :param tags: tags of the OSM way
+    :return: True if the way is a public drivable street
+    >>> is_drivable({'highway': 'residential'}), is_drivable({'highway': 'footway'})
+    (True, False)
+    >>> is_drivable({'highway': 'residential', 'access': 'private'})
+    False
+    """
+    return ('highway' in tags and tags['highway'] not in EXCLUDED_HIGHWAYS and tags.get('area') != 'yes' and
+            'private' not in tags.get('access', '') and tags.get('motor_vehicle') != 'no' and
+            tags.get('motorcar') != 'no' and tags.get('service') not in EXCLUDED_SERVICES)
+
+
+def way_direction(tags: dict) -> int:
+    """
+    Finds the directions a car can drive along an OSM way.
+    :param tags: tags of the OSM way
+    :return: 1 for one way in node order, -1 for one way against node order, 0 for both ways
+    >>> way_direction({'oneway': 'yes'}), way_direction({'oneway': '-1'}), way_direction({'highway': 'residential'})
+    (1, -1, 0)
+    """
+    oneway = tags.get('oneway')
+    if oneway in ('-1', 'reverse'):
+        return -1
+    if oneway in ('yes', 'true', '1') or tags.get('junction') == 'roundabout' or (
+            tags.get('highway') == 'motorway' and oneway != 'no'):
+        return 1
+    return 0
+
+
+def way_speed(tags: dict) -> float:
+    """
+    Finds the speed limit of an OSM way, from its maxspeed tag or from the default speed of its highway type.
+    :param tags: tags of the OSM way
+    :return: speed in kph
+    >>> way_speed({'highway': 'residential', 'maxspeed': '25 mph'}), way_speed({'highway': 'primary'})
+    (40.2336, 50)
+    """
+    maxspeed = tags.get('maxspeed', '').split(';')[0].strip()
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*(mph)?', maxspeed)
+    if match:
+        return float(match.group(1)) * (KPH_PER_MPH if match.group(2) else 1)
+    return DEFAULT_SPEEDS.get(tags.get('highway'), FALLBACK_SPEED)
+
+
+def haversine(lon1, lat1, lon2, lat2) -> np.ndarray:
+    """
+    Great-circle distance between points in meters.
+    :return: numpy array of distances in meters
+    """
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def cache_hash(cache_dir: str) -> str:
+    """
+    Hashes the content of the cached Overpass responses and the store version.
+    :param cache_dir: directory with the osmnx cache
+    :return: sha1 hex digest
+    """
+    digest = hashlib.sha1(str(STORE_VERSION).encode())
+    for path in sorted(glob.glob(os.path.join(cache_dir, '*.json'))):
+        digest.update(zones.file_hash(path).encode())
+    return digest.hexdigest()
+
+
+def read_overpass_cache(cache_dir: str, bounds: tuple = NYC_BOUNDS) -> tuple:
+    """
+    Reads the nodes and drivable ways of the Overpass responses cached by osmnx.
+    :param cache_dir: directory with the osmnx cache
+    :param bounds: (west, south, east, north). Ways without a node inside the bounds are left out.
+    :return: tuple of a dictionary from node id to (lon, lat) and a dictionary from way id to (node ids, tags)
+    """
+    nodes, ways = {}, {}
+    for path in sorted(glob.glob(os.path.join(cache_dir, '*.json'))):
+        with open(path) as file:
+            response = json.load(file)
+        # the cache also holds geocoder responses, which are lists
+        if not isinstance(response, dict):
+            continue
+        for element in response.get('elements', []):
+            if element['type'] == 'node':
+                nodes[element['id']] = (element['lon'], element['lat'])
+            elif element['type'] == 'way' and is_drivable(element.get('tags', {})):
+                ways[element['id']] = (element['nodes'], element['tags'])
+
+    west, south, east, north = bounds
+    kept_ways = {}
+    for way_id, (way_nodes, tags) in ways.items():
+        if len(way_nodes) < 2 or not all(node in nodes for node in way_nodes):
+            continue
+        if any(west <= nodes[node][0] <= east and south <= nodes[node][1] <= north for node in way_nodes):
+            kept_ways[way_id] = (way_nodes, tags)
+    return nodes, kept_ways
+
+
+def build_network(cache_dir: str = 'cache', bounds: tuple = NYC_BOUNDS) -> RoadNetwork:
+    """
+    Builds the drive network from the Overpass responses cached by osmnx, without network access.
+    :param cache_dir: directory with the osmnx cache
+    :param bounds: (west, south, east, north) of the network
+    :return: RoadNetwork
+    """
+    nodes, ways = read_overpass_cache(cache_dir, bounds)
+    way_node_ids = [np.array(way_nodes, dtype=np.int64) for way_nodes, tags in ways.values()]
+    node_ids = np.unique(np.concatenate(way_node_ids)) if way_node_ids else np.array([], dtype=np.int64)
+    coordinates = np.array([nodes[node] for node in node_ids.tolist()], dtype=np.float64).reshape(-1, 2)
+    lon, lat = coordinates[:, 0], coordinates[:, 1]
+
+    name_codes, names = pd.factorize(pd.Series([tags.get('name', '') for way_nodes, tags in ways.values()],
+                                               dtype=object))
+    way_lengths = np.array([len(way_nodes) for way_nodes in way_node_ids], dtype=np.int64)
+    way_indptr = np.concatenate([[0], np.cumsum(way_lengths)])
+    way_nodes = np.searchsorted(node_ids, np.concatenate(way_node_ids)) if way_node_ids else np.array([], np.int64)
+
+    # every pair of consecutive way nodes is an edge in the allowed directions
+    sources, targets, edge_names, speeds = [], [], [], []
+    for way, (way_id, (way_node_list, tags)) in enumerate(ways.items()):
+        positions = way_nodes[way_indptr[way]:way_indptr[way + 1]]
+        direction = way_direction(tags)
+        if direction >= 0:
+            sources.append(positions[:-1])
+            targets.append(positions[1:])
+        if direction <= 0:
+            sources.append(positions[1:])
+            targets.append(positions[:-1])
+        edge_count = (len(positions) - 1) * (2 if direction == 0 else 1)
+        edge_names.append(np.full(edge_count, name_codes[way]))
+        speeds.append(np.full(edge_count, way_speed(tags)))
+    sources = np.concatenate(sources) if sources else np.array([], dtype=np.int64)
+    targets = np.concatenate(targets) if targets else np.array([], dtype=np.int64)
+    edge_names = np.concatenate(edge_names) if edge_names else np.array([], dtype=np.int64)
+    speeds = np.concatenate(speeds) if speeds else np.array([], dtype=np.float64)
+
+    order = np.argsort(sources, kind='stable')
+    sources, targets, edge_names, speeds = sources[order], targets[order], edge_names[order], speeds[order]
+    indptr = np.searchsorted(sources, np.arange(len(node_ids) + 1)).astype(np.int64)
+    lengths = haversine(lon[sources], lat[sources], lon[targets], lat[targets]).astype(np.float32)
+    return RoadNetwork(node_ids, lon, lat, indptr, targets.astype(np.int32), lengths, speeds.astype(np.float32),
+                       edge_names.astype(np.int32),
+                       way_indptr, way_nodes.astype(np.int32), name_codes.astype(np.int32),
+                       np.asarray(names, dtype=str))
+
+
+def load_network(cache_dir: str = 'cache', path: str = 'nyc_drive_network.npz') -> RoadNetwork:
+    """
+    Loads the drive network saved by an earlier call. The network is built from the osmnx cache and saved the first
+    time, and rebuilt when the cached responses change.
+    :param cache_dir: directory with the osmnx cache
+    :param path: path of the saved network
+    :return: RoadNetwork
+    """
+    network_hash = cache_hash(cache_dir)
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            if str(saved['network_hash']) == network_hash:
+                return RoadNetwork(*(saved[field] for field in RoadNetwork._fields))
+
+    network = build_network(cache_dir)
+    zones.save_arrays(path, network_hash=np.array(network_hash), **network._asdict())
+    return network
+
+
+def nearest_nodes(network: RoadNetwork, lon, lat) -> np.ndarray:
+    """
+    Finds the network node nearest to every point.
+    :param network: RoadNetwork
+    :param lon: longitudes of the points
+    :param lat: latitudes of the points
+    :return: numpy array of node positions
+    """
+    tree = shapely.STRtree(shapely.points(network.lon, network.lat))
+    return tree.nearest(shapely.points(lon, lat))
+
+
+def dijkstra(network: RoadNetwork, source: int, target: int = None, weights: np.ndarray = None,
+             along: np.ndarray = None) -> tuple:
+    """
+    Finds the shortest paths from a source node over the CSR arrays.
+    :param network: RoadNetwork
+    :param source: position of the source node
+    :param target: position of a target node. The search stops once it is reached. All nodes are searched if None.
+    :param weights: weight of every edge. The edge lengths if None.
+    :param along: a second value of every edge, such as travel time, to add up along the shortest paths
+    :return: tuple of a numpy array with the distance to every node (inf if unreached), a numpy array with the
+        previous node on the shortest path to every node (-1 if none) and a numpy array with the sum of along on the
+        shortest path to every node (None if along is None)
+    """
+    weights = network.lengths if weights is None else weights
+    indptr, indices, weights = network.indptr.tolist(), network.indices.tolist(), weights.tolist()
+    along_values = along.tolist() if along is not None else None
+    distances = [float('inf')] * len(network.node_ids)
+    along_totals = [float('inf')] * len(network.node_ids)
+    previous = [-1] * len(network.node_ids)
+    done = [False] * len(network.node_ids)
+    distances[source] = 0.0
+    along_totals[source] = 0.0
+    heap = [(0.0, source)]
+    while heap:
+        distance, node = heapq.heappop(heap)
+        if done[node]:
+            continue
+        done[node] = True
+        if node == target:
+            break
+        for edge in range(indptr[node], indptr[node + 1]):
+            neighbor = indices[edge]
+            new_distance = distance + weights[edge]
+            if new_distance < distances[neighbor]:
+                distances[neighbor] = new_distance
+                previous[neighbor] = node
+                if along_values is not None:
+                    along_totals[neighbor] = along_totals[node] + along_values[edge]
+                heapq.heappush(heap, (new_distance, neighbor))
+    return (np.array(distances), np.array(previous, dtype=np.int64),
+            np.array(along_totals) if along is not None else None)
+
+
+def shortest_path(network: RoadNetwork, source: int, target: int) -> list:
+    """
+    Finds the shortest path by length between two nodes.
+    :param network: RoadNetwork
+    :param source: position of the source node
+    :param target: position of the target node
+    :return: list of node positions from source to target. Empty if the target cannot be reached.
+    """
+    distances, previous, _ = dijkstra(network, source, target)
+    if np.isinf(distances[target]):
+        return []
+    path = [target]
+    while path[-1] != source:
+        path.append(int(previous[path[-1]]))
+    return path[::-1]
+
+
+def street_lines(network: RoadNetwork) -> gpd.GeoDataFrame:
+    """
+    Makes the street geometries of the network, one LineString per OSM way.
+    :param network: RoadNetwork
+    :return: geopandas dataframe with name and geometry columns
+    """
+    coordinates = np.column_stack([network.lon[network.way_nodes], network.lat[network.way_nodes]])
+    way_ids = np.repeat(np.arange(len(network.way_names)), np.diff(network.way_indptr))
+    lines = shapely.linestrings(coordinates, indices=way_ids)
+    names = network.names[network.way_names]
+    return gpd.GeoDataFrame({'name': np.where(names == '', None, names)}, geometry=lines, crs='EPSG:4326')
+
+
+def to_networkx(network: RoadNetwork, node_positions: np.ndarray = None):
+    """
+    Makes an osmnx compatible networkx graph of the network, for plotting.
+    :param network: RoadNetwork
+    :param node_positions: positions of the nodes to include. All nodes if None.
+    :return: networkx MultiDiGraph with OSM node ids
+    """
+    # networkx is only needed for plotting, so it is not imported with the module
+    import networkx as nx
+
+    include = np.ones(len(network.node_ids), dtype=bool)
+    if node_positions is not None:
+        include[:] = False
+        include[node_positions] = True
+    sources = np.repeat(np.arange(len(network.node_ids)), np.diff(network.indptr))
+    edges = include[sources] & include[network.indices]
+
+    graph = nx.MultiDiGraph(crs='epsg:4326')
+    graph.add_nodes_from((int(network.node_ids[node]), {'x': float(network.lon[node]), 'y': float(network.lat[node])})
+                         for node in np.flatnonzero(include))
+    graph.add_edges_from((int(network.node_ids[source]), int(network.node_ids[target]), {'length': float(length)})
+                         for source, target, length in zip(sources[edges], network.indices[edges],
+                                                           network.lengths[edges]))
+    return graph
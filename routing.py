@@ -0,0 +1,306 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import road_network as rn
+import zones
+
+ROUTES_VERSION = 1
+METERS_PER_MILE = 1609.344
+# zone centroids farther than this from the drive network are not routed
+MAX_SNAP_M = 1000
+
+
+class ZoneRoutes(NamedTuple):
+    """
+    Shortest paths by length between the centroids of all taxi zones, indexed by zone number (objectid).
+    distances[z1, z2] is the length in miles of the shortest path from zone z1 to zone z2 and times[z1, z2] the
+    predicted travel time in hours along it. Both are NaN if there is no path. nodes[z] is the network node the
+    centroid of zone z is snapped to, -1 if the zone is not routed.
+    The corridor of the pair (z1, z2) is the ordered zones the path crosses, from z1 to z2. They are stored as one
+    ragged array: corridor_zones[corridor_indptr[p]:corridor_indptr[p + 1]] with p = z1 * NUM_ZONE_IDS + z2. Pairs
+    without a path have the corridor [z1, z2].
+    """
+    distances: np.ndarray
+    times: np.ndarray
+    nodes: np.ndarray
+    corridor_indptr: np.ndarray
+    corridor_zones: np.ndarray
+
+
+def edge_hours(network: rn.RoadNetwork) -> np.ndarray:
+    """
+    Finds the time to drive every edge at its speed limit.
+    :param network: RoadNetwork
+    :return: numpy array with the travel time of every edge in hours
+    """
+    return network.lengths.astype(np.float64) / 1000 / network.speeds
+
+
+def zone_nodes(network: rn.RoadNetwork, nyc_geo: gpd.GeoDataFrame) -> np.ndarray:
+    """
+    Snaps the centroid of every taxi zone to its nearest network node.
+    :param network: RoadNetwork
+    :param nyc_geo: geopandas dataframe with taxi zone data
+    :return: numpy array with the node position of every zone number. -1 for zones that are not in the file or
+        whose centroid is more than MAX_SNAP_M from the network.
+    """
+    centroids = nyc_geo.geometry.to_crs(2263).centroid.to_crs(4326)
+    nodes = rn.nearest_nodes(network, centroids.x.to_numpy(), centroids.y.to_numpy())
+    snap_m = rn.haversine(centroids.x.to_numpy(), centroids.y.to_numpy(), network.lon[nodes], network.lat[nodes])
+    zone_node = np.full(zones.NUM_ZONE_IDS, -1, dtype=np.int64)
+    zone_node[nyc_geo['objectid'].astype(int).to_numpy()] = np.where(snap_m <= MAX_SNAP_M, nodes, -1)
+    return zone_node
+
+
+def node_zones(network: rn.RoadNetwork, nyc_geo: gpd.GeoDataFrame) -> np.ndarray:
+    """
+    Finds the taxi zone of every network node.
+    :param network: RoadNetwork
+    :param nyc_geo: geopandas dataframe with taxi zone data
+    :return: numpy array with the zone number of every node. -1 for nodes outside the zones.
+    """
+    zone_ids = nyc_geo['objectid'].astype(int).to_numpy()
+    node_positions, zone_positions = zones.query_zones(shapely.STRtree(np.asarray(nyc_geo.geometry.values)),
+                                                       shapely.points(network.lon, network.lat), 'within')
+
+    # keep the lowest zone position for every node, like File_creation.assign_zones
+    node_zone = np.full(len(network.node_ids), len(zone_ids), dtype=np.int64)
+    np.minimum.at(node_zone, node_positions, zone_positions)
+    return np.append(zone_ids, -1)[node_zone]
+
+
+def path_zones(previous: np.ndarray, targets: np.ndarray, node_zone: np.ndarray) -> list:
+    """
+    Walks the shortest path tree of a Dijkstra search back from every target at once and lists the zones on the way.
+    :param previous: previous node of every node, from road_network.dijkstra
+    :param targets: node positions of the path ends
+    :param node_zone: zone number of every node, from node_zones
+    :return: list with the ordered distinct zones of the path to every target, from the source zone on
+    >>> previous = np.array([-1, 0, 1, 2, -1])
+    >>> path_zones(previous, np.array([3, 0, 4]), np.array([7, 7, -1, 9, 5]))
+    [array([7, 9]), array([7]), array([5])]
+    """
+    steps = [targets]
+    while True:
+        current = np.where(steps[-1] >= 0, previous[np.maximum(steps[-1], 0)], -1)
+        if (current < 0).all():
+            break
+        steps.append(current)
+    steps = np.stack(steps)[::-1]
+    step_zones = np.where(steps >= 0, node_zone[np.maximum(steps, 0)], -1)
+    return [pd.unique(column[column >= 0]) for column in step_zones.T]
+
+
+def routes_from_sources(network: rn.RoadNetwork, sources: np.ndarray, targets: np.ndarray,
+                        node_zone: np.ndarray = None) -> tuple:
+    """
+    Runs Dijkstra from every source node and reads the distances and travel times to the target nodes.
+    :param network: RoadNetwork
+    :param sources: node positions to route from
+    :param targets: node positions to route to
+    :param node_zone: zone number of every node, from node_zones. The path zones are not listed if None.
+    :return: tuple of two numpy arrays with one row per source and one column per target: the shortest path lengths
+        in miles and the travel times along them in hours, NaN if there is no path, and a list with one list per
+        source of the zones on the path to every target (from path_zones, None if node_zone is None)
+    >>> network = rn.RoadNetwork(np.arange(3), np.zeros(3), np.zeros(3), np.array([0, 1, 2, 2]), np.array([1, 2]),
+    ...                          np.array([1609.344, 3218.688], dtype=np.float32), np.array([40.0, 80.0], dtype=np.float32),
+    ...                          *([np.array([])] * 5))
+    >>> distances, times, _ = routes_from_sources(network, np.array([0, 2]), np.array([0, 2]))
+    >>> distances.round(3), times.round(3)
+    (array([[ 0.,  3.],
+           [nan,  0.]]), array([[0.  , 0.08],
+           [ nan, 0.  ]]))
+    """
+    hours = edge_hours(network)
+    distances = np.full((len(sources), len(targets)), np.nan)
+    times = np.full((len(sources), len(targets)), np.nan)
+    corridors = [] if node_zone is not None else None
+    for row, source in enumerate(sources):
+        source_distances, previous, source_times = rn.dijkstra(network, int(source), along=hours)
+        reached = np.isfinite(source_distances[targets])
+        distances[row, reached] = source_distances[targets[reached]] / METERS_PER_MILE
+        times[row, reached] = source_times[targets[reached]]
+        if node_zone is not None:
+            corridors.append(path_zones(previous, targets, node_zone))
+    return distances, times, corridors
+
+
+def route_batch(args: tuple) -> tuple:
+    """
+    Process pool entry point of build_zone_routes.
+    :param args: tuple of the network, the source nodes, the target nodes and the zone of every node
+    :return: the result of routes_from_sources
+    """
+    return routes_from_sources(*args)
+
+
+def ragged_corridors(corridors: dict) -> tuple:
+    """
+    Packs the corridors of all zone pairs into one ragged array. Pairs that are not in corridors get [z1, z2].
+    :param corridors: dictionary with (zone1, zone2) as key and the ordered zones of its path as value
+    :return: tuple of the corridor_indptr and corridor_zones arrays of ZoneRoutes
+    >>> indptr, corridor_zones = ragged_corridors({(1, 2): [1, 5, 2]})
+    >>> corridor_zones[indptr[zones.NUM_ZONE_IDS + 2]:indptr[zones.NUM_ZONE_IDS + 3]]
+    array([1, 5, 2], dtype=int16)
+    >>> corridor_zones[indptr[3 * zones.NUM_ZONE_IDS + 3]:indptr[3 * zones.NUM_ZONE_IDS + 4]]
+    array([3], dtype=int16)
+    """
+    pair_zones = []
+    for zone1 in range(zones.NUM_ZONE_IDS):
+        for zone2 in range(zones.NUM_ZONE_IDS):
+            corridor = corridors.get((zone1, zone2))
+            pair_zones.append(corridor if corridor is not None else ([zone1, zone2] if zone1 != zone2 else [zone1]))
+    lengths = np.array([len(corridor) for corridor in pair_zones])
+    indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    return indptr, np.concatenate(pair_zones).astype(np.int16)
+
+
+def valid_zones(zone_ids: np.ndarray) -> np.ndarray:
+    """
+    Finds the zone numbers that are taxi zones. The taxi data also uses 264 and 265 for unknown zones.
+    :param zone_ids: numpy array of zone numbers
+    :return: numpy boolean array that is True for zone numbers from 1 to 263
+    >>> valid_zones(np.array([0, 1, 263, 264, 265]))
+    array([False,  True,  True, False, False])
+    """
+    return (zone_ids >= 1) & (zone_ids < zones.NUM_ZONE_IDS)
+
+
+def corridor_zones(routes: ZoneRoutes, pickup_zones: np.ndarray, dropoff_zones: np.ndarray) -> tuple:
+    """
+    Expands the corridors of many trips into one flat array with one row per trip and corridor zone.
+    :param routes: ZoneRoutes
+    :param pickup_zones: numpy array with the pickup zone of every trip
+    :param dropoff_zones: numpy array with the drop off zone of every trip
+    :return: tuple of two numpy arrays: the position of the trip of every row and the zone of every row
+    >>> indptr, ragged = ragged_corridors({(1, 2): [1, 5, 2]})
+    >>> routes = ZoneRoutes(None, None, None, indptr, ragged)
+    >>> corridor_zones(routes, np.array([1, 4]), np.array([2, 4]))
+    (array([0, 0, 0, 1]), array([1, 5, 2, 4], dtype=int16))
+
+    Zones outside 1..263, like the unknown zones 264 and 265 of the taxi data, have no corridor. Those trips get their
+    pickup and drop off zones, like the count without corridors.
+    >>> corridor_zones(routes, np.array([1, 264, 4]), np.array([265, 2, 4]))
+    (array([0, 0, 1, 1, 2]), array([  1, 265, 264,   2,   4], dtype=int16))
+    """
+    pickup_zones = np.asarray(pickup_zones, dtype=np.int64)
+    dropoff_zones = np.asarray(dropoff_zones, dtype=np.int64)
+    known = valid_zones(pickup_zones) & valid_zones(dropoff_zones)
+    routed = np.flatnonzero(known)
+    pairs = pickup_zones[routed] * zones.NUM_ZONE_IDS + dropoff_zones[routed]
+    starts = routes.corridor_indptr[pairs]
+    lengths = routes.corridor_indptr[pairs + 1] - starts
+    trip_positions = np.repeat(routed, lengths)
+    offsets = np.arange(len(trip_positions)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    trip_zones = routes.corridor_zones[np.repeat(starts, lengths) + offsets]
+    if known.all():
+        return trip_positions, trip_zones
+
+    # pickup and drop off zone of the other trips, the drop off zone only once for trips inside one zone
+    unknown = np.flatnonzero(~known)
+    both = pickup_zones[unknown] != dropoff_zones[unknown]
+    trip_positions = np.concatenate([trip_positions, unknown, unknown[both]])
+    trip_zones = np.concatenate([trip_zones, pickup_zones[unknown].astype(np.int16),
+                                 dropoff_zones[unknown][both].astype(np.int16)])
+    order = np.argsort(trip_positions, kind='stable')
+    return trip_positions[order], trip_zones[order]
+
+
+def build_zone_routes(network: rn.RoadNetwork, nyc_geo: gpd.GeoDataFrame, workers: int = None) -> ZoneRoutes:
+    """
+    Computes the shortest path distances, travel times and corridors between the centroids of all taxi zones. The
+    Dijkstra searches from the source zones are split between processes.
+    :param network: RoadNetwork
+    :param nyc_geo: geopandas dataframe with taxi zone data
+    :param workers: number of processes. Uses all cores if None and runs in this process if 1.
+    :return: ZoneRoutes
+    """
+    nodes = zone_nodes(network, nyc_geo)
+    node_zone = node_zones(network, nyc_geo)
+    routed = np.flatnonzero(nodes >= 0)
+    workers = os.cpu_count() if workers is None else workers
+    source_batches = [batch for batch in np.array_split(routed, max(workers, 1)) if len(batch)]
+    batches = [(network, nodes[batch], nodes[routed], node_zone) for batch in source_batches]
+    if workers <= 1:
+        results = [route_batch(batch) for batch in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(route_batch, batches))
+
+    distances = np.full((zones.NUM_ZONE_IDS, zones.NUM_ZONE_IDS), np.nan, dtype=np.float32)
+    times = np.full((zones.NUM_ZONE_IDS, zones.NUM_ZONE_IDS), np.nan, dtype=np.float32)
+    corridors = {}
+    if results:
+        distances[np.ix_(routed, routed)] = np.concatenate([result[0] for result in results])
+        times[np.ix_(routed, routed)] = np.concatenate([result[1] for result in results])
+        for zone1, path_lists in zip(np.concatenate(source_batches), (row for result in results for row in result[2])):
+            for zone2, path in zip(routed, path_lists):
+                if zone1 != zone2 and np.isfinite(distances[zone1, zone2]):
+                    # the centroid nodes can lie just outside their own zone
+                    corridors[(int(zone1), int(zone2))] = pd.unique(np.concatenate([[zone1], path, [zone2]]))
+    return ZoneRoutes(distances, times, nodes, *ragged_corridors(corridors))
+
+
+def load_zone_routes(zones_path: str = 'NYC_Taxi_Zones.geojson', path: str = 'zone_routes.npz',
+                     cache_dir: str = 'cache', nyc_geo: gpd.GeoDataFrame = None, workers: int = None) -> ZoneRoutes:
+    """
+    Loads the zone routes saved by an earlier call. They are computed and saved the first time, and again when the
+    zones file or the osmnx cache change.
+    :param zones_path: path to the taxi zones file
+    :param path: path of the saved zone routes
+    :param cache_dir: directory with the osmnx cache
+    :param nyc_geo: geopandas dataframe of the zones file. Read from zones_path if the routes have to be computed and
+        it is not given.
+    :param workers: number of processes computing the routes
+    :return: ZoneRoutes
+    """
+    routes_hash = f'{ROUTES_VERSION}-' + zones.file_hash(zones_path) + rn.cache_hash(cache_dir)
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            if str(saved['routes_hash']) == routes_hash:
+                return ZoneRoutes(*(saved[field] for field in ZoneRoutes._fields))
+
+    if nyc_geo is None:
+        nyc_geo = zones.read_zones(zones_path)
+    routes = build_zone_routes(rn.load_network(cache_dir), nyc_geo, workers)
+    zones.save_arrays(path, routes_hash=np.array(routes_hash), **routes._asdict())
+    return routes
+
+
+def network_baseline(trips_df: pd.DataFrame, routes: ZoneRoutes) -> pd.DataFrame:
+    """
+    Looks up the network distance and travel time between the pickup and drop off zones of every trip, and compares
+    them to the trip when it has trip_distance and trip_time_h columns.
+    :param trips_df: pandas dataframe of taxi trips data
+    :param routes: ZoneRoutes
+    :return: pandas dataframe with the index of trips_df and the network_distance and network_time_h columns, plus
+        distance_ratio and time_ratio (trip value / network value) when the trip columns are there. The ratios are
+        NaN for trips inside one zone. Trips with a zone that is not in the matrices get NaN.
+    >>> routes = ZoneRoutes(np.array([[0, 4.0], [4.0, 0]]), np.array([[0, 0.2], [0.2, 0]]), np.array([0, 1]), None, None)
+    >>> trips = pd.DataFrame({'PULocationID': [0, 1, 264], 'DOLocationID': [1, 1, 265],
+    ...                       'trip_distance': [5.0, 1.0, 2.0], 'trip_time_h': [0.4, 0.1, 0.2]})
+    >>> network_baseline(trips, routes)
+       network_distance  network_time_h  distance_ratio  time_ratio
+    0               4.0             0.2            1.25         2.0
+    1               0.0             0.0             NaN         NaN
+    2               NaN             NaN             NaN         NaN
+    """
+    pickup = trips_df['PULocationID'].to_numpy(dtype=np.int64)
+    dropoff = trips_df['DOLocationID'].to_numpy(dtype=np.int64)
+    # zones without a row in the matrices, like the unknown zones 264 and 265, get NaN
+    n_zones = len(routes.distances)
+    known = (pickup >= 0) & (pickup < n_zones) & (dropoff >= 0) & (dropoff < n_zones)
+    pickup, dropoff = np.where(known, pickup, 0), np.where(known, dropoff, 0)
+    baseline = pd.DataFrame({'network_distance': np.where(known, routes.distances[pickup, dropoff], np.nan),
+                             'network_time_h': np.where(known, routes.times[pickup, dropoff], np.nan)},
+                            index=trips_df.index)
+    routed = baseline['network_distance'] > 0
+    if 'trip_distance' in trips_df:
+        baseline['distance_ratio'] = (trips_df['trip_distance'] / baseline['network_distance']).where(routed)
+    if 'trip_time_h' in trips_df:
+        baseline['time_ratio'] = (trips_df['trip_time_h'] / baseline['network_time_h']).where(routed)
+    return baseline
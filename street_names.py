@@ -0,0 +1,98 @@
+import re
+from typing import NamedTuple
+import numpy as np
+import pandas as pd
+
+# words that are written out in the canonical names, wherever they are in the name
+ABBREVIATIONS = {'st': 'street', 'str': 'street', 'ave': 'avenue', 'av': 'avenue', 'avn': 'avenue', 'rd': 'road',
+                 'pl': 'place', 'blvd': 'boulevard', 'pkwy': 'parkway', 'pky': 'parkway', 'dr': 'drive',
+                 'ln': 'lane', 'ct': 'court', 'ter': 'terrace', 'terr': 'terrace', 'hwy': 'highway',
+                 'expy': 'expressway', 'expwy': 'expressway', 'sq': 'square', 'tpke': 'turnpike', 'plz': 'plaza',
+                 'cir': 'circle', 'br': 'bridge', 'brg': 'bridge', 'ft': 'fort', 'mt': 'mount'}
+# words that are only written out at the start of a name, so that Avenue S stays avenue s
+FIRST_WORDS = {'e': 'east', 'w': 'west', 'n': 'north', 's': 'south', 'st': 'saint'}
+FIRST_WORD_PATTERN = re.compile(r'^(' + '|'.join(FIRST_WORDS) + r') (?=\S)')
+ABBREVIATION_PATTERN = re.compile(r'\b(?:' + '|'.join(ABBREVIATIONS) + r')\b')
+# canonical name of every raw name normalized so far, shared by all calls
+_canonical_names = {}
+
+
+class StreetNames(NamedTuple):
+    """
+    Street names of several sources encoded as codes into one shared list of canonical names.
+    codes[s][i] is the position in names of the canonical name of row i of source s, or -1 if the row has no name.
+    """
+    names: np.ndarray
+    codes: list
+
+    def match_rate(self, source: int = 0, target: int = 1) -> float:
+        """
+        Finds the share of the rows of a source whose name is also in a target.
+        :param source: position of the source in codes
+        :param target: position of the target in codes
+        :return: share of the rows of source, between 0 and 1. Rows without a name are not matched.
+        >>> encode_names(pd.Series(['Main St', 'Elm Road']), pd.Series(['main street'])).match_rate()
+        0.5
+        """
+        source_codes = self.codes[source]
+        if len(source_codes) == 0:
+            return 0.0
+        in_target = np.zeros(len(self.names) + 1, dtype=bool)
+        in_target[self.codes[target]] = True
+        in_target[-1] = False
+        return float(in_target[source_codes].mean())
+
+
+def canonical_names(names: np.ndarray) -> np.ndarray:
+    """
+    Normalizes distinct street names: lower case, no punctuation, single spaces, no ordinal suffixes (5th -> 5) and
+    the abbreviations written out (ave -> avenue, w -> west at the start).
+    :param names: numpy array of street names
+    :return: numpy array of the canonical names
+    >>> canonical_names(np.array(['WEST   29 STREET', 'W. 29th St', 'St. Marks Pl', 'Avenue S'])).tolist()
+    ['west 29 street', 'west 29 street', 'saint marks place', 'avenue s']
+    """
+    if len(names) == 0:
+        return np.array([], dtype=object)
+    cleaned = (pd.Series(names, dtype=object).astype(str).str.lower()
+               .str.replace(r"[.,'’]", '', regex=True).str.replace(r'[^\w&/-]+', ' ', regex=True).str.strip()
+               .str.replace(r'\b(\d+)(?:st|nd|rd|th)\b', r'\1', regex=True))
+
+    # every rule is one regular expression run over all names, and only the matched words call back into python
+    cleaned = cleaned.str.replace(FIRST_WORD_PATTERN, lambda match: FIRST_WORDS[match.group(1)] + ' ', regex=True)
+    cleaned = cleaned.str.replace(ABBREVIATION_PATTERN, lambda match: ABBREVIATIONS[match.group(0)], regex=True)
+    return cleaned.to_numpy(dtype=object)
+
+
+def normalize_names(names: pd.Series) -> pd.Series:
+    """
+    Finds the canonical name of every street name. Only the distinct names that were never seen before are
+    normalized, the others are looked up in the shared dictionary.
+    :param names: pandas Series of street names
+    :return: pandas Series of canonical names with the index of names. Missing or empty names are NaN.
+    >>> normalize_names(pd.Series(['5th Ave', None, '5 AVENUE'])).tolist()
+    ['5 avenue', nan, '5 avenue']
+    """
+    codes, uniques = pd.factorize(names)
+    uniques = np.asarray(uniques, dtype=object)
+    new = np.array([name for name in uniques if name not in _canonical_names], dtype=object)
+    _canonical_names.update(zip(new.tolist(), canonical_names(new).tolist()))
+    canonical = np.array([_canonical_names[name] or np.nan for name in uniques] + [np.nan], dtype=object)
+    return pd.Series(canonical[codes], index=names.index, name=names.name)
+
+
+def encode_names(*name_columns: pd.Series) -> StreetNames:
+    """
+    Normalizes the street names of every source and encodes them as integer codes into one list of canonical names,
+    so names of different sources can be joined by comparing integers.
+    :param name_columns: pandas Series of street names, one per source
+    :return: StreetNames with the sorted canonical names and an int32 array of codes per source
+    >>> names = encode_names(pd.Series(['MAIN STREET', 'Broadway']), pd.Series(['broadway', 'Main St', None]))
+    >>> names.names.tolist(), [codes.tolist() for codes in names.codes]
+    (['broadway', 'main street'], [[1, 0], [0, 1, -1]])
+    """
+    canonical = [normalize_names(names) for names in name_columns]
+    all_names = pd.concat(canonical, ignore_index=True).dropna().unique() if canonical else []
+    names = np.sort(np.asarray(all_names, dtype=object))
+    index = pd.Index(names)
+    return StreetNames(names, [index.get_indexer(column).astype(np.int32) for column in canonical])
@@ -0,0 +1,201 @@
+import argparse
+import glob
+import itertools
+import os
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import File_creation as fc
+import main
+import zones
+
+PARTITION_DIR = 'taxi_partitions'
+STAT_COLUMNS = ['fare_amount', 'trip_time_h', 'avg speed']
+# prepare_trip_chunk removes trips longer than this, so a trip never ends later than this after its month
+MAX_TRIP = timedelta(hours=24)
+# rows a partition file buffers before writing a row group, which bounds the memory of the partition writers
+MIN_ROWS_PER_GROUP = 20000
+
+PARTITION_SCHEMA = pa.schema([('tripID', pa.int32()), ('tpep_pickup_datetime', pa.timestamp('s')),
+                              ('tpep_dropoff_datetime', pa.timestamp('s')), ('trip_distance', pa.float32()),
+                              ('PULocationID', pa.int16()), ('DOLocationID', pa.int16()),
+                              ('fare_amount', pa.float32()), ('tip_amount', pa.float32()),
+                              ('tolls_amount', pa.float32()), ('total_amount', pa.float32()),
+                              ('trip_time_h', pa.float32()), ('avg speed', pa.float32()),
+                              ('month', pa.string()), ('pickup_zone', pa.int16())])
+
+
+def write_taxi_partitions(taxi_paths: list, partition_dir: str = PARTITION_DIR, neighbor_dict: dict = None,
+                          zone_mode: str = 'neighbors', hops: int = 1, time_format: str = '%m/%d/%Y %I:%M:%S %p',
+                          chunksize: int = 1000000) -> dict:
+    """
+    Prepares the full monthly taxi files and stores the kept trips as a parquet dataset partitioned by pickup month
+    and pickup zone (partition_dir/month=2018-01/pickup_zone=4/). The files are streamed in chunks through
+    main.prepare_trip_chunk, so memory does not grow with the size of the files.
+    Running it again for a taxi file replaces only the partition files written from that taxi file.
+    :param taxi_paths: paths to the monthly taxi trip files
+    :param partition_dir: directory of the partitioned dataset
+    :param neighbor_dict: dictionary of zones and their neighbors. See main.prepare_trips.
+    :param zone_mode: 'same', 'neighbors' or 'any'. See filter_trips_based_on_zones.
+    :param hops: number of neighbor steps allowed in 'neighbors' mode
+    :param time_format: format of the pickup and drop off times
+    :param chunksize: number of trips read at a time
+    :return: dictionary with the number of trips each rule removed
+    """
+    removed = {'too_quick': 0, 'too_long': 0, 'super_fast': 0, 'super_slow': 0, 'not_neighbor_zones': 0}
+    neighbors = main.neighbor_matrix(neighbor_dict) if neighbor_dict is not None else None
+    partitioning = ds.partitioning(pa.schema([('month', pa.string()), ('pickup_zone', pa.int16())]), flavor='hive')
+
+    for path in taxi_paths:
+        file_name = os.path.splitext(os.path.basename(path))[0]
+        for old_file in glob.glob(os.path.join(partition_dir, 'month=*', 'pickup_zone=*', f'{file_name}-*.parquet')):
+            os.remove(old_file)
+
+        def batches():
+            for chunk in pd.read_csv(path, usecols=lambda column: column in main.PREPARE_DTYPES,
+                                     dtype=main.PREPARE_DTYPES, chunksize=chunksize):
+                trips = main.prepare_trip_chunk(chunk, removed, neighbors, zone_mode, hops, time_format)
+                trips['month'] = trips['tpep_pickup_datetime'].to_numpy().astype('datetime64[M]').astype(str)
+                trips['pickup_zone'] = trips['PULocationID']
+                yield pa.RecordBatch.from_pandas(trips, schema=PARTITION_SCHEMA, preserve_index=False)
+
+        ds.write_dataset(batches(), partition_dir, schema=PARTITION_SCHEMA, format='parquet',
+                         partitioning=partitioning, basename_template=f'{file_name}-{{i}}.parquet',
+                         existing_data_behavior='overwrite_or_ignore', min_rows_per_group=MIN_ROWS_PER_GROUP,
+                         max_rows_per_group=100000)
+    return removed
+
+
+def taxi_partitions(partition_dir: str = PARTITION_DIR) -> list:
+    """
+    Lists the partitions of a partitioned taxi dataset.
+    :param partition_dir: directory of the partitioned dataset
+    :return: sorted list of (month, pickup zone) tuples, like ('2018-01', 4)
+    """
+    keys = []
+    for zone_dir in glob.glob(os.path.join(partition_dir, 'month=*', 'pickup_zone=*')):
+        month_dir, zone_name = os.path.split(zone_dir)
+        keys.append((os.path.basename(month_dir).split('=', 1)[1], int(zone_name.split('=', 1)[1])))
+    return sorted(keys)
+
+
+def read_partition(month: str, pickup_zone: int, partition_dir: str = PARTITION_DIR) -> pd.DataFrame:
+    """
+    Reads the trips of one partition.
+    :param month: pickup month, like '2018-01'
+    :param pickup_zone: pickup zone
+    :param partition_dir: directory of the partitioned dataset
+    :return: pandas dataframe of the trips with the columns of main.prepare_trips
+    """
+    return pq.read_table(os.path.join(partition_dir, f'month={month}', f'pickup_zone={pickup_zone}')).to_pandas()
+
+
+def partial_moments(trips_df: pd.DataFrame, passed_event: np.ndarray, columns: list = STAT_COLUMNS) -> pd.DataFrame:
+    """
+    Summarizes the columns of a group of trips with statistics that can be combined across groups.
+    :param trips_df: pandas dataframe of taxi trips
+    :param passed_event: numpy boolean array that is True for the trips that passed a traffic event
+    :param columns: columns to summarize
+    :return: pandas dataframe indexed by (passed_event, column) with the count, mean, sum of squared differences
+        from the mean (m2), min and max of the non missing values
+    """
+    rows = []
+    for passed in (True, False):
+        for column in columns:
+            values = trips_df[column].to_numpy(dtype=np.float64)[passed_event == passed]
+            values = values[~np.isnan(values)]
+            if len(values):
+                mean = values.mean()
+                rows.append((passed, column, len(values), mean, ((values - mean) ** 2).sum(), values.min(),
+                             values.max()))
+    return pd.DataFrame(rows, columns=['passed_event', 'column', 'count', 'mean', 'm2', 'min', 'max']
+                        ).set_index(['passed_event', 'column'])
+
+
+def combine_moments(partials: list) -> pd.DataFrame:
+    """
+    Combines the statistics of many groups of trips into the statistics of all trips. The means and variances are
+    merged with the parallel variance formula, so the result is the same as summarizing all trips at once.
+    :param partials: list of pandas dataframes made by partial_moments
+    :return: pandas dataframe with the count, mean, std, min and max rows, like describe(), and the columns
+        (passed_event, column)
+    >>> trips = pd.DataFrame({'fare_amount': [4.0, 6.0, 8.0, 10.0, 30.0]})
+    >>> passed = np.array([True, True, True, True, False])
+    >>> halves = [partial_moments(trips.iloc[:2], passed[:2], ['fare_amount']),
+    ...           partial_moments(trips.iloc[2:], passed[2:], ['fare_amount'])]
+    >>> combine_moments(halves) #doctest:+NORMALIZE_WHITESPACE
+    passed_event       False       True
+    column       fare_amount fare_amount
+    count                1.0    4.000000
+    mean                30.0    7.000000
+    std                  NaN    2.581989
+    min                 30.0    4.000000
+    max                 30.0   10.000000
+    """
+    moments = pd.concat(partials)
+    groups = moments.groupby(level=['passed_event', 'column'])
+    count = groups['count'].sum()
+    mean = (moments['count'] * moments['mean']).groupby(level=['passed_event', 'column']).sum() / count
+    spread = moments['count'] * (moments['mean'] - mean.reindex(moments.index)) ** 2
+    m2 = (moments['m2'] + spread).groupby(level=['passed_event', 'column']).sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std = np.sqrt(m2 / (count - 1)).where(count > 1)
+    return pd.DataFrame({'count': count, 'mean': mean, 'std': std, 'min': groups['min'].min(),
+                         'max': groups['max'].max()}).T
+
+
+def event_statistics(partition_dir: str = PARTITION_DIR, crashes_path: str = 'Crash_zones.parquet',
+                     closures_path: str = 'closures_cleaned.parquet',
+                     closure_zones_path: str = 'closure_zones.parquet',
+                     time_window: timedelta = timedelta(minutes=30), corridors=None,
+                     columns: list = STAT_COLUMNS) -> pd.DataFrame:
+    """
+    Compares the trips that pass a traffic event with the trips that do not, like main.trips_during_events_avg_time,
+    one partition at a time. For every month only the crashes and closures whose times overlap the month are read from
+    the parquet files, and every pickup zone partition is matched against the events of its own zones. Peak memory
+    depends on the size of the biggest partition and one month of events, not on the number of trips.
+    :param partition_dir: directory of the partitioned dataset made by write_taxi_partitions
+    :param crashes_path: path to the crashes parquet file
+    :param closures_path: path to the cleaned closures parquet file
+    :param closure_zones_path: path to the closure zones parquet file
+    :param time_window: time before the pickup and after the drop off in which crashes are counted
+    :param corridors: ZoneRoutes to count the events along the route of every trip. See event_counts_during_trips.
+    :param columns: columns to summarize
+    :return: pandas dataframe with the count, mean, std, min and max of every column for the trips that passed an
+        event (True) and those that did not (False)
+    """
+    closure_zones = fc.open_file(closure_zones_path, columns=['SEGMENTID', 'ZONE'])
+    partials = []
+    for month, month_partitions in itertools.groupby(taxi_partitions(partition_dir), key=lambda key: key[0]):
+        month_start = pd.Timestamp(f'{month}-01')
+        month_end = month_start + pd.DateOffset(months=1)
+        crashes = fc.open_file(crashes_path, columns=['ZONE', 'CRASH DATE_CRASH TIME'],
+                               filters=[('CRASH DATE_CRASH TIME', '>=', month_start - time_window),
+                                        ('CRASH DATE_CRASH TIME', '<=', month_end + MAX_TRIP + time_window)])
+        closures = fc.open_file(closures_path, columns=['SEGMENTID', 'WORK_START_DATE', 'WORK_END_DATE'],
+                                filters=[('WORK_START_DATE', '<', month_end), ('WORK_END_DATE', '>=', month_start)])
+
+        for _, pickup_zone in month_partitions:
+            trips = read_partition(month, pickup_zone, partition_dir)
+            events = fc.events_for_partition(trips, crashes, closures, closure_zones, time_window, corridors)
+            counts = fc.event_counts_during_trips(trips, *events, time_window, corridors)
+            passed_event = ((counts['num_of_crashes_passed'] > 0) | (counts['num_of_road_closures_passed'] > 0))
+            partials.append(partial_moments(trips, passed_event.to_numpy(), columns))
+    return combine_moments(partials)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the trip analysis on the full monthly taxi files, one month '
+                                                 'and pickup zone partition at a time.')
+    parser.add_argument('taxi_files', nargs='*', help='monthly taxi files to prepare and partition first')
+    parser.add_argument('--partition-dir', default=PARTITION_DIR, help='directory of the partitioned trips')
+    parser.add_argument('--zones', default='NYC_Taxi_Zones.geojson', help='path to the taxi zones file')
+    args = parser.parse_args()
+
+    if args.taxi_files:
+        neighbors = zones.neighbor_dict(zones.load_adjacency(args.zones))
+        print(f'Trips removed by each rule: {write_taxi_partitions(args.taxi_files, args.partition_dir, neighbors)}')
+    print(event_statistics(args.partition_dir))
@@ -0,0 +1,222 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+METRICS = ['fare_amount', 'trip_time_h', 'avg speed']
+N_RESAMPLES = 1000
+CONFIDENCE = 0.95
+# strata with fewer trips than this in either group get no effect sizes
+MIN_TRIPS = 5
+# largest number of row indices one block of resamples draws at a time, which bounds the memory of a stratum
+MAX_GATHER = 2 ** 24
+# strata sent to a worker process at a time
+STRATA_PER_TASK = 64
+# columns of stratum_effects
+EFFECT_COLUMNS = ['mean_event', 'mean_no_event', 'difference', 'ci_low', 'ci_high', 'relative_difference',
+                  'relative_ci_low', 'relative_ci_high', 'cohens_d']
+
+
+def stratum_keys(trips_df: pd.DataFrame, strata: list) -> pd.DataFrame:
+    """
+    Finds the stratum of every trip.
+    :param trips_df: pandas dataframe of taxi trips
+    :param strata: list of 'zone' (pickup zone), 'hour' or 'month' (of the pickup) and other column names
+    :return: pandas dataframe with one column per stratum
+    >>> trips = pd.DataFrame({'PULocationID': [4, 7], 'tpep_pickup_datetime': pd.to_datetime(['2018-01-01 08:10',
+    ...                                                                                      '2018-03-02 17:00'])})
+    >>> stratum_keys(trips, ['zone', 'hour', 'month']).values.tolist()
+    [[4, 8, '2018-01'], [7, 17, '2018-03']]
+    """
+    pickup = pd.to_datetime(trips_df['tpep_pickup_datetime']) if {'hour', 'month'} & set(strata) else None
+    keys = {}
+    for stratum in strata:
+        if stratum == 'zone':
+            keys[stratum] = trips_df['PULocationID'].to_numpy()
+        elif stratum == 'hour':
+            keys[stratum] = pickup.dt.hour.to_numpy()
+        elif stratum == 'month':
+            keys[stratum] = pickup.to_numpy().astype('datetime64[M]').astype(str)
+        else:
+            keys[stratum] = trips_df[stratum].to_numpy()
+    return pd.DataFrame(keys, index=trips_df.index)
+
+
+def bootstrap_means(values: np.ndarray, n_resamples: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Resamples the rows of values with replacement and averages every resample. A block of resamples is drawn as a
+    matrix of row indices and counted into a matrix of how often every row was drawn, so the means of the block are
+    one matrix product. Blocks hold at most MAX_GATHER indices. NaN values are left out of the mean of their metric
+    only.
+    :param values: numpy array with one row per trip and one column per metric
+    :param n_resamples: number of resamples
+    :param rng: numpy random generator
+    :return: numpy array with one row per resample and the mean of every metric
+    >>> bootstrap_means(np.array([[1.0], [3.0]]), 4, np.random.default_rng(0)).shape
+    (4, 1)
+    >>> bootstrap_means(np.array([[1.0, np.nan], [1.0, 3.0]]), 2, np.random.default_rng(0))[:, 1]
+    array([3., 3.])
+    """
+    n = len(values)
+    present = ~np.isnan(values)
+    filled = np.where(present, values, 0.0)
+    means = np.empty((n_resamples, values.shape[1]))
+    block = max(1, MAX_GATHER // max(n, 1))
+    for start in range(0, n_resamples, block):
+        size = min(block, n_resamples - start)
+        indices = rng.integers(0, n, size=(size, n), dtype=np.int64)
+        indices += np.arange(size, dtype=np.int64)[:, None] * n
+        counts = np.bincount(indices.ravel(), minlength=size * n).reshape(size, n).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means[start:start + size] = (counts @ filled) / (counts @ present)
+    return means
+
+
+def column_stats(values: np.ndarray) -> tuple:
+    """
+    Finds the number of values, mean and sample variance of every column, leaving out NaN values.
+    :param values: numpy array with one row per trip and one column per metric
+    :return: tuple of three numpy arrays: counts, means and variances. Means and variances are NaN when there are too
+        few values.
+    >>> column_stats(np.array([[1.0, np.nan], [3.0, 2.0]]))
+    (array([2, 1]), array([2., 2.]), array([ 2., nan]))
+    """
+    present = ~np.isnan(values)
+    counts = present.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(present, values, 0.0).sum(axis=0) / counts
+        variances = (np.where(present, values - means, 0.0) ** 2).sum(axis=0) / (counts - 1)
+    return counts, means, np.where(counts > 1, variances, np.nan)
+
+
+def stratum_effects(event_values: np.ndarray, other_values: np.ndarray, n_resamples: int, confidence: float,
+                    seed) -> np.ndarray:
+    """
+    Compares the trips that passed an event with the other trips of a stratum. The confidence intervals are the
+    percentile intervals of the bootstrap resamples. A trip with a NaN metric is left out of that metric only.
+    :param event_values: numpy array of the metrics of the trips that passed an event
+    :param other_values: numpy array of the metrics of the other trips
+    :param n_resamples: number of bootstrap resamples
+    :param confidence: confidence level of the intervals
+    :param seed: seed of the random number generator
+    :return: numpy array with one row per metric and the columns mean_event, mean_no_event, difference, ci_low,
+        ci_high, relative_difference, relative_ci_low, relative_ci_high and cohens_d
+    """
+    rng = np.random.default_rng(seed)
+    n_event, mean_event, var_event = column_stats(event_values)
+    n_other, mean_other, var_other = column_stats(other_values)
+    boot_event = bootstrap_means(event_values, n_resamples, rng)
+    boot_other = bootstrap_means(other_values, n_resamples, rng)
+    tails = [(1 - confidence) / 2, (1 + confidence) / 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ci_low, ci_high = np.quantile(boot_event - boot_other, tails, axis=0)
+        relative_low, relative_high = np.quantile(boot_event / boot_other - 1, tails, axis=0)
+        pooled_var = ((n_event - 1) * var_event + (n_other - 1) * var_other) / (n_event + n_other - 2)
+        return np.column_stack([mean_event, mean_other, mean_event - mean_other, ci_low, ci_high,
+                                mean_event / mean_other - 1, relative_low, relative_high,
+                                (mean_event - mean_other) / np.sqrt(pooled_var)])
+
+
+def stratum_batch(batch: list) -> list:
+    """
+    Runs stratum_effects on a batch of strata. Used by the worker processes of bootstrap_effects.
+    :param batch: list of tuples with the arguments of stratum_effects
+    :return: list of the results of stratum_effects
+    """
+    return [stratum_effects(*arguments) for arguments in batch]
+
+
+def bootstrap_effects(trips_df: pd.DataFrame, passed_event: np.ndarray, strata: list = None,
+                      metrics: list = METRICS, n_resamples: int = N_RESAMPLES, confidence: float = CONFIDENCE,
+                      min_trips: int = MIN_TRIPS, seed: int = 0, workers: int = None) -> pd.DataFrame:
+    """
+    Estimates how much the trips that passed a traffic event differ from the other trips in every metric, with
+    bootstrap confidence intervals, overall or in every stratum. Every stratum gets its own seed from seed, so the
+    results do not depend on the number of workers. A trip with a NaN metric is left out of that metric only, so
+    n_event and n_no_event can differ between the metrics of a stratum. A trip with a missing value in a strata
+    column is left out of all strata.
+    :param trips_df: pandas dataframe of taxi trips
+    :param passed_event: numpy boolean array that is True for the trips that passed a traffic event
+    :param strata: list of 'zone', 'hour', 'month' or column names to stratify by. All trips are one stratum if None.
+    :param metrics: columns to compare
+    :param n_resamples: number of bootstrap resamples
+    :param confidence: confidence level of the intervals
+    :param min_trips: fewest trips with a value a metric needs in both groups. The effects of a metric with fewer are
+        NaN, and strata where no metric has enough are left out.
+    :param seed: seed of the random number generators
+    :param workers: number of worker processes. Uses all cores if None.
+    :return: pandas dataframe with one row per stratum and metric: the stratum columns, metric, n_event and
+        n_no_event (trips with a value of the metric) and the columns of stratum_effects. Differences are event minus
+        no event.
+    >>> rng = np.random.default_rng(1)
+    >>> trips = pd.DataFrame({'fare_amount': np.r_[rng.normal(12, 1, 200), rng.normal(10, 1, 200)],
+    ...                       'PULocationID': np.tile([4, 7], 200)})
+    >>> passed = np.r_[np.ones(200, dtype=bool), np.zeros(200, dtype=bool)]
+    >>> effects = bootstrap_effects(trips, passed, ['zone'], ['fare_amount'], n_resamples=200, workers=1)
+    >>> effects[['zone', 'metric', 'n_event', 'n_no_event']].values.tolist()
+    [[4, 'fare_amount', 100, 100], [7, 'fare_amount', 100, 100]]
+    >>> bool(((effects['ci_low'] < 2) & (effects['ci_high'] > 2)).all())
+    True
+    >>> trips.loc[:9, 'fare_amount'] = np.nan
+    >>> bootstrap_effects(trips, passed, ['zone'], ['fare_amount'], n_resamples=10, workers=1)['n_event'].tolist()
+    [95, 95]
+    >>> trips['PULocationID'] = trips['PULocationID'].astype(float)
+    >>> trips.loc[10:19, 'PULocationID'] = np.nan
+    >>> bootstrap_effects(trips, passed, ['zone'], ['fare_amount'], n_resamples=10, workers=1)['n_event'].tolist()
+    [90, 90]
+    """
+    strata = list(strata) if strata else []
+    values = trips_df[metrics].to_numpy(dtype=np.float64)
+    passed_event = np.asarray(passed_event, dtype=bool)
+    keys = stratum_keys(trips_df, strata)
+
+    # sort the trips by stratum and event group so every group is one slice
+    # a trip with a missing stratum value belongs to no stratum (ngroup gives it NaN or -1), so it is left out
+    # instead of becoming a NaN stratum
+    codes = (keys.groupby(strata, sort=True).ngroup().fillna(-1).to_numpy(dtype=np.int64) if strata
+             else np.zeros(len(values), dtype=np.int64))
+    known = codes >= 0
+    if not known.all():
+        values, passed_event, keys, codes = values[known], passed_event[known], keys[known], codes[known]
+    n_strata = int(codes.max()) + 1 if len(codes) else 0
+    group_codes = codes * 2 + passed_event
+    order = np.argsort(group_codes, kind='stable')
+    bounds = np.searchsorted(group_codes[order], np.arange(2 * n_strata + 1))
+
+    # trips with a value of every metric in every stratum and group
+    present = ~np.isnan(values)
+    group_counts = np.column_stack([np.bincount(group_codes, present[:, metric], 2 * n_strata).astype(np.int64)
+                                    for metric in range(len(metrics))])
+
+    seeds = np.random.SeedSequence(seed).spawn(n_strata)
+    kept, tasks = [], []
+    for stratum in range(n_strata):
+        n_other, n_event = group_counts[2 * stratum], group_counts[2 * stratum + 1]
+        if ((n_event >= min_trips) & (n_other >= min_trips)).any():
+            other = order[bounds[2 * stratum]:bounds[2 * stratum + 1]]
+            event = order[bounds[2 * stratum + 1]:bounds[2 * stratum + 2]]
+            kept.append((stratum, n_event, n_other))
+            tasks.append((values[event], values[other], n_resamples, confidence, seeds[stratum]))
+
+    if workers is None:
+        workers = os.cpu_count()
+    batches = [tasks[start:start + STRATA_PER_TASK] for start in range(0, len(tasks), STRATA_PER_TASK)]
+    if workers <= 1 or len(batches) <= 1:
+        results = [effects for batch in batches for effects in stratum_batch(batch)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = [effects for batch_results in executor.map(stratum_batch, batches)
+                       for effects in batch_results]
+
+    # one row per stratum and metric
+    strata_kept = [stratum for stratum, _, _ in kept]
+    repeat = np.repeat(np.arange(len(kept)), len(metrics))
+    n_event = np.concatenate([n for _, n, _ in kept]) if kept else np.array([], dtype=np.int64)
+    n_no_event = np.concatenate([n for _, _, n in kept]) if kept else np.array([], dtype=np.int64)
+    effects = pd.DataFrame(np.concatenate(results) if results else np.empty((0, len(EFFECT_COLUMNS))),
+                           columns=EFFECT_COLUMNS)
+    effects.loc[(n_event < min_trips) | (n_no_event < min_trips)] = np.nan
+    table = keys.iloc[order[bounds[2 * np.array(strata_kept, dtype=np.int64)]]].reset_index(drop=True).iloc[repeat]
+    table = table.reset_index(drop=True).assign(metric=np.tile(metrics, len(kept)),
+                                                n_event=n_event, n_no_event=n_no_event)
+    return pd.concat([table, effects], axis=1)
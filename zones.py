@@ -0,0 +1,288 @@
+import hashlib
+import os
+from typing import NamedTuple
+import numpy as np
+import geopandas as gpd
+import shapely
+
+# zone numbers go from 1 to 263, so arrays indexed by zone number have 264 rows
+NUM_ZONE_IDS = 264
+ASSET_VERSION = 1
+# largest distance in degrees (about 10 m in New York) the simplified zone boundaries move from the real boundaries
+SIMPLIFY_TOLERANCE = 0.0001
+
+
+class Adjacency(NamedTuple):
+    """
+    Neighbors of the taxi zones, indexed by zone number (objectid).
+    The neighbors of zone z are indices[indptr[z]:indptr[z + 1]] and matrix[z, n] is True if n is a neighbor of z.
+    """
+    indptr: np.ndarray
+    indices: np.ndarray
+    matrix: np.ndarray
+
+
+class ZoneAsset(NamedTuple):
+    """
+    Taxi zones compiled for fast loading, in the row order of the zones file. The polygons are stored as WKB and
+    prepared when loaded, so contains and intersects tests against them use an index of their edges.
+    simplified holds the polygons simplified with the tolerance, for drawing and quick approximate tests.
+    bounds has one (minx, miny, maxx, maxy) row per zone and centroids one (lon, lat) row.
+    """
+    zone_ids: np.ndarray
+    names: np.ndarray
+    boroughs: np.ndarray
+    geometries: np.ndarray
+    bounds: np.ndarray
+    centroids: np.ndarray
+    simplified: np.ndarray
+    tolerance: float
+
+
+def file_hash(path: str) -> str:
+    """
+    Hashes the content of a file.
+    :param path: path to the file
+    :return: sha1 hex digest of the file content
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+
+def save_arrays(path: str, **arrays):
+    """
+    Saves arrays to an npz file. They are written to a temporary file next to it that then replaces it, so a process
+    reading the file while another one saves it sees the old or the new file, never a partial one.
+    :param path: path of the npz file
+    :param arrays: arrays to save by name
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'arrays.npz')
+    >>> save_arrays(path, values=np.arange(3))
+    >>> np.load(path)['values'].tolist(), os.listdir(os.path.dirname(path))
+    ([0, 1, 2], ['arrays.npz'])
+    """
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temporary_path, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+def build_adjacency(nyc_geo: gpd.GeoDataFrame) -> Adjacency:
+    """
+    Finds the neighbors of every taxi zone. Zones are neighbors if they are not disjoint. A spatial index
+    gives the candidate pairs with overlapping bounding boxes, so only those are tested.
+    :param nyc_geo: geopandas dataframe with taxi zone data
+    :return: Adjacency of the zones
+    >>> from shapely.geometry import box
+    >>> zones = gpd.GeoDataFrame({'objectid': ['2', '1', '3']}, geometry=[box(0, 0, 1, 1), box(1, 0, 2, 1), box(5, 5, 6, 6)])
+    >>> adjacency = build_adjacency(zones)
+    >>> adjacency.indices[adjacency.indptr[1]:adjacency.indptr[2]], bool(adjacency.matrix[2, 1]), bool(adjacency.matrix[3].any())
+    (array([2], dtype=int16), True, False)
+    """
+    zone_ids = nyc_geo['objectid'].astype(int).to_numpy()
+    geometries = np.asarray(nyc_geo.geometry.values)
+    zone_positions, neighbor_positions = shapely.STRtree(geometries).query(geometries, predicate='intersects')
+
+    # remove every zone from its own neighbors
+    other_zone = zone_positions != neighbor_positions
+    zones, neighbors = zone_ids[zone_positions[other_zone]], zone_ids[neighbor_positions[other_zone]]
+
+    matrix = np.zeros((NUM_ZONE_IDS, NUM_ZONE_IDS), dtype=bool)
+    matrix[zones, neighbors] = True
+    zones, neighbors = np.nonzero(matrix)
+    indptr = np.searchsorted(zones, np.arange(NUM_ZONE_IDS + 1)).astype(np.int32)
+    return Adjacency(indptr, neighbors.astype(np.int16), matrix)
+
+
+def load_adjacency(zones_path: str = 'NYC_Taxi_Zones.geojson', nyc_geo: gpd.GeoDataFrame = None) -> Adjacency:
+    """
+    Loads the zone adjacency saved next to the zones file. It is rebuilt and saved again when the zones file content
+    changed since it was saved.
+    :param zones_path: path to the taxi zones file
+    :param nyc_geo: geopandas dataframe of the zones file. Read from zones_path if the adjacency has to be rebuilt and
+        it is not given.
+    :return: Adjacency of the zones
+    """
+    adjacency_path = os.path.splitext(zones_path)[0] + '.adjacency.npz'
+    zones_hash = file_hash(zones_path)
+    if os.path.exists(adjacency_path):
+        with np.load(adjacency_path) as saved:
+            if str(saved['zones_hash']) == zones_hash:
+                return Adjacency(saved['indptr'], saved['indices'], saved['matrix'])
+
+    if nyc_geo is None:
+        nyc_geo = read_zones(zones_path)
+    adjacency = build_adjacency(nyc_geo)
+    save_arrays(adjacency_path, indptr=adjacency.indptr, indices=adjacency.indices, matrix=adjacency.matrix,
+                zones_hash=np.array(zones_hash))
+    return adjacency
+
+
+def reachable_zones(matrix: np.ndarray, hops: int = 1) -> np.ndarray:
+    """
+    Finds the zones reachable from every zone in at most hops neighbor steps.
+    :param matrix: square boolean neighbor matrix
+    :param hops: maximum number of neighbor steps, 0 or more
+    :return: boolean matrix where [zone1, zone2] is True if zone2 can be reached from zone1. With one or more hops a
+        zone does not reach itself. With 0 hops every zone only reaches itself.
+    >>> path = np.array([[False, True, False], [True, False, True], [False, True, False]])
+    >>> reachable_zones(path, 2).astype(int)
+    array([[0, 1, 1],
+           [1, 0, 1],
+           [1, 1, 0]])
+    >>> reachable_zones(path, 0).astype(int)
+    array([[1, 0, 0],
+           [0, 1, 0],
+           [0, 0, 1]])
+    >>> reachable_zones(path, -1)
+    Traceback (most recent call last):
+    ...
+    ValueError: hops must be 0 or more, got -1
+    """
+    if hops < 0:
+        raise ValueError(f'hops must be 0 or more, got {hops}')
+    if hops == 0:
+        return np.eye(len(matrix), dtype=bool)
+    steps = matrix.astype(np.int32)
+    reachable = matrix.copy()
+    frontier = matrix
+    for _ in range(hops - 1):
+        frontier = (frontier.astype(np.int32) @ steps) > 0
+        reachable |= frontier
+    np.fill_diagonal(reachable, False)
+    return reachable
+
+
+def neighbor_dict(adjacency: Adjacency, zone_ids=range(1, NUM_ZONE_IDS)) -> dict:
+    """
+    Turns the adjacency into a dictionary of zones and their neighbors.
+    :param adjacency: Adjacency of the zones
+    :param zone_ids: zone numbers to include
+    :return: dictionary with format {zone1:[neighbor1,neighbor2,...], zone2:[neighbor1,neighbor2,...], ...}
+    """
+    return {int(zone): adjacency.indices[adjacency.indptr[zone]:adjacency.indptr[zone + 1]].tolist()
+            for zone in zone_ids}
+
+
+def query_zones(zone_index: shapely.STRtree, geometries: np.ndarray, predicate: str) -> tuple:
+    """
+    Finds the pairs of geometries and zones that match a predicate, like zone_index.query. The index only gives the
+    pairs with overlapping bounding boxes, and the prepared zone boundaries are tested against them in bulk, which is
+    much faster for many small geometries against detailed zones than a predicate query.
+    :param zone_index: STRtree over the zone boundaries, like File_creation.build_zone_index
+    :param geometries: numpy array of shapely geometries
+    :param predicate: 'within' (the zone contains the geometry) or 'intersects'
+    :return: tuple of numpy arrays with the positions in geometries and the zone positions of the matching pairs
+    """
+    shapely.prepare(zone_index.geometries)
+    geometry_positions, zone_positions = zone_index.query(geometries)
+    test = shapely.contains if predicate == 'within' else shapely.intersects
+    matches = test(zone_index.geometries[zone_positions], geometries[geometry_positions])
+    return geometry_positions[matches], zone_positions[matches]
+
+
+def compile_zones(nyc_geo: gpd.GeoDataFrame, tolerance: float = SIMPLIFY_TOLERANCE) -> ZoneAsset:
+    """
+    Compiles the taxi zones with integer zone numbers, bounding boxes, centroids and simplified polygons.
+    :param nyc_geo: geopandas dataframe with taxi zone data in EPSG:4326
+    :param tolerance: largest distance in degrees the simplified boundaries may move
+    :return: ZoneAsset of the zones
+    >>> from shapely.geometry import box
+    >>> zones = gpd.GeoDataFrame({'objectid': ['2', '1'], 'zone': ['a', 'b'], 'borough': ['Queens', 'Bronx']},
+    ...                          geometry=[box(0, 0, 1, 1), box(1, 0, 3, 1)], crs='EPSG:4326')
+    >>> asset = compile_zones(zones)
+    >>> asset.zone_ids, asset.bounds[1].tolist()
+    (array([2, 1], dtype=int16), [1.0, 0.0, 3.0, 1.0])
+    """
+    geometries = np.asarray(nyc_geo.geometry.values)
+    # centroids are found in feet (EPSG:2263), where the areas are not stretched by the latitude
+    centroids = nyc_geo.geometry.to_crs('EPSG:2263').centroid.to_crs('EPSG:4326')
+    shapely.prepare(geometries)
+    return ZoneAsset(nyc_geo['objectid'].astype(int).to_numpy(dtype=np.int16),
+                     nyc_geo['zone'].to_numpy(dtype=str), nyc_geo['borough'].to_numpy(dtype=str), geometries,
+                     shapely.bounds(geometries), np.stack([centroids.x.to_numpy(), centroids.y.to_numpy()], axis=1),
+                     shapely.simplify(geometries, tolerance, preserve_topology=True), float(tolerance))
+
+
+def pack_geometries(geometries: np.ndarray) -> tuple:
+    """
+    Stores geometries as one byte array of WKB.
+    :param geometries: numpy array of shapely geometries
+    :return: tuple of the offsets (geometry i is data[offsets[i]:offsets[i + 1]]) and the uint8 WKB data
+    """
+    wkb = shapely.to_wkb(geometries)
+    offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(geometry) for geometry in wkb])
+    return offsets, np.frombuffer(b''.join(wkb), dtype=np.uint8)
+
+
+def unpack_geometries(offsets: np.ndarray, data: np.ndarray) -> np.ndarray:
+    """
+    Reads the geometries stored by pack_geometries.
+    :param offsets: offsets of the geometries in data
+    :param data: uint8 WKB data
+    :return: numpy array of shapely geometries
+    >>> from shapely.geometry import box
+    >>> unpack_geometries(*pack_geometries(np.array([box(0, 0, 1, 1), shapely.Point(2, 3)])))[1].wkt
+    'POINT (2 3)'
+    """
+    data = data.tobytes()
+    return shapely.from_wkb(np.array([data[start:end] for start, end in zip(offsets[:-1], offsets[1:])],
+                                     dtype=object))
+
+
+def load_zone_asset(zones_path: str = 'NYC_Taxi_Zones.geojson', tolerance: float = SIMPLIFY_TOLERANCE) -> ZoneAsset:
+    """
+    Loads the compiled zones saved next to the zones file, which takes milliseconds instead of parsing the GeoJSON.
+    They are compiled and saved again when the zones file content or the tolerance changed since they were saved.
+    :param zones_path: path to the taxi zones file
+    :param tolerance: largest distance in degrees the simplified boundaries may move
+    :return: ZoneAsset of the zones
+    """
+    asset_path = os.path.splitext(zones_path)[0] + '.zones.npz'
+    zones_hash = f'{ASSET_VERSION}-{tolerance!r}-{file_hash(zones_path)}'
+    if os.path.exists(asset_path):
+        with np.load(asset_path) as saved:
+            if str(saved['zones_hash']) == zones_hash:
+                geometries = unpack_geometries(saved['wkb_offsets'], saved['wkb'])
+                shapely.prepare(geometries)
+                return ZoneAsset(saved['zone_ids'], saved['names'], saved['boroughs'], geometries, saved['bounds'],
+                                 saved['centroids'], unpack_geometries(saved['simplified_offsets'],
+                                                                       saved['simplified_wkb']), tolerance)
+
+    asset = compile_zones(gpd.read_file(zones_path), tolerance)
+    wkb_offsets, wkb = pack_geometries(asset.geometries)
+    simplified_offsets, simplified_wkb = pack_geometries(asset.simplified)
+    save_arrays(asset_path, zone_ids=asset.zone_ids, names=asset.names, boroughs=asset.boroughs, bounds=asset.bounds,
+                centroids=asset.centroids, wkb_offsets=wkb_offsets, wkb=wkb, simplified_offsets=simplified_offsets,
+                simplified_wkb=simplified_wkb, zones_hash=np.array(zones_hash))
+    return asset
+
+
+def zone_frame(asset: ZoneAsset, simplified: bool = False) -> gpd.GeoDataFrame:
+    """
+    Turns compiled zones into the geopandas dataframe the rest of the code takes as nyc_geo.
+    :param asset: ZoneAsset of the zones
+    :param simplified: use the simplified polygons, for drawing maps
+    :return: geopandas dataframe with integer objectid, zone, borough and geometry columns in EPSG:4326
+    """
+    return gpd.GeoDataFrame({'objectid': asset.zone_ids.astype(np.int64), 'zone': asset.names,
+                             'borough': asset.boroughs},
+                            geometry=asset.simplified if simplified else asset.geometries, crs='EPSG:4326')
+
+
+def read_zones(zones_path: str = 'NYC_Taxi_Zones.geojson', simplified: bool = False) -> gpd.GeoDataFrame:
+    """
+    Reads the taxi zones from their compiled asset. Use instead of gpd.read_file on the zones file.
+    :param zones_path: path to the taxi zones file
+    :param simplified: use the simplified polygons, for drawing maps
+    :return: geopandas dataframe with integer objectid, zone, borough and geometry columns in EPSG:4326
+    """
+    return zone_frame(load_zone_asset(zones_path), simplified)